@@ -19,9 +19,64 @@ HAPLOQA_CONFIG = {
     'GENERATE_IDS_DEFAULT': True,
     'ON_DUPLICATE_ID_DEFAULT': 'skip',  # 'halt', 'replace'
 
+    # the number of samples that importers write to the database per bulk write
+    'IMPORT_BATCH_SIZE': 10,
+
+    # the number of processes used to parse final reports. Reports are split at
+    # sample boundaries so each process parses a different set of samples.
+    # Imports running inside daemonic celery pool processes always parse in
+    # a single process
+    'IMPORT_PARSE_WORKERS': 1,
+
+    # the approximate amount of memory (in megabytes) that the genotype matrix
+    # importer uses to buffer samples. The matrix files are read once for as many
+    # samples as fit in this budget
+    'IMPORT_MEMORY_BUDGET_MB': 1024,
+
+    # when True, imported samples store genotypes as one byte per call (plus 2-bit
+    # packed AB codes) and probe intensities as float32 binary values instead of lists
+    # of strings and doubles. This makes sample documents much smaller and faster to
+    # load. Packing is lossless. Existing samples can be packed with:
+    # python -m haploqa.schemaupgrade --pack-chromosome-data
+    'PACKED_CHROMOSOME_DATA': True,
+
+    # the maximum number of haplotype candidate search results that are cached. Once
+    # the cache is full the least recently used results are evicted
+    'CANDIDATE_SEARCH_CACHE_SIZE': 10000,
+
+    # the number of sample chromosome candidate likelihood tables that each worker
+    # process keeps in memory so that searches over different intervals of the same
+    # chromosome don't need to reload and rescore the candidates. A table takes about
+    # 8 * (# SNPs / 256) * (# candidates) ^ 2 bytes
+    'CANDIDATE_INTERVAL_CACHE_SIZE': 8,
+
+    # the number of samples whose haplotypes are inferred by a single celery task. Each
+    # task loads its samples and their contributing strains once for all chromosomes
+    'HAPLOTYPE_INFERENCE_BATCH_SIZE': 10,
+
+    # the number of chromosome SNP annotation tables that each process keeps in memory
+    # (see mongods.get_snp_table). Tables are reloaded when a platform's annotations change
+    'SNP_TABLE_CACHE_SIZE': 128,
+
+    # the number of contributing strain AB code panels (one per platform, strain set and
+    # chromosome) that each worker process keeps in memory for haplotype inference. A
+    # panel takes about (# chromosome SNPs) * (# strains) bytes
+    'HAPLOTYPE_PANEL_CACHE_SIZE': 256,
+
+    # the number of days that GEMM screen results are kept before they are removed
+    'GEMM_SCREEN_TTL_DAYS': 7,
+
     'DB_HOST': 'localhost',
     'DB_PORT': 27017,
 
+    # connection pool settings for the MongoClient that is shared by all requests
+    # and tasks in a process. Set any of these to None to use the pymongo default
+    'DB_MAX_POOL_SIZE': 100,
+    'DB_CONNECT_TIMEOUT_MS': 20000,
+    'DB_SOCKET_TIMEOUT_MS': None,
+    'DB_SERVER_SELECTION_TIMEOUT_MS': 30000,
+    'DB_READ_PREFERENCE': 'primary',  # 'primaryPreferred', 'secondary', 'secondaryPreferred', 'nearest'
+
     'SMTP_HOST': 'smtp.jax.org',
     'SMTP_PORT': 25,
 
@@ -1,109 +1,149 @@
 import argparse
 import csv
 
+import numpy as np
+
+from haploqa.config import HAPLOQA_CONFIG
 import haploqa.mongods as mds
 
 
-SAMPLE_BATCH_SIZE = 20
-
-
-def import_samples(platform, geno_matrix_csv, x_matrix_csv, y_matrix_csv, sample_tags, db):
-    platform_chrs, snp_count_per_chr, snp_chr_indexes = mds.within_chr_snp_indices(platform, db)
-
-    curr_sample_start_index = 0
-    while True:
-        def get_sample_names(header_row):
-            slice = header_row[curr_sample_start_index:curr_sample_start_index + SAMPLE_BATCH_SIZE]
-            return [x.strip() for x in slice]
-
-        def get_data(data_row):
-            # the '+ 1' is because we need to shift right to accommodate the SNP ID column
-            slice = data_row[curr_sample_start_index + 1:curr_sample_start_index + SAMPLE_BATCH_SIZE + 1]
-            return [x.strip() for x in slice]
-
-        with open(geno_matrix_csv, 'r', newline='') as geno_matrix_handle, \
-             open(x_matrix_csv, 'r', newline='') as x_matrix_handle, \
-             open(y_matrix_csv, 'r', newline='') as y_matrix_handle:
-
-            # grab the current sample names
-            geno_matrix_table = csv.reader(geno_matrix_handle)
-            x_matrix_table = csv.reader(x_matrix_handle)
-            y_matrix_table = csv.reader(y_matrix_handle)
-
-            sample_names = get_sample_names(next(geno_matrix_table))
-            if not sample_names:
-                # we've already imported all of the samples
-                return
-            x_sample_names = get_sample_names(next(x_matrix_table))
-            y_sample_names = get_sample_names(next(y_matrix_table))
-
-            if sample_names != x_sample_names or sample_names != y_sample_names:
-                raise Exception('sample IDs do not match in files')
-
-            def make_snp_stream():
-                while True:
-                    next_geno_row = next(geno_matrix_table)
-                    next_x_row = next(x_matrix_table)
-                    next_y_row = next(y_matrix_table)
-
-                    snp_id = next_geno_row[0].strip()
-                    if snp_id != next_x_row[0].strip() or snp_id != next_y_row[0].strip():
-                        raise Exception('snp IDs do not match in files')
-
-                    genos = get_data(next_geno_row)
-                    xs = [float(x) for x in get_data(next_x_row)]
-                    ys = [float(y) for y in get_data(next_y_row)]
-
-                    yield snp_id, genos, xs, ys
-
-            samples = []
-            for sample_name in sample_names:
-                chr_dict = dict()
-                for chr in platform_chrs:
-                    curr_snp_count = snp_count_per_chr[chr]
-                    chr_dict[chr] = {
-                        'xs': [float('nan')] * curr_snp_count,
-                        'ys': [float('nan')] * curr_snp_count,
-                        'snps': ['-'] * curr_snp_count,
-                    }
-                curr_sample = {
-                    'sample_id': mds.gen_unique_id(db),
-                    'other_ids': [sample_name],
-                    'platform_id': platform,
-                    'chromosome_data': chr_dict,
-                    'tags': sample_tags,
-                    'unannotated_snps': [],
+# each buffered sample needs an X and Y intensity (8 bytes each) and a genotype
+# reference (8 bytes) for every SNP
+BUFFER_BYTES_PER_SNP = 24
+
+
+def _read_header(matrix_table):
+    return [x.strip() for x in next(matrix_table)[1:]]
+
+
+def _fill_buffers(geno_matrix_csv, x_matrix_csv, y_matrix_csv, sample_start, sample_end, snp_index,
+                  geno_buf, x_buf, y_buf):
+    """
+    Read through the matrix files one time, filling the column-major buffers for the samples
+    in the [sample_start, sample_end) range. Rows for SNPs that aren't in the platform's
+    snp_index are skipped
+    """
+    with open(geno_matrix_csv, 'r', newline='') as geno_matrix_handle, \
+         open(x_matrix_csv, 'r', newline='') as x_matrix_handle, \
+         open(y_matrix_csv, 'r', newline='') as y_matrix_handle:
+
+        geno_matrix_table = csv.reader(geno_matrix_handle)
+        x_matrix_table = csv.reader(x_matrix_handle)
+        y_matrix_table = csv.reader(y_matrix_handle)
+
+        # skip past the headers. We've already checked that they match
+        for matrix_table in (geno_matrix_table, x_matrix_table, y_matrix_table):
+            next(matrix_table)
+
+        # the '+ 1' is because we need to shift right to accommodate the SNP ID column
+        col_start = sample_start + 1
+        col_end = sample_end + 1
+        for geno_row, x_row, y_row in zip(geno_matrix_table, x_matrix_table, y_matrix_table):
+            snp_id = geno_row[0].strip()
+            if snp_id != x_row[0].strip() or snp_id != y_row[0].strip():
+                raise Exception('snp IDs do not match in files')
+
+            snp_row = snp_index.get_row(snp_id)
+            if snp_row is not None:
+                geno_buf[snp_row, :] = [x.strip().upper() for x in geno_row[col_start:col_end]]
+                x_buf[snp_row, :] = np.array(x_row[col_start:col_end], dtype=np.float64)
+                y_buf[snp_row, :] = np.array(y_row[col_start:col_end], dtype=np.float64)
+
+    geno_buf[geno_buf == 'N'] = '-'
+
+
+def import_samples(platform, geno_matrix_csv, x_matrix_csv, y_matrix_csv, sample_tags, db,
+                   memory_budget_mb=None, batch_size=None):
+    """
+    Import samples from genotype, X and Y intensity matrices (one row per SNP and one column
+    per sample). Each file is read once for as many samples as fit in the memory budget so
+    typically a single pass is enough.
+    :param platform: the platform of the samples
+    :param geno_matrix_csv: the genotype matrix file
+    :param x_matrix_csv: the X intensity matrix file
+    :param y_matrix_csv: the Y intensity matrix file
+    :param sample_tags: the tags to give each sample
+    :param db: the database
+    :param memory_budget_mb:
+        the approximate amount of memory to use for buffering sample data. Defaults to the
+        IMPORT_MEMORY_BUDGET_MB config value
+    :param batch_size:
+        the number of samples to insert per bulk write. Defaults to the IMPORT_BATCH_SIZE
+        config value
+    """
+    if memory_budget_mb is None:
+        memory_budget_mb = HAPLOQA_CONFIG.get('IMPORT_MEMORY_BUDGET_MB', 1024)
+    if batch_size is None:
+        batch_size = HAPLOQA_CONFIG.get('IMPORT_BATCH_SIZE', 10)
+
+    snp_index = mds.get_platform_snp_index(platform, db)
+    snp_calls = mds.get_snp_calls(platform, db)
+    gemm_anno = mds.get_gemm_anno(platform, db)
+
+    # the buffers hold all of the platform's SNPs with chromosomes laid out one after the other
+    total_snp_count = snp_index.total_snp_count
+
+    with open(geno_matrix_csv, 'r', newline='') as geno_matrix_handle, \
+         open(x_matrix_csv, 'r', newline='') as x_matrix_handle, \
+         open(y_matrix_csv, 'r', newline='') as y_matrix_handle:
+        sample_names = _read_header(csv.reader(geno_matrix_handle))
+        x_sample_names = _read_header(csv.reader(x_matrix_handle))
+        y_sample_names = _read_header(csv.reader(y_matrix_handle))
+
+    if sample_names != x_sample_names or sample_names != y_sample_names:
+        raise Exception('sample IDs do not match in files')
+
+    samples_per_pass = max(1, (memory_budget_mb * 2 ** 20) // (BUFFER_BYTES_PER_SNP * max(1, total_snp_count)))
+    for sample_start in range(0, len(sample_names), samples_per_pass):
+        pass_sample_names = sample_names[sample_start:sample_start + samples_per_pass]
+        pass_sample_count = len(pass_sample_names)
+
+        geno_buf = np.full((total_snp_count, pass_sample_count), '-', dtype=object)
+        x_buf = np.full((total_snp_count, pass_sample_count), np.nan)
+        y_buf = np.full((total_snp_count, pass_sample_count), np.nan)
+        _fill_buffers(
+            geno_matrix_csv, x_matrix_csv, y_matrix_csv,
+            sample_start, sample_start + pass_sample_count,
+            snp_index, geno_buf, x_buf, y_buf)
+
+        sample_ids = mds.gen_unique_ids(pass_sample_count, db)
+        sample_batch = []
+        for i, sample_name in enumerate(pass_sample_names):
+            chr_dict = dict()
+            for chr, chr_offset, snp_count in zip(snp_index.chromosomes, snp_index.chr_offsets, snp_index.snp_counts):
+                chr_slice = slice(chr_offset, chr_offset + snp_count)
+                chr_dict[chr] = {
+                    'xs': x_buf[chr_slice, i],
+                    'ys': y_buf[chr_slice, i],
+                    'snps': geno_buf[chr_slice, i],
                 }
-                samples.append(curr_sample)
-
-            for snp_id, genos, xs, ys in make_snp_stream():
-                snp_chr_index = snp_chr_indexes.get(snp_id)
-                if snp_chr_index is not None:
-                    snp_chr = snp_chr_index['chromosome']
-                    snp_index = snp_chr_index['index']
-                    for i, curr_sample in enumerate(samples):
-                        curr_geno = genos[i].upper()
-                        if curr_geno == 'N':
-                            curr_geno = '-'
-                        curr_x = xs[i]
-                        curr_y = ys[i]
-
-                        curr_sample_chr = curr_sample['chromosome_data'][snp_chr]
-                        curr_sample_chr['xs'][snp_index] = curr_x
-                        curr_sample_chr['ys'][snp_index] = curr_y
-                        curr_sample_chr['snps'][snp_index] = curr_geno
-
-            for curr_sample in samples:
-                mds.post_proc_sample(curr_sample)
-                db.samples.insert_one(curr_sample)
-            print('inserted samples:', ', '.join(sample_names))
-
-        curr_sample_start_index += SAMPLE_BATCH_SIZE
+            curr_sample = {
+                'sample_id': sample_ids[i],
+                'other_ids': [sample_name],
+                'platform_id': platform,
+                'chromosome_data': chr_dict,
+                'tags': sample_tags,
+                'unannotated_snps': [],
+            }
+            mds.post_proc_sample(curr_sample, None, snp_calls, gemm_anno)
+            sample_batch.append(curr_sample)
+
+            if len(sample_batch) >= batch_size or i == pass_sample_count - 1:
+                db.samples.insert_many(sample_batch)
+                print('inserted samples:', ', '.join(x['other_ids'][0] for x in sample_batch))
+                sample_batch = []
 
 
 def main():
     # parse command line arguments
     parser = argparse.ArgumentParser(description='import the final report with probe intensities')
+    parser.add_argument(
+        '--memory-budget-mb',
+        type=int,
+        help='the approximate amount of memory (in megabytes) used to buffer samples. The matrix files are read '
+             'once for as many samples as fit in this budget. By default the IMPORT_MEMORY_BUDGET_MB config '
+             'value is used',
+    )
     parser.add_argument(
         'platform',
         help='the platform for the data we are importing. eg: MegaMUGA')
@@ -125,7 +165,8 @@ def main():
             args.platform,
             args.geno_matrix_csv, args.x_matrix_csv, args.y_matrix_csv,
             [args.tag, args.platform],
-            mds.init_db())
+            mds.init_db(),
+            args.memory_budget_mb)
 
 
 if __name__ == '__main__':
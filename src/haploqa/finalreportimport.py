@@ -1,13 +1,22 @@
 import argparse
+from collections import deque
 import csv
+from itertools import islice
+import multiprocessing
+import os
 from os.path import splitext, basename
 import sys
 import time
 
+import numpy as np
+
 import haploqa.mongods as mds
 import haploqa.sampleannoimport as sai
 
-from pymongo.errors import DuplicateKeyError
+from pymongo import InsertOne, ReplaceOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from haploqa.config import HAPLOQA_CONFIG
 
 header_tag = '[header]'
 data_tag = '[data]'
@@ -19,180 +28,419 @@ y_col_hdr = 'Y'
 allele1_fwd_col_hdr = 'Allele1 - Forward'
 allele2_fwd_col_hdr = 'Allele2 - Forward'
 
-def import_final_report(user_email, generate_ids, on_duplicate, final_report_file, sample_anno_dicts, platform_id, sample_tags, db):
-
-    def save_sample(samp):
-        if samp is not None:
-            try:
-                samp = sai.merge_dicts(samp, sample_anno_dicts[samp['sample_id']])
-            except KeyError:
-                pass
-
-            if generate_ids:
-                # if we're asked to generate IDs we move the sample ID into "other_ids"
-                samp['other_ids'] = [samp['sample_id']]
-                samp['sample_id'] = mds.gen_unique_id(db)
-            else:
-                samp['other_ids'] = []
-
-            mds.post_proc_sample(samp, user_email)
-
-            samp['owner'] = user_email
-
-            if on_duplicate == 'replace':
-                update_res = db.samples.replace_one(
-                    {'sample_id': samp['sample_id']},
-                    samp,
-                    upsert=True,
-                )
-                if update_res.upserted_id is None:
-                    print('replaced sample with canonical ID:', samp['sample_id'])
-            else:
-                try:
-                    db.samples.insert_one(samp)
-                except DuplicateKeyError:
-                    if on_duplicate == 'skip':
-                        print('skipping insert of duplicate sample with canonical ID:', samp['sample_id'])
-                    else:
-                        print(
-                            'halting import after detecting duplicate canonical ID:',
-                            samp['sample_id'],
-                            file=sys.stderr,
-                        )
-                        raise
-
-    platform_chrs, snp_count_per_chr, snp_chr_indexes = mds.within_chr_snp_indices(platform_id, db)
+DUPLICATE_KEY_ERROR_CODE = 11000
+
+# when parsing in parallel we split the report into this many chunks per worker so
+# that workers stay busy even when samples vary in size
+PARSE_CHUNKS_PER_WORKER = 4
+
+
+def _write_samples(samples, on_duplicate, db):
+    """
+    write a batch of samples to the DB using a single bulk write. Duplicate handling mirrors
+    on_duplicate: 'replace' upserts every sample, 'skip' does an unordered insert and reports
+    the duplicates and anything else does an ordered insert which halts at the first duplicate
+    """
+    if on_duplicate == 'replace':
+        write_res = db.samples.bulk_write(
+            [ReplaceOne({'sample_id': samp['sample_id']}, samp, upsert=True) for samp in samples],
+            ordered=False,
+        )
+        for i, samp in enumerate(samples):
+            if i not in write_res.upserted_ids:
+                print('replaced sample with canonical ID:', samp['sample_id'])
+    else:
+        try:
+            db.samples.bulk_write(
+                [InsertOne(samp) for samp in samples],
+                ordered=on_duplicate != 'skip',
+            )
+        except BulkWriteError as e:
+            write_errors = e.details.get('writeErrors', [])
+            if any(err['code'] != DUPLICATE_KEY_ERROR_CODE for err in write_errors):
+                raise
+
+            for err in write_errors:
+                samp_id = samples[err['index']]['sample_id']
+                if on_duplicate == 'skip':
+                    print('skipping insert of duplicate sample with canonical ID:', samp_id)
+                else:
+                    print('halting import after detecting duplicate canonical ID:', samp_id, file=sys.stderr)
+                    raise DuplicateKeyError(err['errmsg'], err['code']) from e
 
-    prev_time = time.time()
-    all_sample_ids = set()
 
+def _sample_id_col_hdr(platform_id):
     # for MiniMUGA, the files I've had access to had blank values for 'Sample ID'
     # although the header value is there. The 'Sample Name' values were populated
     # though so swap the sample ID column header to 'Sample Name'
     if platform_id == 'MiniMUGA':
-        sample_id_col_hdr = 'Sample Name'
+        return 'Sample Name'
     else:
-        sample_id_col_hdr = 'Sample ID'
+        return 'Sample ID'
+
 
+def _fmt_err(final_report_file, offset, msg, cause=None):
+    ex = Exception('Format Error in {} at byte offset {}: {}'.format(final_report_file, offset, msg))
+    if cause is None:
+        raise ex
+    else:
+        raise ex from cause
+
+
+def _parse_row(line):
+    return next(csv.reader([line], delimiter='\t'), [])
+
+
+def _read_data_header(final_report_file, sample_id_col_hdr):
+    """
+    read through the [Header] section of the final report to find the header row of the [Data] section
+    :return: the tuple (data_header_indexes, data_start) where data_header_indexes maps the required
+        column headers to their column index and data_start is the byte offset of the first data row.
+        If there is no data header we return (None, None)
+    """
     data_col_hdrs = {
         snp_name_col_hdr, sample_id_col_hdr,
         x_col_hdr, y_col_hdr,
         allele1_fwd_col_hdr, allele2_fwd_col_hdr
     }
 
-    with open(final_report_file, 'r') as final_report_handle:
-
-        final_report_table = csv.reader(final_report_handle, delimiter='\t')
-
+    with open(final_report_file, 'rb') as final_report_handle:
         curr_section = data_tag
-        data_header_indexes = None
-        curr_sample = None
-
-        for row_index, row in enumerate(final_report_table):
-            def fmt_err(msg, cause=None):
-                ex = Exception('Format Error in {} line {}: {}'.format(final_report_file, row_index + 1, msg))
-                if cause is None:
-                    raise ex
-                else:
-                    raise ex from cause
-
-            def string_val(col_name):
-                return row[data_header_indexes[col_name]].strip()
-
-            def float_val(col_name):
-                str_val = string_val(col_name)
-                try:
-                    return float(str_val)
-                except ValueError as e:
-                    if str_val.upper() == 'NA':
-                        return float('nan')
-                    else:
-                        fmt_err('failed to convert "' + str_val + '" into a float', e)
+        offset = 0
+        for line in final_report_handle:
+            row = _parse_row(line.decode())
+            offset += len(line)
 
             # just ignore empty lines
             if row:
                 if len(row) == 1 and row[0].lower() in tags:
                     curr_section = row[0].lower()
-                else:
-                    if curr_section == header_tag:
-                        # TODO do something with the header data
-                        pass
-                    elif curr_section == data_tag:
-                        if data_header_indexes is None:
-                            # this is the header. we'll just make note of the indices
-                            data_header_indexes = {
-                                col_hdr: i
-                                for i, col_hdr in enumerate(row)
-                                if col_hdr in data_col_hdrs
-                            }
-
-                            # confirm that all are represented
-                            for col_hdr in data_col_hdrs:
-                                if col_hdr not in data_header_indexes:
-                                    fmt_err('failed to find required header "{}" in data header'.format(col_hdr))
-                        else:
-                            snp_name = string_val(snp_name_col_hdr)
-                            sample_id = string_val(sample_id_col_hdr)
-                            x = float_val(x_col_hdr)
-                            y = float_val(y_col_hdr)
-                            allele1_fwd = string_val(allele1_fwd_col_hdr)
-                            allele2_fwd = string_val(allele2_fwd_col_hdr)
-
-                            if curr_sample is None or sample_id != curr_sample['sample_id']:
-                                # if we've seen this ID before it means that rows are not grouped by sample ID
-                                if sample_id in all_sample_ids:
-                                    raise Exception('Final report must be grouped by sample ID but it is not')
-
-                                # we hit a new sample so at this point we commit the curr_sample to the
-                                # DB and move on to building a new sample
-                                all_sample_ids.add(sample_id)
-                                save_sample(curr_sample)
-
-                                curr_time = time.time()
-                                print('took {:.1f} sec. importing sample: {}'.format(curr_time - prev_time, sample_id))
-                                prev_time = curr_time
-
-                                chr_dict = dict()
-                                for chr in platform_chrs:
-                                    curr_snp_count = snp_count_per_chr[chr]
-                                    chr_dict[chr] = {
-                                        'xs': [float('nan')] * curr_snp_count,
-                                        'ys': [float('nan')] * curr_snp_count,
-                                        'allele1_fwds': ['-'] * curr_snp_count,
-                                        'allele2_fwds': ['-'] * curr_snp_count,
-                                    }
-
-                                curr_sample = {
-                                    'sample_id': sample_id,
-                                    'platform_id': platform_id,
-                                    'chromosome_data': chr_dict,
-                                    'tags': sample_tags,
-                                    'unannotated_snps': [],
-                                }
-
-                            try:
-                                snp_chr_index = snp_chr_indexes[snp_name]
-                            except KeyError:
-                                snp_chr_index = None
-                            if snp_chr_index is not None:
-                                snp_chr = snp_chr_index['chromosome']
-                                snp_index = snp_chr_index['index']
-
-                                curr_sample_chr = curr_sample['chromosome_data'][snp_chr]
-                                curr_sample_chr['xs'][snp_index] = x
-                                curr_sample_chr['ys'][snp_index] = y
-                                curr_sample_chr['allele1_fwds'][snp_index] = allele1_fwd
-                                curr_sample_chr['allele2_fwds'][snp_index] = allele2_fwd
-                            else:
-                                curr_sample['unannotated_snps'].append({
-                                    'snp_name': snp_name,
-                                    'x': x,
-                                    'y': y,
-                                    'allele1_fwd': allele1_fwd,
-                                    'allele2_fwd': allele2_fwd,
-                                })
-
-        save_sample(curr_sample)
+                elif curr_section == data_tag:
+                    # this is the header. we'll just make note of the indices
+                    data_header_indexes = {
+                        col_hdr: i
+                        for i, col_hdr in enumerate(row)
+                        if col_hdr in data_col_hdrs
+                    }
+
+                    # confirm that all are represented
+                    for col_hdr in data_col_hdrs:
+                        if col_hdr not in data_header_indexes:
+                            _fmt_err(
+                                final_report_file,
+                                offset - len(line),
+                                'failed to find required header "{}" in data header'.format(col_hdr))
+
+                    return data_header_indexes, offset
+
+    return None, None
+
+
+def _sample_chunks(final_report_file, data_start, sample_id_index, chunk_count):
+    """
+    Split the data section of the final report into byte ranges that start and end on sample
+    boundaries. Since the report is grouped by sample each range can be parsed independently.
+    :return: a list of (start, end) byte offsets
+    """
+    file_size = os.path.getsize(final_report_file)
+    offsets = [data_start]
+    with open(final_report_file, 'rb') as final_report_handle:
+        for i in range(1, chunk_count):
+            approx_offset = data_start + (file_size - data_start) * i // chunk_count
+            if approx_offset <= offsets[-1]:
+                continue
+
+            # move to the start of the first line at or after the approximate offset
+            final_report_handle.seek(approx_offset - 1)
+            offset = approx_offset - 1 + len(final_report_handle.readline())
+
+            # now scan forward until the sample ID changes
+            boundary = None
+            prev_sample_id = None
+            for line in final_report_handle:
+                row = _parse_row(line.decode())
+                if len(row) > sample_id_index:
+                    sample_id = row[sample_id_index].strip()
+                    if prev_sample_id is not None and sample_id != prev_sample_id:
+                        boundary = offset
+                        break
+                    prev_sample_id = sample_id
+                offset += len(line)
+
+            if boundary is None:
+                # the rest of the file belongs to a single sample
+                break
+            elif boundary > offsets[-1]:
+                offsets.append(boundary)
+
+    offsets.append(file_size)
+
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def _iter_chunk_samples(final_report_file, chunk, data_header_indexes, sample_id_col_hdr, platform_id, snp_index):
+    """
+    parse the samples in the given (start, end) byte range of the final report data section. The
+    samples are yielded in file order with their chromosome data stored as numpy arrays
+    """
+    chunk_start, chunk_end = chunk
+
+    snp_name_idx = data_header_indexes[snp_name_col_hdr]
+    sample_id_idx = data_header_indexes[sample_id_col_hdr]
+    x_idx = data_header_indexes[x_col_hdr]
+    y_idx = data_header_indexes[y_col_hdr]
+    allele1_fwd_idx = data_header_indexes[allele1_fwd_col_hdr]
+    allele2_fwd_idx = data_header_indexes[allele2_fwd_col_hdr]
+
+    # the offset of the line that is currently being parsed (used for error messages)
+    line_offset = chunk_start
+
+    # samples from a report almost always list the same SNPs in the same order so
+    # we only look up SNP rows again when the SNP names change
+    prev_snp_names = None
+    prev_snp_rows = None
+
+    def float_val(str_val):
+        try:
+            return float(str_val)
+        except ValueError as e:
+            if str_val.upper() == 'NA':
+                return float('nan')
+            else:
+                _fmt_err(final_report_file, line_offset, 'failed to convert "' + str_val + '" into a float', e)
+
+    def build_sample(sample_id, snp_names, xs, ys, allele1_fwds, allele2_fwds):
+        nonlocal prev_snp_names, prev_snp_rows
+
+        if snp_names != prev_snp_names:
+            prev_snp_names = snp_names
+            prev_snp_rows = snp_index.lookup_rows(snp_names)
+        snp_rows = prev_snp_rows
+        is_annotated = snp_rows >= 0
+        annotated_rows = snp_rows[is_annotated]
+
+        # fill arrays covering all of the platform's SNPs and then split them up by chromosome
+        total_snp_count = snp_index.total_snp_count
+        all_xs = np.full(total_snp_count, np.nan)
+        all_xs[annotated_rows] = np.array(xs)[is_annotated]
+        all_ys = np.full(total_snp_count, np.nan)
+        all_ys[annotated_rows] = np.array(ys)[is_annotated]
+        allele1_fwd_arr = np.array(allele1_fwds)
+        all_allele1_fwds = np.full(total_snp_count, '-', dtype=allele1_fwd_arr.dtype)
+        all_allele1_fwds[annotated_rows] = allele1_fwd_arr[is_annotated]
+        allele2_fwd_arr = np.array(allele2_fwds)
+        all_allele2_fwds = np.full(total_snp_count, '-', dtype=allele2_fwd_arr.dtype)
+        all_allele2_fwds[annotated_rows] = allele2_fwd_arr[is_annotated]
+
+        chr_dict = dict()
+        for chr, chr_offset, snp_count in zip(snp_index.chromosomes, snp_index.chr_offsets, snp_index.snp_counts):
+            chr_slice = slice(chr_offset, chr_offset + snp_count)
+            chr_dict[chr] = {
+                'xs': all_xs[chr_slice],
+                'ys': all_ys[chr_slice],
+                'allele1_fwds': all_allele1_fwds[chr_slice],
+                'allele2_fwds': all_allele2_fwds[chr_slice],
+            }
+
+        return {
+            'sample_id': sample_id,
+            'platform_id': platform_id,
+            'chromosome_data': chr_dict,
+            'unannotated_snps': [
+                {
+                    'snp_name': snp_names[i],
+                    'x': xs[i],
+                    'y': ys[i],
+                    'allele1_fwd': allele1_fwds[i],
+                    'allele2_fwd': allele2_fwds[i],
+                }
+                for i in np.flatnonzero(~is_annotated)
+            ],
+        }
+
+    def chunk_lines():
+        nonlocal line_offset
+
+        with open(final_report_file, 'rb') as final_report_handle:
+            final_report_handle.seek(chunk_start)
+            next_offset = chunk_start
+            for line in final_report_handle:
+                if next_offset >= chunk_end:
+                    break
+                line_offset = next_offset
+                next_offset += len(line)
+                yield line.decode()
+
+    curr_sample_id = None
+    curr_cols = None
+    for row in csv.reader(chunk_lines(), delimiter='\t'):
+        # just ignore empty lines
+        if row:
+            sample_id = row[sample_id_idx].strip()
+            if sample_id != curr_sample_id:
+                # we hit a new sample so at this point we hand off the current sample and
+                # move on to building a new sample
+                if curr_cols is not None:
+                    yield build_sample(curr_sample_id, *curr_cols)
+
+                curr_sample_id = sample_id
+                curr_cols = [], [], [], [], []
+
+            snp_names, xs, ys, allele1_fwds, allele2_fwds = curr_cols
+            snp_names.append(row[snp_name_idx].strip())
+            xs.append(float_val(row[x_idx].strip()))
+            ys.append(float_val(row[y_idx].strip()))
+            allele1_fwds.append(row[allele1_fwd_idx].strip())
+            allele2_fwds.append(row[allele2_fwd_idx].strip())
+
+    if curr_cols is not None:
+        yield build_sample(curr_sample_id, *curr_cols)
+
+
+# the arguments to _iter_chunk_samples (minus the chunk) for parse worker processes
+_parse_worker_args = None
+
+
+def _init_parse_worker(parse_args):
+    global _parse_worker_args
+    _parse_worker_args = parse_args
+
+
+def _parse_chunk(chunk):
+    final_report_file, *other_args = _parse_worker_args
+    return list(_iter_chunk_samples(final_report_file, chunk, *other_args))
+
+
+def _iter_parallel_samples(chunks, parse_args, workers):
+    """
+    parse the chunks in a pool of worker processes, yielding samples in file order. We only keep
+    a couple of chunks per worker in flight so that memory use stays bounded even if the DB
+    writes are slower than parsing
+    """
+    pool = multiprocessing.Pool(workers, initializer=_init_parse_worker, initargs=(parse_args,))
+    try:
+        chunk_iter = iter(chunks)
+        pending_chunks = deque(
+            pool.apply_async(_parse_chunk, (chunk,))
+            for chunk in islice(chunk_iter, 2 * workers)
+        )
+        while pending_chunks:
+            chunk_samples = pending_chunks.popleft().get()
+            next_chunk = next(chunk_iter, None)
+            if next_chunk is not None:
+                pending_chunks.append(pool.apply_async(_parse_chunk, (next_chunk,)))
+
+            for samp in chunk_samples:
+                yield samp
+
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def import_final_report(user_email, generate_ids, on_duplicate, final_report_file, sample_anno_dicts, platform_id,
+                        sample_tags, db, batch_size=None, workers=None):
+    """
+    Import all of the samples in the given final report. Rows are streamed into preallocated
+    per-sample arrays and finished samples are written to the DB in batches
+    :param user_email: the email of the user doing the import
+    :param generate_ids: if true the report's sample IDs are moved to other_ids and canonical IDs are generated
+    :param on_duplicate: what to do with duplicate canonical IDs: 'halt', 'skip' or 'replace'
+    :param final_report_file: the path to the final report
+    :param sample_anno_dicts: sample annotations keyed by sample ID
+    :param platform_id: the platform of the samples
+    :param sample_tags: the tags to give each sample
+    :param db: the database
+    :param batch_size:
+        the number of samples to write to the DB per bulk write. Defaults to
+        the IMPORT_BATCH_SIZE config value
+    :param workers:
+        the number of processes to use for parsing the report. If this is more than one the report
+        is split at sample boundaries and parsed in parallel while this process post-processes and
+        writes the samples. Defaults to the IMPORT_PARSE_WORKERS config value
+    """
+
+    if batch_size is None:
+        batch_size = HAPLOQA_CONFIG.get('IMPORT_BATCH_SIZE', 10)
+    if workers is None:
+        workers = HAPLOQA_CONFIG.get('IMPORT_PARSE_WORKERS', 1)
+    if workers > 1 and multiprocessing.current_process().daemon:
+        # daemonic processes (eg. celery prefork pool workers) aren't allowed to have children
+        print('parsing final report in a single process since daemonic processes cannot start workers',
+              file=sys.stderr)
+        workers = 1
+
+    sample_batch = []
+
+    def flush_samples():
+        if sample_batch:
+            if generate_ids:
+                # if we're asked to generate IDs we move the sample ID into "other_ids". We
+                # reserve IDs for the whole batch at once
+                for samp, samp_id in zip(sample_batch, mds.gen_unique_ids(len(sample_batch), db)):
+                    samp['other_ids'] = [samp['sample_id']]
+                    samp['sample_id'] = samp_id
+            else:
+                for samp in sample_batch:
+                    samp['other_ids'] = []
+
+            _write_samples(sample_batch, on_duplicate, db)
+            del sample_batch[:]
+
+    def save_sample(samp):
+        try:
+            samp = sai.merge_dicts(samp, sample_anno_dicts[samp['sample_id']])
+        except KeyError:
+            pass
+
+        mds.post_proc_sample(samp, user_email, snp_calls, gemm_anno)
+
+        samp['owner'] = user_email
+
+        sample_batch.append(samp)
+        if len(sample_batch) >= batch_size:
+            flush_samples()
+
+    snp_index = mds.get_platform_snp_index(platform_id, db)
+    snp_calls = mds.get_snp_calls(platform_id, db)
+    gemm_anno = mds.get_gemm_anno(platform_id, db)
+
+    sample_id_col_hdr = _sample_id_col_hdr(platform_id)
+    data_header_indexes, data_start = _read_data_header(final_report_file, sample_id_col_hdr)
+    if data_header_indexes is None:
+        return
+
+    parse_args = final_report_file, data_header_indexes, sample_id_col_hdr, platform_id, snp_index
+    chunks = [(data_start, os.path.getsize(final_report_file))]
+    if workers > 1:
+        chunks = _sample_chunks(
+            final_report_file,
+            data_start,
+            data_header_indexes[sample_id_col_hdr],
+            workers * PARSE_CHUNKS_PER_WORKER)
+
+    if len(chunks) > 1:
+        samples = _iter_parallel_samples(chunks, parse_args, workers)
+    else:
+        samples = _iter_chunk_samples(final_report_file, chunks[0], *parse_args[1:])
+
+    prev_time = time.time()
+    all_sample_ids = set()
+    for samp in samples:
+        # if we've seen this ID before it means that rows are not grouped by sample ID
+        if samp['sample_id'] in all_sample_ids:
+            raise Exception('Final report must be grouped by sample ID but it is not')
+        all_sample_ids.add(samp['sample_id'])
+
+        samp['tags'] = sample_tags
+        save_sample(samp)
+
+        curr_time = time.time()
+        print('took {:.1f} sec. importing sample: {}'.format(curr_time - prev_time, samp['sample_id']))
+        prev_time = curr_time
+
+    flush_samples()
 
 
 def main():
@@ -211,6 +459,18 @@ def main():
              'duplicate canonical ID is encountered during import: halt the import process with an error message, '
              'skip the sample with a warning message or replace the existing sample with a warning',
     )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        help='the number of samples to write to the database per bulk write. By default the '
+             'IMPORT_BATCH_SIZE config value is used',
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        help='the number of processes to use for parsing the final report. By default the '
+             'IMPORT_PARSE_WORKERS config value is used',
+    )
     parser.add_argument(
         'platform',
         help='the platform for the data we are importing. eg: MegaMUGA')
@@ -233,13 +493,16 @@ def main():
 
     report_name = splitext(basename(args.final_report))[0]
     import_final_report(
+        None,
         args.generate_ids,
         args.on_duplicate,
         args.final_report,
         sample_anno_dicts,
         args.platform,
         [report_name, args.platform],
-        mds.init_db())
+        mds.init_db(),
+        args.batch_size,
+        args.workers)
 
 
 if __name__ == '__main__':
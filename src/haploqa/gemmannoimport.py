@@ -42,6 +42,8 @@ def import_gemm_anno(anno_file, platform, db):
                 {'$set': {'engineered_target': target, 'informative_axis': inf_axis}},
             )
 
+    mds.bump_platform_revision(platform, db)
+
 
 def main():
     # parse command line arguments
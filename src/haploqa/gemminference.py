@@ -1,65 +1,233 @@
 from bson.objectid import ObjectId
 import haploqa.mongods as mds
 import numpy as np
-from scipy.stats import multivariate_normal
-from scipy.spatial.distance import mahalanobis
+from scipy.linalg import solve_triangular
+from scipy.special import expit
 
 from pprint import pprint
 
 
-def _get_gemm_snp_intens(gemm_snp, sample):
-    # this is a bit convoluted but all we are doing here is extracting
-    # the intensity for the target SNP at the informative axis
-    snp_chr = gemm_snp['chromosome']
-    intens_key = 'xs' if gemm_snp['informative_axis'] == 'X' else 'ys'
-    intens_index = gemm_snp['within_chr_index']
-    return sample['chromosome_data'][snp_chr][intens_key][intens_index]
+def _get_gemm_snp_intens(sample):
+    # GEMM intensities are stored with each sample as parallel SNP ID and
+    # intensity lists (see mds.sample_gemm_intensities). Here we key them on SNP ID
+    gemm_intens = sample['gemm_intensities']
+    return dict(zip(gemm_intens['snp_ids'], gemm_intens['intensities']))
 
 
-def _calc_pd_and_dist(ctrl_intens, sample_intens):
+def _fit_ctrl_model(ctrl_sample_ids, ctrl_intens):
     """
-    Calculates per-sample probability densities and mahalanobis distances. The
-    densities and distances are with respect to a (multivariate) gaussian
-    distribution fit to the control intensities.
+    Fit a (multivariate) gaussian to the given control intensities. The model is
+    stored as the mean and the lower Cholesky factor of the covariance so that it
+    can be persisted and used for scoring without refitting.
+    :param ctrl_sample_ids:
+            the (sorted) object IDs of the target's control samples. This is the
+            membership that cached models are validated against so it may include
+            controls that were left out of the fit
     :param ctrl_intens:
             the control intensities that we fit a gaussian to. This is a 2D
             matrix where columns correspond to samples, rows correspond to
             control probes and values are the control intensities
+    :return:
+            the control model dict
+    """
+    ctrl_cov = np.atleast_2d(np.cov(ctrl_intens))
+    ctrl_mean = np.mean(ctrl_intens, axis=1)
+
+    return {
+        'control_sample_ids': ctrl_sample_ids,
+        'count': ctrl_intens.shape[1],
+        'mean': ctrl_mean.tolist(),
+        'cholesky': np.linalg.cholesky(ctrl_cov).tolist(),
+    }
+
+
+def calc_log_pd_and_dist(ctrl_model, sample_intens):
+    """
+    Calculates per-sample log probability densities and mahalanobis distances in
+    a single pass. The densities and distances are with respect to a (multivariate)
+    gaussian control model (see _fit_ctrl_model). Both fall out of one triangular
+    solve against the model's Cholesky factor so thousands of samples can be
+    scored in one call.
+    :param ctrl_model:
+            the control model
     :param sample_intens:
             the samples for which we are calculating densities and distances.
             Rows correspond to samples and columns correspond to probes
     :return:
-            a tuple of vectors composed of (prob_densities, dists) where
+            a tuple of vectors composed of (log_prob_densities, dists) where
             vector index corresponds to sample
     """
+    ctrl_mean = np.asarray(ctrl_model['mean'], dtype=np.float64)
+    ctrl_chol = np.asarray(ctrl_model['cholesky'], dtype=np.float64)
+    sample_intens = np.asarray(sample_intens, dtype=np.float64).reshape(-1, ctrl_mean.size)
 
-    # Note: there's probably a more efficient way to calculate the density and distance together
-    #       without using the library functions but I'm not sure it's worth bothering with
+    # solving L z = (x - mean) gives ||z|| as the mahalanobis distance
+    z = solve_triangular(ctrl_chol, np.transpose(sample_intens - ctrl_mean), lower=True, check_finite=False)
+    sq_dists = np.einsum('ij,ij->j', z, z)
+    log_norm_const = 0.5 * ctrl_mean.size * np.log(2.0 * np.pi) + np.sum(np.log(np.diag(ctrl_chol)))
+    log_prob_densities = -0.5 * sq_dists - log_norm_const
 
-    ctrl_cov = np.cov(ctrl_intens)
-    ctrl_mean = np.mean(ctrl_intens, axis=1)
-    prob_densities = multivariate_normal.pdf(sample_intens, ctrl_mean, ctrl_cov)
+    return log_prob_densities, np.sqrt(sq_dists)
+
+
+def pos_mixture_probs(ctrl_model, sample_intens, max_mahalanobis_dist=2):
+    """
+    Calculates per-sample probabilities that a sample came from the positive
+    (ie GEMM present) mixture component of a target's control model. If a
+    sample is more than max_mahalanobis_dist units from the nearest mixture
+    component its probability is NaN
+    :param ctrl_model:
+            the target's control model as returned by get_gemm_ctrl_models
+    :param sample_intens:
+            the sample intensities where rows correspond to samples and columns
+            correspond to the model's 'snp_ids'
+    :param max_mahalanobis_dist:
+            the distance cutoff
+    :return:
+            the probability vector where vector index corresponds to sample
+    """
+    pos_log_densities, pos_mah_dists = calc_log_pd_and_dist(ctrl_model['pos'], sample_intens)
+    neg_log_densities, neg_mah_dists = calc_log_pd_and_dist(ctrl_model['neg'], sample_intens)
+
+    # pos / (pos + neg) calculated in log space so that it doesn't underflow
+    probs = expit(pos_log_densities - neg_log_densities)
+    min_mah_dists = np.minimum(neg_mah_dists, pos_mah_dists)
+    probs[np.logical_not(min_mah_dists <= max_mahalanobis_dist)] = np.nan
+
+    return probs
+
+
+def get_gemm_ctrl_models(platform_ids, min_pos_neg_count=4, db=None):
+    """
+    Get the positive and negative control models of every engineered target on
+    the given platforms. Models are persisted in the gemm_control_models collection
+    and only refit when the platform's GEMM annotations are re-imported (which
+    changes the platform revision) or when the set of samples marked as positive
+    or negative controls for the target changes.
+    :param platform_ids:
+            the platforms to get models for
+    :param min_pos_neg_count:
+            targets with fewer positive or negative controls than this are left out
+    :param db:
+    :return:
+            a dict keyed on (platform_id, engineered_target) tuples. Each model dict has
+            the 'snp_ids' of the target's probes along with the 'pos' and 'neg' control models
+    """
 
-    # for some reason the densities become scalar if there is only a single sample. Here
-    # we cast them back as numpy arrays of size one
-    if not isinstance(prob_densities, np.ndarray):
-        prob_densities = np.array([prob_densities])
+    if db is None:
+        db = mds.get_db()
 
-    # calculate distance
-    inv_ctrl_cov = np.linalg.inv(ctrl_cov)
-    dists = np.array([
-        mahalanobis(sample_row, ctrl_mean, inv_ctrl_cov)
-        for sample_row
-        in list(sample_intens)
-    ])
+    platform_ids = list(set(platform_ids))
+    gemm_annos = {platform_id: mds.get_gemm_anno(platform_id, db) for platform_id in platform_ids}
 
-    return prob_densities, dists
+    # organize GEMM snps by target. We only need the IDs here
+    tgt_snp_ids = dict()
+    gemm_snps = db.snps.find(
+        {'platform_id': {'$in': platform_ids}, 'engineered_target': {'$exists': True}},
+        {'_id': 0, 'platform_id': 1, 'engineered_target': 1, 'snp_id': 1},
+    )
+    for snp in gemm_snps:
+        tgt_snp_ids.setdefault((snp['platform_id'], snp['engineered_target']), []).append(snp['snp_id'])
+
+    # one small query gives us the current pos/neg control memberships for all targets
+    tgt_ctrl_ids = {tgt_key: ([], []) for tgt_key in tgt_snp_ids}
+    ctrl_samples = db.samples.find(
+        {
+            'platform_id': {'$in': platform_ids},
+            '$or': [
+                {'pos_ctrl_eng_tgts': {'$exists': True, '$ne': []}},
+                {'neg_ctrl_eng_tgts': {'$exists': True, '$ne': []}},
+            ],
+        },
+        {'platform_id': 1, 'pos_ctrl_eng_tgts': 1, 'neg_ctrl_eng_tgts': 1},
+    )
+    for sample in ctrl_samples:
+        for i, tgts_key in enumerate(('pos_ctrl_eng_tgts', 'neg_ctrl_eng_tgts')):
+            for tgt in set(sample.get(tgts_key, [])):
+                tgt_key = sample['platform_id'], tgt
+                if tgt_key in tgt_ctrl_ids:
+                    tgt_ctrl_ids[tgt_key][i].append(sample['_id'])
+
+    ctrl_models = dict()
+    stale_tgt_keys = []
+    cached_models = db.gemm_control_models.find({'platform_id': {'$in': platform_ids}})
+    cached_models = {(x['platform_id'], x['engineered_target']): x for x in cached_models}
+    for tgt_key, (pos_ids, neg_ids) in tgt_ctrl_ids.items():
+        pos_ids.sort()
+        neg_ids.sort()
+        if min(len(pos_ids), len(neg_ids)) < max(min_pos_neg_count, 2):
+            continue
+
+        snp_ids = sorted(tgt_snp_ids[tgt_key])
+        cached_model = cached_models.get(tgt_key)
+        if cached_model is not None \
+                and cached_model['platform_revision'] == gemm_annos[tgt_key[0]]['revision'] \
+                and cached_model['snp_ids'] == snp_ids \
+                and cached_model['pos']['control_sample_ids'] == pos_ids \
+                and cached_model['neg']['control_sample_ids'] == neg_ids:
+            ctrl_models[tgt_key] = cached_model
+        else:
+            stale_tgt_keys.append(tgt_key)
+
+    if stale_tgt_keys:
+        # we need the GEMM intensities of all controls used by stale models in order to refit them
+        stale_ctrl_ids = set()
+        for tgt_key in stale_tgt_keys:
+            pos_ids, neg_ids = tgt_ctrl_ids[tgt_key]
+            stale_ctrl_ids.update(pos_ids)
+            stale_ctrl_ids.update(neg_ids)
+        stale_ctrl_samples = list(db.samples.find(
+            {'_id': {'$in': list(stale_ctrl_ids)}},
+            {'platform_id': 1, 'gemm_intensities': 1},
+        ))
+        mds.load_gemm_intensities(stale_ctrl_samples, db, gemm_annos)
+        ctrl_intens_by_id = {x['_id']: _get_gemm_snp_intens(x) for x in stale_ctrl_samples}
+
+        for tgt_key in stale_tgt_keys:
+            platform_id, tgt = tgt_key
+            snp_ids = sorted(tgt_snp_ids[tgt_key])
+            pos_ids, neg_ids = tgt_ctrl_ids[tgt_key]
+
+            def ctrl_intens(ctrl_ids):
+                return np.array([
+                    [ctrl_intens_by_id[ctrl_id].get(snp_id, np.nan) for ctrl_id in ctrl_ids]
+                    for snp_id in snp_ids
+                ])
+
+            # controls missing any of the target's intensities would make the fit NaN so
+            # they're dropped, which means we have to check the minimum count again
+            pos_intens = ctrl_intens(pos_ids)
+            neg_intens = ctrl_intens(neg_ids)
+            pos_intens = pos_intens[:, np.all(np.isfinite(pos_intens), axis=0)]
+            neg_intens = neg_intens[:, np.all(np.isfinite(neg_intens), axis=0)]
+            if min(pos_intens.shape[1], neg_intens.shape[1]) < max(min_pos_neg_count, 2):
+                db.gemm_control_models.delete_one({'platform_id': platform_id, 'engineered_target': tgt})
+                continue
+
+            ctrl_model = {
+                'platform_id': platform_id,
+                'engineered_target': tgt,
+                'platform_revision': gemm_annos[platform_id]['revision'],
+                'snp_ids': snp_ids,
+                'pos': _fit_ctrl_model(pos_ids, pos_intens),
+                'neg': _fit_ctrl_model(neg_ids, neg_intens),
+            }
+            db.gemm_control_models.replace_one(
+                {'platform_id': platform_id, 'engineered_target': tgt},
+                ctrl_model,
+                upsert=True,
+            )
+            ctrl_models[tgt_key] = ctrl_model
+
+    return ctrl_models
 
 
 def get_gemm_intens(sample_obj_ids, min_pos_neg_count=4, db=None):
     """
     Extract GEMM intensities from the database. This extracts both the control
-    intensities along with intensities for the given sample_obj_ids
+    intensities along with intensities for the given sample_obj_ids. Only the
+    GEMM SNPs of the given samples' platforms are used and controls are only
+    taken from samples on the same platform as the SNP
     :param sample_obj_ids:
     :param min_pos_neg_count:
     :param db:
@@ -69,8 +237,19 @@ def get_gemm_intens(sample_obj_ids, min_pos_neg_count=4, db=None):
     if db is None:
         db = mds.get_db()
 
+    # we only ever need the per-sample GEMM intensities rather than the full chromosome data
+    sample_projection = {'sample_id': 1, 'platform_id': 1, 'gemm_intensities': 1}
+    test_samples_by_id = {
+        sample['_id']: sample
+        for sample in db.samples.find({'_id': {'$in': list(sample_obj_ids)}}, sample_projection)
+    }
+    test_samples = [test_samples_by_id[sample_obj_id] for sample_obj_id in sample_obj_ids]
+
     # organize GEMM snps by target
-    gemm_snps = list(db.snps.find({'engineered_target': {'$exists': True}}))
+    gemm_snp_query = {'engineered_target': {'$exists': True}}
+    if test_samples:
+        gemm_snp_query['platform_id'] = {'$in': list(set(sample['platform_id'] for sample in test_samples))}
+    gemm_snps = list(db.snps.find(gemm_snp_query))
     gemm_snp_dict = {snp['engineered_target']: [] for snp in gemm_snps}
     for snp in gemm_snps:
         snp['pos_ctrls'] = []
@@ -78,41 +257,51 @@ def get_gemm_intens(sample_obj_ids, min_pos_neg_count=4, db=None):
         snp['non_ctrls'] = []
         gemm_snp_dict[snp['engineered_target']].append(snp)
 
-    # find all pos/neg samples and collect their probe intensities for all of the engineered targets
-    # TODO this approach is much more expensive than it should be (we're loading
-    # all SNP data for the samples even though we only care about a small subset
-    # of SNPs) but I'm just going to go with this for now.
-    for sample in db.samples.find({'pos_ctrl_eng_tgts': {'$exists': True, '$ne': []}}):
+    gemm_platform_ids = list(set(snp['platform_id'] for snp in gemm_snps))
+    pos_ctrl_samples = list(db.samples.find(
+        {'pos_ctrl_eng_tgts': {'$exists': True, '$ne': []}, 'platform_id': {'$in': gemm_platform_ids}},
+        dict(sample_projection, pos_ctrl_eng_tgts=1),
+    ))
+    neg_ctrl_samples = list(db.samples.find(
+        {'neg_ctrl_eng_tgts': {'$exists': True, '$ne': []}, 'platform_id': {'$in': gemm_platform_ids}},
+        dict(sample_projection, neg_ctrl_eng_tgts=1),
+    ))
+
+    # samples imported before GEMM intensities were stored (or before the GEMM
+    # annotations last changed) get their intensities filled in here
+    gemm_annos = dict()
+    for samples in (pos_ctrl_samples, neg_ctrl_samples, test_samples):
+        mds.load_gemm_intensities(samples, db, gemm_annos)
+
+    def ctrl_intens(snp, sample, sample_intens):
+        return {
+            'sample_obj_id': sample['_id'],
+            'sample_id': sample['sample_id'],
+            'probe_intensity': sample_intens.get(snp['snp_id'], float('nan')),
+        }
+
+    # collect probe intensities of all pos samples for all of the engineered targets
+    for sample in pos_ctrl_samples:
+        sample_intens = _get_gemm_snp_intens(sample)
         for pos_tgt in set(sample['pos_ctrl_eng_tgts']):
             for snp in gemm_snp_dict.get(pos_tgt, []):
-                intens_val = _get_gemm_snp_intens(snp, sample)
-                snp['pos_ctrls'].append({
-                    'sample_obj_id': sample['_id'],
-                    'sample_id': sample['sample_id'],
-                    'probe_intensity': intens_val
-                })
+                if snp['platform_id'] == sample['platform_id']:
+                    snp['pos_ctrls'].append(ctrl_intens(snp, sample, sample_intens))
 
     # and now the same for the negative samples
-    for sample in db.samples.find({'neg_ctrl_eng_tgts': {'$exists': True, '$ne': []}}):
+    for sample in neg_ctrl_samples:
+        sample_intens = _get_gemm_snp_intens(sample)
         for neg_tgt in set(sample['neg_ctrl_eng_tgts']):
             for snp in gemm_snp_dict.get(neg_tgt, []):
-                intens_val = _get_gemm_snp_intens(snp, sample)
-                snp['neg_ctrls'].append({
-                    'sample_obj_id': sample['_id'],
-                    'sample_id': sample['sample_id'],
-                    'probe_intensity': intens_val
-                })
+                if snp['platform_id'] == sample['platform_id']:
+                    snp['neg_ctrls'].append(ctrl_intens(snp, sample, sample_intens))
 
     # and now the same for test samples
-    for sample_obj_id in sample_obj_ids:
-        sample = db.samples.find_one({'_id': sample_obj_id})
+    for sample in test_samples:
+        sample_intens = _get_gemm_snp_intens(sample)
         for snp in gemm_snps:
-            intens_val = _get_gemm_snp_intens(snp, sample)
-            snp['non_ctrls'].append({
-                'sample_obj_id': sample['_id'],
-                'sample_id': sample['sample_id'],
-                'probe_intensity': intens_val
-            })
+            if snp['platform_id'] == sample['platform_id']:
+                snp['non_ctrls'].append(ctrl_intens(snp, sample, sample_intens))
 
     # here we remove any targets that don't meet the minimum count threshold
     for tgt in list(gemm_snp_dict.keys()):
@@ -130,43 +319,39 @@ def get_gemm_intens(sample_obj_ids, min_pos_neg_count=4, db=None):
 
 
 def est_gemm_probs(sample_obj_ids, min_pos_neg_count=4, max_mahalanobis_dist=2, db=None):
-    gemm_snp_dict = get_gemm_intens(sample_obj_ids, min_pos_neg_count, db)
+    if db is None:
+        db = mds.get_db()
 
-    # now we fit a multivariate normal to each GEMM target (where # dimensions == # probes)
+    samples_by_id = {
+        sample['_id']: sample
+        for sample in db.samples.find(
+            {'_id': {'$in': list(sample_obj_ids)}},
+            {'platform_id': 1, 'gemm_intensities': 1})
+    }
+    samples = [samples_by_id[sample_obj_id] for sample_obj_id in sample_obj_ids]
+    mds.load_gemm_intensities(samples, db)
+    samples_intens = [_get_gemm_snp_intens(sample) for sample in samples]
+    sample_platform_ids = np.array([sample['platform_id'] for sample in samples], dtype=object)
+
+    # each engineered target has a multivariate normal control model per platform (where # dimensions == # probes)
+    ctrl_models = get_gemm_ctrl_models(set(sample_platform_ids), min_pos_neg_count, db)
     mixture_probs = dict()
-    for gemm_eng_tgt, gemm_snps in gemm_snp_dict.items():
-
+    for (platform_id, gemm_eng_tgt), ctrl_model in ctrl_models.items():
+        pos_mixture_component_probs = mixture_probs.setdefault(gemm_eng_tgt, np.full(len(samples), np.nan))
+        is_platform_sample = sample_platform_ids == platform_id
         sample_intens = np.array([
-            [x['probe_intensity'] for x in gemm_snp['non_ctrls']]
-            for gemm_snp in gemm_snps
+            [sample_intens.get(snp_id, np.nan) for snp_id in ctrl_model['snp_ids']]
+            for sample_intens, is_platform in zip(samples_intens, is_platform_sample)
+            if is_platform
         ])
-        sample_intens = np.transpose(sample_intens)
-
-        pos_ctrls = np.array([
-            [x['probe_intensity'] for x in gemm_snp['pos_ctrls']]
-            for gemm_snp in gemm_snps
-        ])
-        pos_pdf_densities, neg_mah_dists = _calc_pd_and_dist(pos_ctrls, sample_intens)
-
-        neg_ctrls = np.array([
-            [x['probe_intensity'] for x in gemm_snp['neg_ctrls']]
-            for gemm_snp in gemm_snps
-        ])
-        neg_pdf_densities, pos_mah_dists = _calc_pd_and_dist(neg_ctrls, sample_intens)
-
-        # calculate a vector of per-sample probabilities that a sample came from
-        # the positive (ie GEMM present) mixture component. Then, if a sample is
-        # more than maximum_mahalanobis_dist units from the nearest mixture component
-        # we set its probability to NaN
-        sum_densities = pos_pdf_densities + neg_pdf_densities
-        pos_mixture_component_probs = pos_pdf_densities / sum_densities
-        pos_mixture_component_probs[np.logical_not(np.isfinite(pos_mixture_component_probs))] = np.nan
-        min_mah_dists = np.minimum(neg_mah_dists, pos_mah_dists)
-        pos_mixture_component_probs[min_mah_dists > max_mahalanobis_dist] = np.nan
 
-        mixture_probs[gemm_eng_tgt] = [float(x) for x in pos_mixture_component_probs]
+        pos_mixture_component_probs[is_platform_sample] = pos_mixture_probs(
+            ctrl_model, sample_intens, max_mahalanobis_dist)
 
-    return mixture_probs
+    return {
+        gemm_eng_tgt: [float(x) for x in pos_mixture_component_probs]
+        for gemm_eng_tgt, pos_mixture_component_probs in mixture_probs.items()
+    }
 
 
 def main():
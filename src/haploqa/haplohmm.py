@@ -105,52 +105,105 @@ def _scale_matrix_rows_to_one(m):
     m /= row_sums
 
 
+def pack_ab_codes(ab_codes):
+    """
+    Pack a vector of AB codes into bytes using two bits per code (four codes per byte)
+    :param ab_codes: the AB code vector. All codes must be in the range [0, 3]
+    :return: the packed bytes
+    """
+    ab_codes = np.asarray(ab_codes, dtype=np.uint8)
+    padded_codes = np.zeros(4 * ((ab_codes.size + 3) // 4), dtype=np.uint8)
+    padded_codes[:ab_codes.size] = ab_codes
+    padded_codes = padded_codes.reshape((-1, 4))
+
+    packed_codes = padded_codes[:, 0] | (padded_codes[:, 1] << 2) | (padded_codes[:, 2] << 4) | (padded_codes[:, 3] << 6)
+    return packed_codes.tobytes()
+
+
+def unpack_ab_codes(packed_ab_codes, snp_count):
+    """
+    The inverse of pack_ab_codes
+    :param packed_ab_codes: the packed bytes
+    :param snp_count: the number of AB codes that were packed
+    :return: the AB code vector as a uint8 numpy array
+    """
+    packed_codes = np.frombuffer(packed_ab_codes, dtype=np.uint8)
+    ab_codes = (packed_codes[:, np.newaxis] >> np.array([0, 2, 4, 6], dtype=np.uint8)) & 3
+
+    return ab_codes.reshape(-1)[:snp_count]
+
+
+def chr_data_to_ab_codes(chr_data, x_calls, y_calls):
+    """
+    Converts the "GACT-" calls for a single sample chromosome into AB codes. Any calls that
+    don't match the SNP's probe calls will be assigned a code of 255
+    :param chr_data: the chromosome data dict from a sample (ie sample['chromosome_data'][chromosome])
+    :param x_calls: numpy array of x probe calls for the chromosome
+    :param y_calls: numpy array of y probe calls for the chromosome
+    :return: the AB codes as a uint8 numpy array
+    """
+    ab_codes = np.empty(len(x_calls), dtype=np.uint8)
+    ab_codes.fill(255)
+
+    if 'ab_codes' in chr_data:
+        # these codes have already been converted
+        if isinstance(chr_data['ab_codes'], bytes):
+            ab_codes[:] = unpack_ab_codes(chr_data['ab_codes'], chr_data['snp_count'])
+        else:
+            ab_codes[:] = chr_data['ab_codes']
+    elif 'allele1_fwds' in chr_data:
+        allele1_fwds = np.array(chr_data['allele1_fwds'])
+        allele2_fwds = np.array(chr_data['allele2_fwds'])
+
+        # here we convert nucleotides (GACT and '-' for no call) into AB codes
+        allele1_is_a = allele1_fwds == x_calls
+        allele2_is_a = allele2_fwds == x_calls
+        allele1_is_b = allele1_fwds == y_calls
+        allele2_is_b = allele2_fwds == y_calls
+        alleles_are_het = np.logical_or(
+            np.logical_and(allele1_is_a, allele2_is_b),
+            np.logical_and(allele1_is_b, allele2_is_a))
+        ab_codes[np.logical_and(allele1_is_a, allele2_is_a)] = A_CODE
+        ab_codes[np.logical_and(allele1_is_b, allele2_is_b)] = B_CODE
+        ab_codes[alleles_are_het] = H_CODE
+        ab_codes[np.logical_or(allele1_fwds == '-', allele2_fwds == '-')] = N_CODE
+    elif 'snps' in chr_data:
+        sample_snps = np.array(chr_data['snps'])
+
+        ab_codes[sample_snps == x_calls] = A_CODE
+        ab_codes[sample_snps == y_calls] = B_CODE
+        ab_codes[sample_snps == 'H'] = H_CODE
+        ab_codes[sample_snps == '-'] = N_CODE
+    else:
+        raise Exception('chromosome data does not have ab_codes, allele1_fwds or snps attributes')
+
+    return ab_codes
+
+
 def samples_to_ab_codes(samples, chromosome, snps):
     """
     Converts the "GACT-" calls into "ABHN" which is a more natural representation for the HMM to work with
     :param samples: the samples from mongo DB whose SNP calls we're going to extract and convert
     :param chromosome: the chromosome to convert
-    :param snps: the SNP annotation dicts from mongo DB
+    :param snps: the SNP annotation dicts from mongo DB or a SNP table (see mongods.get_snp_table)
     :return: the AB codes organized in as an NP array
     """
-    snp_count = 0
-    x_calls = []
-    y_calls = []
-    for snp in snps:
-        snp_count += 1
-        x_calls.append(snp['x_probe_call'])
-        y_calls.append(snp['y_probe_call'])
-    x_calls = np.array(x_calls)
-    y_calls = np.array(y_calls)
+    if isinstance(snps, np.ndarray):
+        x_calls = snps['x_probe_call']
+        y_calls = snps['y_probe_call']
+    else:
+        x_calls = np.array([snp['x_probe_call'] for snp in snps])
+        y_calls = np.array([snp['y_probe_call'] for snp in snps])
+    snp_count = len(x_calls)
     ab_codes = np.empty((snp_count, len(samples)), dtype=np.uint8)
-    ab_codes.fill(255)
 
     for i, curr_sample in enumerate(samples):
-        if 'allele1_fwds' in curr_sample['chromosome_data'][chromosome]:
-            allele1_fwds = np.array(curr_sample['chromosome_data'][chromosome]['allele1_fwds'])
-            allele2_fwds = np.array(curr_sample['chromosome_data'][chromosome]['allele2_fwds'])
-
-            # here we convert nucleotides (GACT and '-' for no call) into AB codes
-            allele1_is_a = allele1_fwds == x_calls
-            allele2_is_a = allele2_fwds == x_calls
-            allele1_is_b = allele1_fwds == y_calls
-            allele2_is_b = allele2_fwds == y_calls
-            alleles_are_het = np.logical_or(
-                np.logical_and(allele1_is_a, allele2_is_b),
-                np.logical_and(allele1_is_b, allele2_is_a))
-            ab_codes[np.logical_and(allele1_is_a, allele2_is_a), i] = A_CODE
-            ab_codes[np.logical_and(allele2_is_b, allele2_is_b), i] = B_CODE
-            ab_codes[alleles_are_het, i] = H_CODE
-            ab_codes[np.logical_or(allele1_fwds == '-', allele2_fwds == '-'), i] = N_CODE
-        elif 'snps' in curr_sample['chromosome_data'][chromosome]:
-            sample_snps = np.array(curr_sample['chromosome_data'][chromosome]['snps'])
-
-            ab_codes[sample_snps == x_calls, i] = A_CODE
-            ab_codes[sample_snps == y_calls, i] = B_CODE
-            ab_codes[sample_snps == 'H', i] = H_CODE
-            ab_codes[sample_snps == '-', i] = N_CODE
-        else:
-            raise Exception('sample does not have allele1_fwds or snps attributes for chromosome {}'.format(chromosome))
+        try:
+            ab_codes[:, i] = chr_data_to_ab_codes(curr_sample['chromosome_data'][chromosome], x_calls, y_calls)
+        except Exception as e:
+            raise Exception('failed to get AB codes for sample {}, chr: {}'.format(
+                curr_sample['sample_id'],
+                chromosome)) from e
 
         bad_codes = ab_codes[:, i] == 255
         num_bad_codes = np.count_nonzero(bad_codes)
@@ -285,65 +338,141 @@ class SnpHaploHMM:
               haplotype indices
             * log_likelihood is the log likelihood of this hidden state sequence
         """
+        max_likelihood_states, log_likelihoods = self.viterbi_batch(
+            haplotype_ab_codes,
+            observation_ab_codes[:, np.newaxis])
+
+        return max_likelihood_states[0], log_likelihoods[0]
+
+    def viterbi_haplotype_indices(self, haplotype_ab_codes, observation_ab_codes):
+        """
+        The same as viterbi(...) except that the most likely state sequence is returned as a
+        (# SNPs, 2) integer matrix holding the pair of haplotype indices for each SNP rather
+        than as a list of tuples. This is the more convenient form for vectorized post-processing.
+
+        :param haplotype_ab_codes: see viterbi(...)
+        :param observation_ab_codes: see viterbi(...)
+        :return: the tuple (max_likelihood_haplotypes, log_likelihood)
+        """
+        max_likelihood_haplotypes, log_likelihoods = self._viterbi_batch_haplotype_indices(
+            haplotype_ab_codes,
+            observation_ab_codes[:, np.newaxis])
+
+        return max_likelihood_haplotypes[:, 0, :], log_likelihoods[0]
+
+    def viterbi_batch(self, haplotype_ab_codes, observation_ab_codes):
+        """
+        Run the viterbi algorithm for a batch of samples that all share the same haplotypes. This
+        gives the same results as calling viterbi(...) once per sample but the per-SNP work is done
+        with 2D array operations across all of the samples in the batch and emission lookups for the
+        haplotype panel are only calculated once.
+
+        Note that the traceback lattice needs (# SNPs x # samples x # states) 16 bit integers so
+        callers with very large batches should split them into smaller batches.
+
+        :param haplotype_ab_codes:
+            a 2D matrix where row_index == snp_index and col_index == haplotype_index.
+            The numerical genotype codes used should be: 0->N, 1->A, 2->B, 3->H
+        :param observation_ab_codes:
+            a 2D matrix where row_index == snp_index and col_index == sample_index. The row count
+            should match the row count of haplotype_ab_codes.
+            The numerical genotype codes used should be: 0->N, 1->A, 2->B, 3->H
+        :return:
+            the tuple (max_likelihood_states, log_likelihoods) where,
+
+            * max_likelihood_states is a list with one element per sample. Each element is the
+              most likely state sequence for that sample in the same form that viterbi(...) returns
+            * log_likelihoods is a vector of the per-sample log likelihoods of these state sequences
+        """
+        max_likelihood_haplotypes, max_final_likelihoods = self._viterbi_batch_haplotype_indices(
+            haplotype_ab_codes,
+            observation_ab_codes)
+
+        max_likelihood_states = [
+            [tuple(state) for state in max_likelihood_haplotypes[:, i, :].tolist()]
+            for i in range(max_likelihood_haplotypes.shape[1])
+        ]
+        return max_likelihood_states, max_final_likelihoods
+
+    def _viterbi_batch_haplotype_indices(self, haplotype_ab_codes, observation_ab_codes):
+        """
+        The viterbi implementation behind viterbi_batch(...). The most likely state sequences are
+        returned as a (# SNPs, # samples, 2) matrix of haplotype index pairs
+        """
         obs_count, haplotype_count = haplotype_ab_codes.shape
+        sample_count = observation_ab_codes.shape[1]
 
         state_hap1_indices, state_hap2_indices = np.triu_indices(haplotype_count)
         state_count = state_hap1_indices.size
+        all_states = np.arange(state_count)
+        all_samples = np.arange(sample_count)
 
-        # initialize transition probabilities
-        log_transition_to_new_state_prob = 0
+        # initialize transition probabilities. The transition matrix only holds two distinct
+        # values (staying in the same state vs. switching to any other state) so rather than
+        # building the full state_count x state_count matrix we just keep the two log probs
+        log_transition_to_new_state_prob = -np.inf
         if state_count > 1:
             log_transition_to_new_state_prob = np.log(self.trans_prob / (state_count - 1))
 
         log_transition_to_same_state_prob = np.log(1.0 - self.trans_prob)
-        log_trans_probs = np.empty((state_count, state_count), dtype=np.float64)
-        log_trans_probs[:] = log_transition_to_new_state_prob
-        np.fill_diagonal(log_trans_probs, log_transition_to_same_state_prob)
 
         # set uniform initial probs
         log_init_prob = np.log(1.0 / state_count)
+
         log_obs_prob_matrix = np.log(self.obs_prob_matrix)
 
+        def log_state_obs_probs(t):
+            # the (# samples, # states) emission log probabilities at SNP t
+            return log_obs_prob_matrix[
+                haplotype_ab_codes[t, state_hap1_indices],
+                haplotype_ab_codes[t, state_hap2_indices],
+                observation_ab_codes[t, :, np.newaxis]]
+
         # initialize viterbi using first observations and the init_probs
-        curr_log_obs_probs = log_obs_prob_matrix[
-            haplotype_ab_codes[0, state_hap1_indices],
-            haplotype_ab_codes[0, state_hap2_indices],
-            observation_ab_codes[0]]
-        curr_log_likelihoods = log_init_prob + curr_log_obs_probs
+        curr_log_likelihoods = log_init_prob + log_state_obs_probs(0)
 
         # step forward in time updating the "from" state likelihoods for each
-        # "to" state at each step
-        from_state_lattice = np.zeros((obs_count - 1, state_count), dtype=np.uint16)
+        # "to" state at each step. For any to_state the best from_state is either
+        # to_state itself (a stay transition) or the best scoring state other than
+        # to_state (a switch transition) so we only need the top two states from the
+        # previous step to do this for all states at once
+        from_state_lattice = np.zeros((obs_count - 1, sample_count, state_count), dtype=np.uint16)
         for t in range(1, obs_count):
             prev_log_likelihoods = curr_log_likelihoods
-            curr_log_likelihoods = np.zeros(state_count, dtype=np.float64)
-
-            for to_state in range(state_count):
-                # TODO is log_trans_probs[:, to_state] right??
-                from_log_likelihoods = prev_log_likelihoods + log_trans_probs[:, to_state]
-                max_from_state = np.argmax(from_log_likelihoods)
-                from_state_lattice[t - 1, to_state] = max_from_state
-                curr_log_likelihoods[to_state] = from_log_likelihoods[max_from_state]
 
-            curr_log_obs_probs = log_obs_prob_matrix[
-                haplotype_ab_codes[t, state_hap1_indices],
-                haplotype_ab_codes[t, state_hap2_indices],
-                observation_ab_codes[t]]
-            curr_log_likelihoods += curr_log_obs_probs
-
-        # backtrace through the most likely path starting with the final state
-        max_final_state = np.argmax(curr_log_likelihoods)
-        max_final_likelihood = curr_log_likelihoods[max_final_state]
-        max_likelihood_states = np.zeros(obs_count, dtype=np.uint16)
-        max_likelihood_states[obs_count - 1] = max_final_state
+            best_states = np.argmax(prev_log_likelihoods, axis=1)
+            best_other_states = np.repeat(best_states[:, np.newaxis], state_count, axis=1)
+            if state_count > 1:
+                runner_up_log_likelihoods = prev_log_likelihoods.copy()
+                runner_up_log_likelihoods[all_samples, best_states] = -np.inf
+                best_other_states[all_samples, best_states] = np.argmax(runner_up_log_likelihoods, axis=1)
+
+            stay_log_likelihoods = prev_log_likelihoods + log_transition_to_same_state_prob
+            switch_log_likelihoods = np.take_along_axis(prev_log_likelihoods, best_other_states, axis=1)
+            switch_log_likelihoods += log_transition_to_new_state_prob
+
+            # ties are broken in favor of the lowest from_state index (matching np.argmax)
+            use_stay = np.logical_or(
+                stay_log_likelihoods > switch_log_likelihoods,
+                np.logical_and(
+                    stay_log_likelihoods == switch_log_likelihoods,
+                    all_states < best_other_states))
+            from_state_lattice[t - 1, :, :] = np.where(use_stay, all_states, best_other_states)
+            curr_log_likelihoods = np.where(use_stay, stay_log_likelihoods, switch_log_likelihoods)
+            curr_log_likelihoods += log_state_obs_probs(t)
+
+        # backtrace through the most likely paths starting with the final states
+        max_final_states = np.argmax(curr_log_likelihoods, axis=1)
+        max_final_likelihoods = curr_log_likelihoods[all_samples, max_final_states]
+        max_likelihood_states = np.zeros((obs_count, sample_count), dtype=np.uint16)
+        max_likelihood_states[obs_count - 1, :] = max_final_states
         for t in reversed(range(obs_count - 1)):
-            max_likelihood_states[t] = from_state_lattice[t, max_likelihood_states[t + 1]]
+            max_likelihood_states[t, :] = from_state_lattice[t, all_samples, max_likelihood_states[t + 1, :]]
 
-        max_likelihood_states = [
-            (int(state_hap1_indices[s]), int(state_hap2_indices[s]))
-            for s in max_likelihood_states
-        ]
-        return max_likelihood_states, max_final_likelihood
+        max_likelihood_haplotypes = np.stack(
+            [state_hap1_indices[max_likelihood_states], state_hap2_indices[max_likelihood_states]],
+            axis=-1)
+        return max_likelihood_haplotypes, max_final_likelihoods
 
     def log_likelihood(self, haplotype1_ab_codes, haplotype2_ab_codes, observation_ab_codes):
         """
@@ -357,19 +486,175 @@ class SnpHaploHMM:
         log_obs_prob_matrix = np.log(self.obs_prob_matrix)
         return np.sum(log_obs_prob_matrix[haplotype1_ab_codes, haplotype2_ab_codes, observation_ab_codes])
 
+    def pairwise_log_likelihoods(self, haplotype_ab_codes, observation_ab_codes):
+        """
+        Compute the log_likelihood(...) of the observations for every pair of haplotypes at once.
+        For each observation code we count the SNPs where haplotype i has code a and haplotype j
+        has code b using a matrix product of one-hot code indicators. The likelihoods are then
+        weighted sums of these exact counts, which keeps the scores of pairs made up of identical
+        haplotypes exactly equal so that ties are stable.
+        :param haplotype_ab_codes: a (# SNPs, # haplotypes) matrix of haplotype AB codes
+        :param observation_ab_codes: the observation AB code vector
+        :return: a (# haplotypes, # haplotypes) matrix where [i, j] is the log likelihood given haplotypes i and j
+        """
+        haplotype_count = haplotype_ab_codes.shape[1]
+        log_obs_prob_matrix = np.log(self.obs_prob_matrix)
+
+        log_likelihoods = np.zeros((haplotype_count, haplotype_count), dtype=np.float64)
+        for obs_code in range(4):
+            obs_haplotype_ab_codes = haplotype_ab_codes[observation_ab_codes == obs_code, :]
+            if not obs_haplotype_ab_codes.size:
+                continue
+
+            # float32 products are exact for counts below 2 ** 24 which is well beyond any chromosome
+            one_hots = [(obs_haplotype_ab_codes == code).astype(np.float32) for code in range(4)]
+            present_codes = [code for code in range(4) if one_hots[code].any()]
+            for hap1_code in present_codes:
+                hap1_one_hot_t = np.transpose(one_hots[hap1_code])
+                for hap2_code in present_codes:
+                    if hap2_code < hap1_code:
+                        continue
+
+                    # the (hap2_code, hap1_code) counts are just the transpose. Adding them together
+                    # first means the [i, j] and [j, i] likelihoods are summed in the same order
+                    counts = np.dot(hap1_one_hot_t, one_hots[hap2_code])
+                    log_obs_prob = log_obs_prob_matrix[hap1_code, hap2_code, obs_code]
+                    swapped_log_obs_prob = log_obs_prob_matrix[hap2_code, hap1_code, obs_code]
+                    if hap1_code == hap2_code:
+                        count_terms = [(counts, log_obs_prob)]
+                    elif log_obs_prob == swapped_log_obs_prob:
+                        count_terms = [(counts + np.transpose(counts), log_obs_prob)]
+                    else:
+                        count_terms = [(counts, log_obs_prob), (np.transpose(counts), swapped_log_obs_prob)]
+
+                    for term_counts, term_log_obs_prob in count_terms:
+                        if np.isfinite(term_log_obs_prob):
+                            log_likelihoods += term_counts * term_log_obs_prob
+                        else:
+                            log_likelihoods[term_counts > 0] = term_log_obs_prob
+
+        return log_likelihoods
+
+    def best_haplotype_pairs(self, haplotype_ab_codes, observation_ab_codes, limit=None):
+        """
+        Find the most likely haplotype pairs (i, j) where i <= j for the given observations. This gives
+        the same result as computing log_likelihood(...) for every pair and sorting but only the top
+        pairs are ever sorted
+        :param haplotype_ab_codes: a (# SNPs, # haplotypes) matrix of haplotype AB codes
+        :param observation_ab_codes: the observation AB code vector
+        :param limit: the maximum number of pairs to return. If None all pairs are returned
+        :return: see top_haplotype_pairs(...)
+        """
+        return top_haplotype_pairs(
+            self.pairwise_log_likelihoods(haplotype_ab_codes, observation_ab_codes),
+            limit)
+
+    def _trans_probs(self, state_count):
+        """
+        The transition matrix only holds two distinct values so we just return those
+        :param state_count: the number of hidden states
+        :return: the tuple (same_state_prob, new_state_prob)
+        """
+        new_state_prob = 0.0
+        if state_count > 1:
+            new_state_prob = self.trans_prob / (state_count - 1)
+
+        return 1.0 - self.trans_prob, new_state_prob
+
+    def _state_obs_probs(self, haplotype_ab_codes, observation_ab_codes):
+        """
+        Look up the emission probabilities for every SNP and state
+        :param haplotype_ab_codes: the haplotype AB codes (see viterbi(...))
+        :param observation_ab_codes: the observation AB code vector (see viterbi(...))
+        :return: a (# SNPs, # states) matrix of P(obs | state)
+        """
+        haplotype_count = haplotype_ab_codes.shape[1]
+        state_hap1_indices, state_hap2_indices = np.triu_indices(haplotype_count)
+
+        return self.obs_prob_matrix[
+            haplotype_ab_codes[:, state_hap1_indices],
+            haplotype_ab_codes[:, state_hap2_indices],
+            observation_ab_codes[:, np.newaxis]]
+
     def forward_scan(self, haplotype_ab_codes, observation_ab_codes):
         """
+        Run the scaled forward algorithm. States are ordered the same way as they are for viterbi(...)
+        (the upper triangle of the haplotype x haplotype matrix in row-major order)
 
-        :param haplotype_ab_codes:
-        :param observation_ab_codes:
+        :param haplotype_ab_codes: the haplotype AB codes (see viterbi(...))
+        :param observation_ab_codes: the observation AB code vector (see viterbi(...))
+        :return:
+            the tuple (forward_likelihoods, forward_scaling_factors) where forward_likelihoods is
+            a (# SNPs, # states) matrix whose rows are scaled to sum to one and
+            forward_scaling_factors is the vector of per-SNP scaling factors. The log likelihood
+            of the observations is sum(log(forward_scaling_factors))
+        """
+        state_obs_probs = self._state_obs_probs(haplotype_ab_codes, observation_ab_codes)
+        obs_count, state_count = state_obs_probs.shape
+        same_state_prob, new_state_prob = self._trans_probs(state_count)
+
+        forward_likelihoods = np.empty((obs_count, state_count), dtype=np.float64)
+        forward_scaling_factors = np.empty(obs_count, dtype=np.float64)
+
+        # start with uniform initial probs
+        curr_likelihoods = state_obs_probs[0, :] / state_count
+        forward_scaling_factors[0] = np.sum(curr_likelihoods)
+        forward_likelihoods[0, :] = curr_likelihoods / forward_scaling_factors[0]
+
+        for t in range(1, obs_count):
+            # since the previous likelihoods sum to one the probability mass switching
+            # into each state is just new_state_prob * (1 - prev)
+            prev_likelihoods = forward_likelihoods[t - 1, :]
+            curr_likelihoods = same_state_prob * prev_likelihoods + new_state_prob * (1.0 - prev_likelihoods)
+            curr_likelihoods *= state_obs_probs[t, :]
+
+            forward_scaling_factors[t] = np.sum(curr_likelihoods)
+            forward_likelihoods[t, :] = curr_likelihoods / forward_scaling_factors[t]
+
+        return forward_likelihoods, forward_scaling_factors
+
+    def backward_scan(self, haplotype_ab_codes, observation_ab_codes, forward_scaling_factors):
+        """
+        Run the backward algorithm using the scaling factors from forward_scan(...)
+
+        :param haplotype_ab_codes: the haplotype AB codes (see viterbi(...))
+        :param observation_ab_codes: the observation AB code vector (see viterbi(...))
+        :param forward_scaling_factors: the scaling factors returned by forward_scan(...)
+        :return: a (# SNPs, # states) matrix of scaled backward likelihoods
+        """
+        state_obs_probs = self._state_obs_probs(haplotype_ab_codes, observation_ab_codes)
+        obs_count, state_count = state_obs_probs.shape
+        same_state_prob, new_state_prob = self._trans_probs(state_count)
+
+        backward_likelihoods = np.empty((obs_count, state_count), dtype=np.float64)
+        backward_likelihoods[obs_count - 1, :] = 1.0
+        for t in reversed(range(obs_count - 1)):
+            next_likelihoods = state_obs_probs[t + 1, :] * backward_likelihoods[t + 1, :]
+            next_likelihoods_sum = np.sum(next_likelihoods)
+            curr_likelihoods = \
+                same_state_prob * next_likelihoods + new_state_prob * (next_likelihoods_sum - next_likelihoods)
+            backward_likelihoods[t, :] = curr_likelihoods / forward_scaling_factors[t + 1]
+
+        return backward_likelihoods
+
+    def posterior_probabilities(self, haplotype_ab_codes, observation_ab_codes):
+        """
+        Use the forward-backward algorithm to calculate per-SNP posterior diplotype probabilities.
+        This runs in O(# SNPs x # states) time and memory
+
+        :param haplotype_ab_codes: the haplotype AB codes (see viterbi(...))
+        :param observation_ab_codes: the observation AB code vector (see viterbi(...))
         :return:
+            the tuple (posterior_probs, log_likelihood) where posterior_probs is a (# SNPs, # states)
+            matrix whose rows sum to one and log_likelihood is the log likelihood of the observations
         """
+        forward_likelihoods, forward_scaling_factors = self.forward_scan(haplotype_ab_codes, observation_ab_codes)
+        backward_likelihoods = self.backward_scan(haplotype_ab_codes, observation_ab_codes, forward_scaling_factors)
+
+        posterior_probs = forward_likelihoods * backward_likelihoods
+        _scale_matrix_rows_to_one(posterior_probs)
 
-        # forward_likelihoods = None
-        # forward_scaling_factors = None
-        #
-        # return forward_likelihoods, forward_scaling_factors
-        raise Exception('implement me')
+        return posterior_probs, np.sum(np.log(forward_scaling_factors))
 
 
 # def main():
@@ -418,3 +703,94 @@ class SnpHaploHMM:
 #
 # if __name__ == '__main__':
 #     main()
+
+
+def top_haplotype_pairs(pair_log_likelihoods, limit=None):
+    """
+    Select the most likely haplotype pairs (i, j) where i <= j from a pairwise log likelihood
+    matrix (see SnpHaploHMM.pairwise_log_likelihoods(...))
+    :param pair_log_likelihoods: the (# haplotypes, # haplotypes) log likelihood matrix
+    :param limit: the maximum number of pairs to return. If None all pairs are returned
+    :return:
+        a list of (i, j, log_likelihood) tuples sorted from most to least likely. Pairs with
+        equal likelihood are ordered by i then j
+    """
+    haplotype_count = pair_log_likelihoods.shape[0]
+    hap1_indices, hap2_indices = np.triu_indices(haplotype_count)
+    pair_log_likelihoods = pair_log_likelihoods[hap1_indices, hap2_indices]
+
+    pair_indices = np.arange(pair_log_likelihoods.size)
+    if limit is not None and limit < pair_log_likelihoods.size:
+        if limit <= 0:
+            return []
+
+        # everything tied with the limit'th best pair stays in play so that ties resolve the same way
+        limit_pair = np.argpartition(-pair_log_likelihoods, limit - 1)[limit - 1]
+        pair_indices = np.flatnonzero(pair_log_likelihoods >= pair_log_likelihoods[limit_pair])
+
+    pair_indices = pair_indices[np.lexsort((pair_indices, -pair_log_likelihoods[pair_indices]))][:limit]
+
+    return [
+        (int(hap1_indices[k]), int(hap2_indices[k]), float(pair_log_likelihoods[k]))
+        for k in pair_indices
+    ]
+
+
+class IntervalPairLogLikelihoods:
+    """
+    Answers pairwise haplotype log likelihood queries (see SnpHaploHMM.pairwise_log_likelihoods)
+    for arbitrary SNP intervals of a chromosome. Pairwise log likelihoods are prefix summed at
+    block boundaries so that the whole blocks covered by an interval take a single subtraction
+    and only the partial blocks at the interval edges need to be scored directly. Keeping a
+    prefix sum for every SNP would need (# SNPs) x (# haplotypes) ^ 2 values which is far too
+    much memory for a realistic candidate panel.
+    """
+
+    def __init__(self, hmm, haplotype_ab_codes, observation_ab_codes, block_size=256):
+        """
+        build the block prefix sums
+        :param hmm: the SnpHaploHMM
+        :param haplotype_ab_codes: a (# SNPs, # haplotypes) matrix of haplotype AB codes for the whole chromosome
+        :param observation_ab_codes: the observation AB code vector for the whole chromosome
+        :param block_size: the number of SNPs per block
+        """
+        self.hmm = hmm
+        self.haplotype_ab_codes = haplotype_ab_codes
+        self.observation_ab_codes = observation_ab_codes
+        self.block_size = block_size
+
+        snp_count, haplotype_count = haplotype_ab_codes.shape
+        block_count = snp_count // block_size
+        self.block_prefix_sums = np.zeros((block_count + 1, haplotype_count, haplotype_count), dtype=np.float64)
+        for block in range(block_count):
+            self.block_prefix_sums[block + 1] = self.block_prefix_sums[block] + self._direct_log_likelihoods(
+                block * block_size,
+                (block + 1) * block_size)
+
+    @property
+    def nbytes(self):
+        return self.block_prefix_sums.nbytes + self.haplotype_ab_codes.nbytes + self.observation_ab_codes.nbytes
+
+    def _direct_log_likelihoods(self, start_index, stop_index):
+        return self.hmm.pairwise_log_likelihoods(
+            self.haplotype_ab_codes[start_index:stop_index, :],
+            self.observation_ab_codes[start_index:stop_index])
+
+    def log_likelihoods(self, start_index, stop_index):
+        """
+        get the pairwise log likelihoods for an interval of SNPs
+        :param start_index: the index of the first SNP in the interval
+        :param stop_index: the index one past the last SNP in the interval
+        :return: the (# haplotypes, # haplotypes) log likelihood matrix
+        """
+        # the whole blocks that fall within the interval
+        start_block = -(-start_index // self.block_size)
+        stop_block = min(stop_index // self.block_size, self.block_prefix_sums.shape[0] - 1)
+        if start_block >= stop_block:
+            return self._direct_log_likelihoods(start_index, stop_index)
+
+        log_likelihoods = self.block_prefix_sums[stop_block] - self.block_prefix_sums[start_block]
+        log_likelihoods += self._direct_log_likelihoods(start_index, start_block * self.block_size)
+        log_likelihoods += self._direct_log_likelihoods(stop_block * self.block_size, stop_index)
+
+        return log_likelihoods
@@ -1,10 +1,12 @@
-from bisect import bisect_left, bisect_right
 from bson.objectid import ObjectId
 from bson.son import SON
+from collections import OrderedDict
 from celery import Celery
+from celery.signals import worker_process_init
 import colorsys
 import datetime
 import flask
+import hashlib
 import json
 import math
 import numpy as np
@@ -125,6 +127,13 @@ def _make_celery(app):
 celery = _make_celery(app)
 
 
+@worker_process_init.connect
+def _reset_worker_db_client(**kwargs):
+    # pool worker processes are forked from the main celery process so they
+    # must not reuse the parent's MongoClient
+    mds.reset_client()
+
+
 @app.context_processor
 def inject_vars():
     """
@@ -771,7 +780,7 @@ def sample_data_export_file():
             obj_id = ObjectId(mongo_id)
             curr_sample = _find_one_and_anno_samples({'_id': obj_id}, {}, db)
             for chr_val in curr_sample['chromosome_data'].values():
-                curr_sample['uses_snp_format'] = 'snps' in chr_val
+                curr_sample['uses_snp_format'] = mds.uses_snp_format(chr_val)
             samples.append(curr_sample)
 
             if platform is None:
@@ -783,17 +792,21 @@ def sample_data_export_file():
         chr_ids = platform['chromosomes']
         for chr_id in chr_ids:
             if (interval is None or interval['chr'] == chr_id) and any(chr_id in sample['chromosome_data'] for sample in samples):
-                snps = list(mds.get_snps(platform['platform_id'], chr_id, db))
+                snps = mds.snp_table_to_dicts(mds.get_snp_table(platform['platform_id'], chr_id, db))
+                chr_datas = [
+                    mds.unpack_chr_data(curr_sample['chromosome_data'][chr_id], snps)
+                    for curr_sample in samples
+                ]
                 for snp_index, curr_snp in enumerate(snps):
                     if interval is None or interval['startPos'] <= curr_snp['position_bp'] <= interval['endPos']:
                         snp_calls = []
-                        for curr_sample in samples:
+                        for curr_sample, chr_data in zip(samples, chr_datas):
                             if curr_sample['uses_snp_format']:
-                                snp_calls.append(curr_sample['chromosome_data'][chr_id]['snps'][snp_index])
+                                snp_calls.append(chr_data['snps'][snp_index])
                             else:
                                 curr_call = (
-                                    curr_sample['chromosome_data'][chr_id]['allele1_fwds'][snp_index] +
-                                    curr_sample['chromosome_data'][chr_id]['allele2_fwds'][snp_index]
+                                    chr_data['allele1_fwds'][snp_index] +
+                                    chr_data['allele2_fwds'][snp_index]
                                 )
                                 snp_calls.append(curr_call)
 
@@ -1681,7 +1694,7 @@ def sample_snp_report(mongo_id):
         flask.abort(400)
     sample_uses_snp_format = False
     for chr_val in sample['chromosome_data'].values():
-        sample_uses_snp_format = 'snps' in chr_val
+        sample_uses_snp_format = mds.uses_snp_format(chr_val)
 
     contributing_strains = sample['contributing_strains']
 
@@ -1715,7 +1728,8 @@ def sample_snp_report(mongo_id):
         chr_ids = platform['chromosomes']
         for chr_id in chr_ids:
             if chr_id in sample['chromosome_data']:
-                snps = list(mds.get_snps(sample['platform_id'], chr_id, db))
+                snps = mds.snp_table_to_dicts(mds.get_snp_table(sample['platform_id'], chr_id, db))
+                chr_data = mds.unpack_chr_data(sample['chromosome_data'][chr_id], snps)
                 try:
                     haplotype_blocks = sample['viterbi_haplotypes']['chromosome_data'][chr_id]['haplotype_blocks']
                 except KeyError:
@@ -1738,7 +1752,7 @@ def sample_snp_report(mongo_id):
                             curr_snp['snp_id'],
                             curr_snp['chromosome'],
                             str(curr_snp['position_bp']),
-                            sample['chromosome_data'][chr_id]['snps'][snp_index],
+                            chr_data['snps'][snp_index],
                             '' if snp_hap_block is None else contributing_strains[snp_hap_block['haplotype_index_1']],
                             '' if snp_hap_block is None else contributing_strains[snp_hap_block['haplotype_index_2']],
                         ))
@@ -1749,8 +1763,8 @@ def sample_snp_report(mongo_id):
                             curr_snp['snp_id'],
                             curr_snp['chromosome'],
                             str(curr_snp['position_bp']),
-                            sample['chromosome_data'][chr_id]['allele1_fwds'][snp_index],
-                            sample['chromosome_data'][chr_id]['allele2_fwds'][snp_index],
+                            chr_data['allele1_fwds'][snp_index],
+                            chr_data['allele2_fwds'][snp_index],
                             '' if snp_hap_block is None else contributing_strains[snp_hap_block['haplotype_index_1']],
                             '' if snp_hap_block is None else contributing_strains[snp_hap_block['haplotype_index_2']],
                         ))
@@ -1779,7 +1793,7 @@ def get_snps_grouped_json(mongo_id, chr_id):
         flask.abort(400)
     sample_uses_snp_format = False
     for chr_val in sample['chromosome_data'].values():
-        sample_uses_snp_format = 'snps' in chr_val
+        sample_uses_snp_format = mds.uses_snp_format(chr_val)
 
     contributing_strains = sample['contributing_strains']
 
@@ -1791,8 +1805,8 @@ def get_snps_grouped_json(mongo_id, chr_id):
         outDict = {}
         data_set = {}
 
-        snps = list(mds.get_snps(sample['platform_id'], chr_id, db))
-        print(snps)
+        snps = mds.snp_table_to_dicts(mds.get_snp_table(sample['platform_id'], chr_id, db))
+        chr_data = mds.unpack_chr_data(sample['chromosome_data'][chr_id], snps)
 
         try:
             haplotype_blocks = sample['viterbi_haplotypes']['chromosome_data'][chr_id]['haplotype_blocks']
@@ -1829,11 +1843,11 @@ def get_snps_grouped_json(mongo_id, chr_id):
             data_set[position]['haplotype2'] = hap2
 
             if sample_uses_snp_format:
-                data_set[position]['snp_call'] = sample['chromosome_data'][chr_id]['snps'][snp_index]
+                data_set[position]['snp_call'] = chr_data['snps'][snp_index]
 
             else:
-                data_set[position]['allele1_fwd'] = sample['chromosome_data'][chr_id]['allele1_fwds'][snp_index]
-                data_set[position]['allele2_fwd'] = sample['chromosome_data'][chr_id]['allele2_fwds'][snp_index]
+                data_set[position]['allele1_fwd'] = chr_data['allele1_fwds'][snp_index]
+                data_set[position]['allele2_fwd'] = chr_data['allele2_fwds'][snp_index]
 
             if data_set_counter == chunk_size:
                 # add the current set of data points to a new element and reset the dictionary
@@ -1880,7 +1894,7 @@ def get_snps_json(mongo_id, chr_id):
         flask.abort(400)
     sample_uses_snp_format = False
     for chr_val in sample['chromosome_data'].values():
-        sample_uses_snp_format = 'snps' in chr_val
+        sample_uses_snp_format = mds.uses_snp_format(chr_val)
 
     contributing_strains = sample['contributing_strains']
 
@@ -1888,7 +1902,8 @@ def get_snps_json(mongo_id, chr_id):
 
         outDict = {}
 
-        snps = list(mds.get_snps(sample['platform_id'], chr_id, db))
+        snps = mds.snp_table_to_dicts(mds.get_snp_table(sample['platform_id'], chr_id, db))
+        chr_data = mds.unpack_chr_data(sample['chromosome_data'][chr_id], snps)
 
         try:
             haplotype_blocks = sample['viterbi_haplotypes']['chromosome_data'][chr_id]['haplotype_blocks']
@@ -1924,11 +1939,11 @@ def get_snps_json(mongo_id, chr_id):
             outDict[position]['haplotype2'] = hap2
 
             if sample_uses_snp_format:
-                outDict[position]['snp_call'] = sample['chromosome_data'][chr_id]['snps'][snp_index]
+                outDict[position]['snp_call'] = chr_data['snps'][snp_index]
 
             else:
-                outDict[position]['allele1_fwd'] = sample['chromosome_data'][chr_id]['allele1_fwds'][snp_index]
-                outDict[position]['allele2_fwd'] = sample['chromosome_data'][chr_id]['allele2_fwds'][snp_index]
+                outDict[position]['allele1_fwd'] = chr_data['allele1_fwds'][snp_index]
+                outDict[position]['allele2_fwd'] = chr_data['allele2_fwds'][snp_index]
 
         return outDict
 
@@ -2221,15 +2236,13 @@ def update_sample(mongo_id):
         update_dict['viterbi_haplotypes.concordant_count'] = 0
         db.samples.update_one({'_id': obj_id}, {'$set': update_dict})
 
-        # since we invalidated haplotypes lets kick off tasks to recalculate
-        sample_obj_id = str(sample['_id'])
-        for chr_id in chr_ids:
-            t = infer_haplotype_structure_task.delay(
-                sample_obj_id,
-                chr_id,
-                haplotype_inference_uuid,
-            )
-            task_ids.append(t.task_id)
+        # since we invalidated haplotypes lets kick off a task to recalculate
+        t = infer_haplotypes_task.delay(
+            [str(sample['_id'])],
+            chr_ids,
+            haplotype_inference_uuid,
+        )
+        task_ids.append(t.task_id)
 
     elif update_dict:
         db.samples.update_one({'_id': obj_id}, {'$set': update_dict})
@@ -2329,15 +2342,16 @@ def update_samples():
         set_dict['viterbi_haplotypes.concordant_count'] = 0
         save_updates()
 
-        for sample_id in sample_ids_to_update:
-            sample_obj_id = str(sample_id)
-            for chr_id in chr_ids:
-                t = infer_haplotype_structure_task.delay(
-                    sample_obj_id,
-                    chr_id,
-                    haplotype_inference_uuid,
-                )
-                task_ids.append(t.task_id)
+        chr_ids = sorted(chr_ids)
+        batch_size = HAPLOQA_CONFIG.get('HAPLOTYPE_INFERENCE_BATCH_SIZE', 10)
+        for batch_start in range(0, len(sample_ids_to_update), batch_size):
+            batch_sample_ids = sample_ids_to_update[batch_start:batch_start + batch_size]
+            t = infer_haplotypes_task.delay(
+                [str(sample_id) for sample_id in batch_sample_ids],
+                chr_ids,
+                haplotype_inference_uuid,
+            )
+            task_ids.append(t.task_id)
     else:
         save_updates()
 
@@ -2352,21 +2366,199 @@ def update_samples():
 DEFAULT_CANDIDATE_HAPLOTYPE_LIMIT = 20
 
 
+# worker-local LRU cache of IntervalPairLogLikelihoods tables keyed on candidate panel key
+_interval_pair_lls_cache = OrderedDict()
+
+
+def _get_interval_pair_lls(panel_key, sample_obj_id, chr_id, candidate_obj_ids, db):
+    """
+    Get the (lazily built and cached) interval pair log likelihood table for a sample chromosome
+    and candidate panel. Note that this doesn't check permissions so the caller is responsible for
+    making sure that the user has access to the sample and to all of the candidates.
+    :param panel_key: the key for the sample/candidate panel (see _candidate_panel_key)
+    :param sample_obj_id: the sample's object ID
+    :param chr_id: the chromosome ID string. like: "X", "2", ...
+    :param candidate_obj_ids: the object IDs of the haplotype candidate samples
+    :param db: the mongo database
+    :return:
+        a (interval_pair_lls, standard_designations) tuple where standard_designations holds the
+        standard designation of each of the table's haplotypes or None if the sample can't be found
+    """
+    try:
+        _interval_pair_lls_cache.move_to_end(panel_key)
+        return _interval_pair_lls_cache[panel_key]
+    except KeyError:
+        pass
+
+    sample_projection = {'sample_id': 1, 'platform_id': 1}
+    sample_projection.update(mds.ab_code_projection(chr_id))
+    sample = db.samples.find_one({'_id': sample_obj_id}, sample_projection)
+    if sample is None:
+        return None
+
+    snps = mds.get_snp_table(sample['platform_id'], chr_id, db)
+    mds.load_missing_chr_calls([sample], chr_id, db)
+    sample_ab = hhmm.samples_to_ab_codes([sample], chr_id, snps)
+
+    haplotype_projection = {'sample_id': 1, 'standard_designation': 1, 'color': 1}
+    haplotype_projection.update(mds.ab_code_projection(chr_id))
+    haplotype_samples_by_id = {
+        x['_id']: x
+        for x in db.samples.find({'_id': {'$in': candidate_obj_ids}}, haplotype_projection)
+    }
+    haplotype_samples = [
+        haplotype_samples_by_id[obj_id]
+        for obj_id in candidate_obj_ids
+        if obj_id in haplotype_samples_by_id
+    ]
+    mds.load_missing_chr_calls(haplotype_samples, chr_id, db)
+    haplotype_samples_ab = hhmm.samples_to_ab_codes(haplotype_samples, chr_id, snps)
+
+    interval_pair_lls = (
+        hhmm.IntervalPairLogLikelihoods(_make_hmm(), haplotype_samples_ab, sample_ab[:, 0]),
+        [x['standard_designation'] for x in haplotype_samples],
+    )
+    _interval_pair_lls_cache[panel_key] = interval_pair_lls
+    while len(_interval_pair_lls_cache) > HAPLOQA_CONFIG.get('CANDIDATE_INTERVAL_CACHE_SIZE', 8):
+        _interval_pair_lls_cache.popitem(last=False)
+
+    return interval_pair_lls
+
+
+def _search_haplotype_candidates(panel_key, sample_obj_id, chr_id, left_index, right_index, candidate_obj_ids,
+                                 limit, db):
+    """
+    Find the most likely pairs of haplotype candidates for the given sample over a range of the
+    chromosome's SNPs. Note that this doesn't check permissions so the caller is responsible for
+    making sure that the user has access to the sample and to all of the candidates.
+    :param panel_key: the key for the sample/candidate panel (see _candidate_panel_key)
+    :param sample_obj_id: the sample's object ID
+    :param chr_id: the chromosome ID string. like: "X", "2", ...
+    :param left_index: the index of the first SNP in the range
+    :param right_index: the index one past the last SNP in the range
+    :param candidate_obj_ids: the object IDs of the haplotype candidate samples
+    :param limit: the maximum number of candidate pairs to return
+    :param db: the mongo database
+    :return: the list of candidate pair dicts sorted from most to least likely
+    """
+    best_candidates = []
+    interval_pair_lls = _get_interval_pair_lls(panel_key, sample_obj_id, chr_id, candidate_obj_ids, db)
+    if interval_pair_lls is None or left_index >= right_index:
+        return best_candidates
+
+    # get the haplotype indexes of the most likely pairs
+    pair_lls, standard_designations = interval_pair_lls
+    haplo_likelihoods = hhmm.top_haplotype_pairs(pair_lls.log_likelihoods(left_index, right_index), limit)
+
+    for i, j, curr_loglikelihood in haplo_likelihoods:
+        best_candidates.append({
+            'haplotype_1': standard_designations[i],
+            'haplotype_2': standard_designations[j],
+            'neg_log_likelihood': -curr_loglikelihood,
+        })
+
+    return best_candidates
+
+
+def _candidate_panel_key(sample, chr_id, candidates, db):
+    """
+    Build the key for a sample chromosome and its haplotype candidates. The key changes whenever anything
+    that candidate searches depend on changes: the sample, the platform's SNP annotations, any of the
+    candidate samples (including the candidate set itself) and the HMM parameters
+    """
+    hmm = _make_hmm()
+    key_hash = hashlib.sha1()
+    key_hash.update(json.dumps([
+        str(sample['_id']),
+        sample.get('last_update'),
+        str(sample.get('calls_revision')),
+        sample['platform_id'],
+        mds.get_platform_revision(sample['platform_id'], db),
+        chr_id,
+        [
+            [
+                str(candidate['_id']),
+                candidate.get('last_update'),
+                str(candidate.get('calls_revision')),
+                candidate.get('standard_designation'),
+            ]
+            for candidate in candidates
+        ],
+        hmm.trans_prob,
+    ]).encode())
+    key_hash.update(hmm.obs_prob_matrix.tobytes())
+
+    return key_hash.hexdigest()
+
+
+def _candidate_search_cache_key(panel_key, left_index, right_index, limit):
+    """
+    Build the key that candidate search results are cached under
+    """
+    return hashlib.sha1(json.dumps([panel_key, left_index, right_index, limit]).encode()).hexdigest()
+
+
+def _get_cached_candidates(cache_key, db):
+    """
+    Look up cached candidate search results, marking them as recently used
+    :return: the cached best candidates or None if they aren't cached
+    """
+    cached_search = db.candidate_search_cache.find_one_and_update(
+        {'cache_key': cache_key},
+        {'$set': {'last_access': datetime.datetime.utcnow()}},
+        {'best_candidates': 1},
+    )
+
+    return None if cached_search is None else cached_search['best_candidates']
+
+
+# when the candidate search cache overflows it is trimmed to this fraction of CANDIDATE_SEARCH_CACHE_SIZE
+CANDIDATE_SEARCH_CACHE_EVICT_FRACTION = 0.9
+
+
+def _cache_candidates(cache_key, best_candidates, db):
+    """
+    Cache candidate search results. Once there are more than CANDIDATE_SEARCH_CACHE_SIZE cached
+    results the least recently used ones are evicted down to CANDIDATE_SEARCH_CACHE_EVICT_FRACTION
+    of the limit so that eviction only runs occasionally rather than on every insert
+    """
+    db.candidate_search_cache.replace_one(
+        {'cache_key': cache_key},
+        {
+            'cache_key': cache_key,
+            'best_candidates': best_candidates,
+            'last_access': datetime.datetime.utcnow(),
+        },
+        upsert=True,
+    )
+
+    max_cache_size = HAPLOQA_CONFIG.get('CANDIDATE_SEARCH_CACHE_SIZE', 10000)
+    cache_size = db.candidate_search_cache.estimated_document_count()
+    if cache_size > max_cache_size:
+        evict_count = cache_size - int(max_cache_size * CANDIDATE_SEARCH_CACHE_EVICT_FRACTION)
+        evicted_searches = db.candidate_search_cache.find({}, {'_id': 1}).sort(
+            'last_access', pymongo.ASCENDING).limit(evict_count)
+        evicted_ids = [x['_id'] for x in evicted_searches]
+        if evicted_ids:
+            db.candidate_search_cache.delete_many({'_id': {'$in': evicted_ids}})
+
+
 @app.route('/best-haplotype-candidates/<sample_mongo_id_str>/chr<chr_id>-<int:start_pos_bp>-<int:end_pos_bp>.json')
 def best_haplotype_candidates(sample_mongo_id_str, chr_id, start_pos_bp, end_pos_bp):
     """
     This function will search all possible combinations of haplotypes for the given sample
     and interval, finding the most likely haplotype combinations and returning them
-    in sorted order (from most likely to least likely)
+    in sorted order (from most likely to least likely). If the search result isn't cached
+    the search is delegated to the celery task queue and the response will contain a
+    task_id that can be polled using best-haplotype-candidates-status
     :param sample_mongo_id_str:
     :param chr_id: the chromosome ID string. like: "X", "2", ...
     :param start_pos_bp: the start position to search
     :param end_pos_bp: the end position to search
-    :return: the JSON response containing the most likely haplotype combinations
+    :return: the JSON response containing the "ready" status along with either the most likely
+        haplotype combinations or the task ID
     """
 
-    # TODO: this is a bit too heavyweight for a web request and should be delegated to the celery task queue
-
     limit = flask.request.args.get('limit', None)
     if limit is not None:
         try:
@@ -2379,102 +2571,112 @@ def best_haplotype_candidates(sample_mongo_id_str, chr_id, start_pos_bp, end_pos
 
     db = mds.get_db()
     obj_id = ObjectId(sample_mongo_id_str)
-    sample = db.samples.find_one(
+    sample = _find_one_and_anno_samples(
         {'_id': obj_id},
-        {'platform_id': 1}
+        {'platform_id': 1, 'last_update': 1, 'calls_revision': 1, 'owner': 1},
+        db=db,
     )
     if sample is None:
         flask.abort(400)
 
     # calculate which SNPs fall within the interval of interest
-    snps = list(mds.get_snps(sample['platform_id'], chr_id, db))
-    snp_positions = [x['position_bp'] for x in snps]
-    left_index = bisect_left(snp_positions, start_pos_bp)
-    right_index = bisect_right(snp_positions, end_pos_bp, left_index)
-    snps = snps[left_index:right_index]
+    snp_table = mds.get_snp_table(sample['platform_id'], chr_id, db)
+    left_index = int(np.searchsorted(snp_table['position_bp'], start_pos_bp, side='left'))
+    right_index = max(left_index, int(np.searchsorted(snp_table['position_bp'], end_pos_bp, side='right')))
+    if left_index == right_index:
+        return flask.jsonify(ready=True, best_candidates=[])
+
+    # the candidates are resolved here since the user determines which samples are visible
+    candidates = list(_find_and_anno_samples(
+        {
+            '_id': {'$ne': obj_id},
+            'haplotype_candidate': True,
+            'platform_id': sample['platform_id']
+        },
+        {'last_update': 1, 'calls_revision': 1, 'standard_designation': 1, 'owner': 1},
+        db=db,
+    ))
+
+    panel_key = _candidate_panel_key(sample, chr_id, candidates, db)
+    cache_key = _candidate_search_cache_key(panel_key, left_index, right_index, limit)
+    best_candidates = _get_cached_candidates(cache_key, db)
+    if best_candidates is not None:
+        return flask.jsonify(ready=True, best_candidates=best_candidates)
+
+    t = best_haplotype_candidates_task.delay(
+        panel_key,
+        sample_mongo_id_str,
+        chr_id,
+        left_index,
+        right_index,
+        [str(candidate['_id']) for candidate in candidates],
+        limit,
+        cache_key,
+    )
 
-    def slice_snps(sample_to_slice):
-        try:
-            chr_data = sample_to_slice['chromosome_data'][chr_id]
-            try:
-                chr_data['allele1_fwds'] = chr_data['allele1_fwds'][left_index:right_index]
-            except KeyError:
-                pass
+    return flask.jsonify(ready=False, task_id=t.task_id)
 
-            try:
-                chr_data['allele2_fwds'] = chr_data['allele2_fwds'][left_index:right_index]
-            except KeyError:
-                pass
 
-            try:
-                chr_data['snps'] = chr_data['snps'][left_index:right_index]
-            except KeyError:
-                pass
+@app.route('/best-haplotype-candidates-status/<sample_mongo_id_str>/<task_id>.json')
+def best_haplotype_candidates_status(sample_mongo_id_str, task_id):
+    """
+    Render a JSON response describing the status of a candidate search task started by
+    best_haplotype_candidates. Once ready the response contains the best candidates. The
+    same sample access check is applied as when the search was started
+    :param sample_mongo_id_str: the mongo ID string of the sample that was searched
+    :param task_id: the celery task ID for the search
+    :return: the flask response object for the status. The task_id is echoed back so that
+            the page can drop the status of a search that it has since replaced
+    """
+    db = mds.get_db()
+    sample = _find_one_and_anno_samples({'_id': ObjectId(sample_mongo_id_str)}, {'owner': 1}, db=db)
+    if sample is None:
+        flask.abort(400)
 
-        except KeyError:
-            pass
+    async_result = best_haplotype_candidates_task.AsyncResult(task_id)
+    msg_dict = {
+        'task_id': task_id,
+        'ready': async_result.ready(),
+        'failed': async_result.failed(),
+    }
+    if async_result.failed():
+        msg_dict['error_message'] = str(async_result.result)
+        response = flask.jsonify(**msg_dict)
 
-    best_candidates = []
-    if snps:
-        # get sliced versions of our main sample and the haplotype samples
-        sample = _find_one_and_anno_samples(
-            {'_id': obj_id},
-            {
-                'sample_id': 1,
-                'platform_id': 1,
-                'chromosome_data.' + chr_id + '.allele1_fwds': 1,
-                'chromosome_data.' + chr_id + '.allele2_fwds': 1,
-                'chromosome_data.' + chr_id + '.snps': 1,
-            },
-            db=db,
-        )
-        if sample is None:
-            flask.abort(400)
-        slice_snps(sample)
-        sample_ab = hhmm.samples_to_ab_codes([sample], chr_id, snps)
+        # server error code
+        response.status_code = 500
 
-        haplotype_samples = list(_find_and_anno_samples(
-            {
-                '_id': {'$ne': obj_id},
-                'haplotype_candidate': True,
-                'platform_id': sample['platform_id']
-            },
-            {
-                'sample_id': 1,
-                'standard_designation': 1,
-                'color': 1,
-                'chromosome_data.' + chr_id + '.allele1_fwds': 1,
-                'chromosome_data.' + chr_id + '.allele2_fwds': 1,
-                'chromosome_data.' + chr_id + '.snps': 1,
-            },
-            db=db,
-        ))
-        for curr_hap_sample in haplotype_samples:
-            slice_snps(curr_hap_sample)
-        hap_sample_count = len(haplotype_samples)
-        haplotype_samples_ab = hhmm.samples_to_ab_codes(haplotype_samples, chr_id, snps)
-
-        # get the haplotype indexes and sort them by likelihood
-        haplo_likelihoods = []
-        hmm = _make_hmm()
-        for i in range(hap_sample_count):
-            for j in range(i, hap_sample_count):
-                curr_loglikelihood = hmm.log_likelihood(
-                    haplotype_samples_ab[:, i],
-                    haplotype_samples_ab[:, j],
-                    sample_ab[:, 0])
-                haplo_likelihoods.append((i, j, curr_loglikelihood))
-        haplo_likelihoods.sort(key=lambda tup: -tup[2])
-        haplo_likelihoods = haplo_likelihoods[:limit]
-
-        for i, j, curr_loglikelihood in haplo_likelihoods:
-            best_candidates.append({
-                'haplotype_1': haplotype_samples[i]['standard_designation'],
-                'haplotype_2': haplotype_samples[j]['standard_designation'],
-                'neg_log_likelihood': -curr_loglikelihood,
-            })
+        return response
+    else:
+        if async_result.ready():
+            if async_result.result['sample_id'] != sample_mongo_id_str:
+                flask.abort(404)
+            msg_dict['best_candidates'] = async_result.result['best_candidates']
+
+        return flask.jsonify(**msg_dict)
+
+
+@celery.task(name='best_haplotype_candidates_task')
+def best_haplotype_candidates_task(panel_key, sample_mongo_id_str, chr_id, left_index, right_index,
+                                   candidate_mongo_id_strs, limit, cache_key):
+    """
+    Run a candidate search (see best_haplotype_candidates) and cache the result
+    :return: a dict holding the searched 'sample_id' along with the 'best_candidates'
+    """
+    db = mds.get_db()
+    best_candidates = _search_haplotype_candidates(
+        panel_key,
+        ObjectId(sample_mongo_id_str),
+        chr_id,
+        left_index,
+        right_index,
+        [ObjectId(x) for x in candidate_mongo_id_strs],
+        limit,
+        db,
+    )
+    _cache_candidates(cache_key, best_candidates, db)
 
-    return flask.jsonify(best_candidates=best_candidates)
+    return {'sample_id': sample_mongo_id_str, 'best_candidates': best_candidates}
 
 
 @app.route('/sample/<mongo_id>/viterbi-haplotypes.json')
@@ -2587,12 +2789,356 @@ def _make_hmm():
     return hmm
 
 
+# worker-local LRU cache of haplotype candidate AB code panels keyed on platform, chromosome and candidate samples
+_haplotype_panel_cache = OrderedDict()
+
+# the projection needed for the haplotype candidate samples passed to _get_haplotype_panel
+HAPLOTYPE_PANEL_STRAIN_PROJECTION = {'sample_id': 1, 'standard_designation': 1, 'last_update': 1, 'calls_revision': 1}
+
+
+def _get_haplotype_panel(platform_id, platform_revision, chr_id, strains, snp_table, db):
+    """
+    Get the AB codes of a panel of haplotype candidate samples for a chromosome. Panels are cached by
+    each worker process and keyed on the platform revision along with the _id, last_update and
+    calls_revision of every candidate (every write of a sample's calls sets a new calls_revision) so a
+    panel is rebuilt whenever any of these change. The candidates' chromosome calls are only loaded
+    on a cache miss.
+    :param platform_id: the platform ID
+    :param platform_revision: the platform's revision (see mds.get_platform_revision)
+    :param chr_id: the chromosome
+    :param strains:
+        the haplotype candidate sample dicts loaded with HAPLOTYPE_PANEL_STRAIN_PROJECTION. The
+        chromosome calls don't need to be loaded
+    :param snp_table: the chromosome's SNP table (see mds.get_snp_table)
+    :param db: the mongo database
+    :return: the AB code matrix with one row per SNP and one column per candidate. Don't modify it
+    """
+    panel_key = (
+        platform_id,
+        platform_revision,
+        chr_id,
+        tuple((strain['_id'], strain.get('last_update'), strain.get('calls_revision')) for strain in strains),
+    )
+
+    try:
+        _haplotype_panel_cache.move_to_end(panel_key)
+        return _haplotype_panel_cache[panel_key]
+    except KeyError:
+        pass
+
+    strain_projection = {'sample_id': 1}
+    strain_projection.update(mds.ab_code_projection(chr_id))
+    chr_strains_by_id = {
+        x['_id']: x
+        for x in db.samples.find({'_id': {'$in': list(set(strain['_id'] for strain in strains))}}, strain_projection)
+    }
+    chr_strains = [chr_strains_by_id[strain['_id']] for strain in strains]
+    mds.load_missing_chr_calls(list(chr_strains_by_id.values()), chr_id, db)
+
+    panel = hhmm.samples_to_ab_codes(chr_strains, chr_id, snp_table)
+    panel.flags.writeable = False
+
+    _haplotype_panel_cache[panel_key] = panel
+    while len(_haplotype_panel_cache) > HAPLOQA_CONFIG.get('HAPLOTYPE_PANEL_CACHE_SIZE', 256):
+        _haplotype_panel_cache.popitem(last=False)
+
+    return panel
+
+
+def _haplotype_blocks(max_likelihood_haplotypes, positions_bp):
+    """
+    Convert a viterbi path into haplotype blocks. A new block starts at every SNP where the
+    state differs from the previous SNP's state
+    :param max_likelihood_haplotypes: the (# SNPs, 2) haplotype indices of the viterbi path
+    :param positions_bp: the SNP positions
+    :return: the list of haplotype block dicts
+    """
+    block_start_indexes = np.concatenate([
+        [0],
+        np.flatnonzero(np.any(np.diff(max_likelihood_haplotypes, axis=0), axis=1)) + 1,
+    ])
+    block_start_positions_bp = positions_bp[block_start_indexes]
+    block_end_positions_bp = np.append(block_start_positions_bp[1:] - 1, positions_bp[-1])
+
+    return [
+        {
+            'start_position_bp': start_pos_bp,
+            'end_position_bp': end_pos_bp,
+            'haplotype_index_1': haplotype_index_1,
+            'haplotype_index_2': haplotype_index_2,
+        }
+        for start_pos_bp, end_pos_bp, (haplotype_index_1, haplotype_index_2) in zip(
+            block_start_positions_bp.tolist(),
+            block_end_positions_bp.tolist(),
+            max_likelihood_haplotypes[block_start_indexes, :].tolist())
+    ]
+
+
+def _infer_chr_haplotypes(hmm, sample, contrib_ab_codes, chr_id, snp_table):
+    """
+    Run the HMM over a single chromosome of a sample to infer its haplotype blocks and call concordance.
+    The sample must already have the chromosome's calls loaded.
+    :param hmm: the HMM
+    :param sample: the sample dict
+    :param contrib_ab_codes: the contributing strain AB codes (see _get_haplotype_panel)
+    :param chr_id: the chromosome
+    :param snp_table: the chromosome's SNP table (see mds.get_snp_table)
+    :return: the (haplotype_dict, sample_ab_codes) tuple
+    """
+    positions_bp = snp_table['position_bp']
+    sample_ab_codes = hhmm.samples_to_ab_codes([sample], chr_id, snp_table)[:, 0]
+
+    # run viterbi to get maximum likelihood path
+    max_likelihood_haplotypes, max_final_likelihood = hmm.viterbi_haplotype_indices(
+        haplotype_ab_codes=contrib_ab_codes,
+        observation_ab_codes=sample_ab_codes)
+    haplotype_dict = _call_concordance(
+        max_likelihood_haplotypes,
+        sample_ab_codes,
+        contrib_ab_codes,
+        positions_bp,
+    )
+
+    # convert haplotypes into coordinates representation
+    haplotype_blocks = _haplotype_blocks(max_likelihood_haplotypes, positions_bp)
+    _extend_haplotype_blocks(haplotype_blocks)
+    haplotype_dict['haplotype_blocks'] = haplotype_blocks
+    haplotype_dict['results_pending'] = False
+
+    return haplotype_dict, sample_ab_codes
+
+
+def _report_missing_strains(sample, contrib_strains, chr_desc):
+    for i, strain in enumerate(contrib_strains):
+        if strain is None:
+            strain_name = sample['contributing_strains'][i]
+            print(
+                'Calculating diplotypes for sample "{}", chr "{}". '
+                'Failed to find candidate haplotype strain "{}" for platform "{}".'.format(
+                    sample['sample_id'],
+                    chr_desc,
+                    strain_name,
+                    sample['platform_id']),
+                file=sys.stderr)
+
+
+@celery.task(name='infer_haplotypes_task')
+def infer_haplotypes_task(sample_obj_id_strs, chr_ids, haplotype_inference_uuid):
+    """
+    This celery task infers the haplotypes of every given chromosome for a batch of samples. The samples
+    and all of their contributing strains are loaded once with a projection covering all chromosomes and
+    each sample's results are written with a single update. See infer_haplotype_structure_task for details.
+    :param sample_obj_id_strs: the mongo string IDs for the samples we're haplotyping
+    :param chr_ids: the chromosomes to haplotype
+    :param haplotype_inference_uuid:
+        this tag is just used to make sure that haplotypes are
+        inferred with the latest HMM settings (we need to prevent older inference
+        tasks from overwriting the results from newer inference tasks since we're
+        doing inference asynchronously)
+    """
+    db = mds.get_db()
+    sample_projection = {
+        'sample_id': 1,
+        'contributing_strains': 1,
+        'platform_id': 1,
+        'sex': 1,
+    }
+    for chr_id in chr_ids:
+        sample_projection.update(mds.ab_code_projection(chr_id))
+    samples = list(db.samples.find(
+        {
+            '_id': {'$in': [ObjectId(x) for x in sample_obj_id_strs]},
+            'haplotype_inference_uuid': haplotype_inference_uuid,
+        },
+        sample_projection))
+    if not samples:
+        # nothing to do if we can't find the samples (or if the UUID has changed)
+        return
+
+    # the haplotype candidates of each platform are looked up once for all of the batch's
+    # samples. Their calls are only loaded when a panel is missing from the haplotype panel cache
+    platform_strain_names = dict()
+    for sample in samples:
+        platform_strain_names.setdefault(sample['platform_id'], set()).update(sample['contributing_strains'])
+    platform_infos = dict()
+
+    def get_platform_info(platform_id):
+        if platform_id not in platform_infos:
+            platform_obj = db.platforms.find_one({'platform_id': platform_id}, {'chromosomes': 1, 'revision': 1})
+            if platform_obj is None:
+                raise Exception('failed to find a platform named "{}".'.format(platform_id))
+
+            strains_by_name = dict()
+            strains = db.samples.find(
+                {
+                    'haplotype_candidate': True,
+                    'standard_designation': {'$in': list(platform_strain_names[platform_id])},
+                    'platform_id': platform_id,
+                },
+                HAPLOTYPE_PANEL_STRAIN_PROJECTION)
+            for strain in strains:
+                strains_by_name.setdefault(strain['standard_designation'], strain)
+            platform_infos[platform_id] = set(platform_obj['chromosomes']), platform_obj.get('revision', 0), strains_by_name
+
+        return platform_infos[platform_id]
+
+    # failures are isolated to the sample (or chromosome) that they happen in so
+    # that one bad sample doesn't prevent the rest of the batch from being haplotyped
+    hmm = _make_hmm()
+    for sample in samples:
+        try:
+            _infer_sample_haplotypes(hmm, sample, chr_ids, get_platform_info, haplotype_inference_uuid, db)
+        except Exception as e:
+            print(
+                'Calculating diplotypes for sample "{}" failed.'.format(sample['sample_id']),
+                file=sys.stderr)
+            traceback.print_exc()
+            _record_haplotype_inference_failure(sample, chr_ids, e, haplotype_inference_uuid, db)
+
+
+def _haplotype_inference_error(e):
+    return {
+        'results_pending': False,
+        'error': 'haplotype inference failed: {}'.format(e),
+    }
+
+
+def _record_haplotype_inference_failure(sample, chr_ids, e, haplotype_inference_uuid, db):
+    """
+    Mark the chromosomes of a sample that are still pending as failed so that they aren't reported as
+    pending forever. Any chromosomes that were already saved are left as they are.
+    """
+    try:
+        curr_sample = db.samples.find_one(
+            {'_id': sample['_id'], 'haplotype_inference_uuid': haplotype_inference_uuid},
+            {'viterbi_haplotypes.chromosome_data': 1},
+        )
+        if curr_sample is not None:
+            chr_data = curr_sample.get('viterbi_haplotypes', {}).get('chromosome_data', {})
+            set_dict = {
+                'viterbi_haplotypes.chromosome_data.' + chr_id: _haplotype_inference_error(e)
+                for chr_id in chr_ids
+                if chr_data.get(chr_id, {}).get('results_pending')
+            }
+            if set_dict:
+                db.samples.update_one(
+                    {'_id': sample['_id'], 'haplotype_inference_uuid': haplotype_inference_uuid},
+                    {'$set': set_dict},
+                )
+    except Exception:
+        print(
+            'Failed to record haplotype inference failure for sample "{}".'.format(sample['sample_id']),
+            file=sys.stderr)
+        traceback.print_exc()
+
+
+def _infer_sample_haplotypes(hmm, sample, chr_ids, get_platform_info, haplotype_inference_uuid, db):
+    """
+    Infer the haplotypes of all of the given chromosomes of a sample and save them with a single
+    update. A chromosome that fails is logged and saved with an error rather than with haplotypes.
+    :param hmm: the HMM
+    :param sample: the sample dict
+    :param chr_ids: the chromosomes to haplotype
+    :param get_platform_info:
+        function that takes a platform ID and returns the (chromosome set, revision, strains_by_name)
+        tuple for the platform where strains_by_name maps standard designation to haplotype candidate
+    :param haplotype_inference_uuid: see infer_haplotypes_task
+    :param db: the mongo database
+    """
+    platform_id = sample['platform_id']
+    platform_chrs, platform_revision, strains_by_name = get_platform_info(platform_id)
+    contrib_strains = [strains_by_name.get(strain_name) for strain_name in sample['contributing_strains']]
+    if None in contrib_strains:
+        _report_missing_strains(sample, contrib_strains, ', '.join(chr_ids))
+
+    set_dict = dict()
+    unset_dict = dict()
+    chr_ab_codes = dict()
+    informative_count = 0
+    concordant_count = 0
+    for chr_id in chr_ids:
+        if ((chr_id == 'Y' and sample.get('sex', None) == 'female')
+                    or not sample['contributing_strains']
+                    or chr_id not in platform_chrs):
+            # if the above condition is met we're just going to delete and skip past this chromosome
+            unset_dict['viterbi_haplotypes.chromosome_data.' + chr_id] = ''
+        elif None not in contrib_strains:
+            try:
+                mds.load_missing_chr_calls([sample], chr_id, db)
+                snp_table = mds.get_snp_table(platform_id, chr_id, db)
+                contrib_ab_codes = _get_haplotype_panel(
+                    platform_id, platform_revision, chr_id, contrib_strains, snp_table, db)
+                haplotype_dict, sample_ab_codes = _infer_chr_haplotypes(
+                    hmm, sample, contrib_ab_codes, chr_id, snp_table)
+            except Exception as e:
+                print(
+                    'Calculating diplotypes for sample "{}", chr "{}" failed.'.format(sample['sample_id'], chr_id),
+                    file=sys.stderr)
+                traceback.print_exc()
+                set_dict['viterbi_haplotypes.chromosome_data.' + chr_id] = _haplotype_inference_error(e)
+            else:
+                set_dict['viterbi_haplotypes.chromosome_data.' + chr_id] = haplotype_dict
+                chr_ab_codes[chr_id] = contrib_ab_codes, sample_ab_codes
+                informative_count += haplotype_dict['informative_count']
+                concordant_count += haplotype_dict['concordant_count']
+
+    update_dict = dict()
+    if set_dict:
+        update_dict['$set'] = set_dict
+        update_dict['$inc'] = {
+            'viterbi_haplotypes.informative_count': informative_count,
+            'viterbi_haplotypes.concordant_count': concordant_count,
+        }
+    if unset_dict:
+        update_dict['$unset'] = unset_dict
+    if not update_dict:
+        return
+
+    update_res = db.samples.update_one(
+        {
+            # TODO add an index for this
+            '_id': sample['_id'],
+            'haplotype_inference_uuid': haplotype_inference_uuid,
+        },
+        update_dict,
+    )
+
+    # only save diplotype probabilities if the haplotypes we inferred are still current
+    if update_res.matched_count:
+        for chr_id, (contrib_ab_codes, sample_ab_codes) in chr_ab_codes.items():
+            try:
+                _save_diplotype_probabilities(
+                    hmm,
+                    sample,
+                    chr_id,
+                    contrib_ab_codes,
+                    sample_ab_codes,
+                    db,
+                )
+            except Exception as e:
+                print(
+                    'Saving diplotype probabilities for sample "{}", chr "{}" failed.'.format(
+                        sample['sample_id'],
+                        chr_id),
+                    file=sys.stderr)
+                traceback.print_exc()
+                db.samples.update_one(
+                    {'_id': sample['_id'], 'haplotype_inference_uuid': haplotype_inference_uuid},
+                    {'$set': {
+                        'viterbi_haplotypes.chromosome_data.' + chr_id + '.diplotype_probabilities_error':
+                            'saving diplotype probabilities failed: {}'.format(e),
+                    }},
+                )
+
+
 @celery.task(name='infer_haplotype_structure_task')
 def infer_haplotype_structure_task(sample_obj_id_str, chr_id, haplotype_inference_uuid):
     """
     This celery task does the heavy lifting of actually calculating the haplotypes for a given
     strain. This involves extracting SNP sequences from this sample as well as from all of
     the contributing_strains samples and delegating the HMM calculation to our HMM model.
+    New inference requests are batched with infer_haplotypes_task but this per-chromosome
+    task is kept so that already queued tasks still run.
     :param sample_obj_id_str: the mongo string ID for the sample we're haplotyping
     :param chr_id: the chromosome to haplotype
     :param haplotype_inference_uuid:
@@ -2604,19 +3150,20 @@ def infer_haplotype_structure_task(sample_obj_id_str, chr_id, haplotype_inferenc
     # look up all of the sample IDs and get their ab codes
     sample_obj_id = ObjectId(sample_obj_id_str)
     db = mds.get_db()
+    sample_projection = {
+        'sample_id': 1,
+        'contributing_strains': 1,
+        'platform_id': 1,
+        'sex': 1,
+    }
+    sample_projection.update(mds.ab_code_projection(chr_id))
     sample = db.samples.find_one(
         {
             # TODO add an index for this
             '_id': sample_obj_id,
             'haplotype_inference_uuid': haplotype_inference_uuid,
         },
-        {
-            'sample_id': 1,
-            'contributing_strains': 1,
-            'platform_id': 1,
-            'chromosome_data.' + chr_id: 1,
-            'sex': 1,
-        })
+        sample_projection)
     if sample is None:
         # nothing to do if we can't find the sample (or if the UUID has changed)
         return
@@ -2640,7 +3187,7 @@ def infer_haplotype_structure_task(sample_obj_id_str, chr_id, haplotype_inferenc
         )
 
     else:
-        snps = list(mds.get_snps(platform_id, chr_id, db))
+        snp_table = mds.get_snp_table(platform_id, chr_id, db)
         contrib_strains = [
             db.samples.find_one(
                 {
@@ -2648,68 +3195,20 @@ def infer_haplotype_structure_task(sample_obj_id_str, chr_id, haplotype_inferenc
                     'standard_designation': strain_name,
                     'platform_id': platform_id,
                 },
-                {'sample_id': 1, 'chromosome_data.' + chr_id: 1})
+                HAPLOTYPE_PANEL_STRAIN_PROJECTION)
             for strain_name in sample['contributing_strains']
         ]
         if None in contrib_strains:
-            for i, strain in enumerate(contrib_strains):
-                if strain is None:
-                    strain_name = sample['contributing_strains'][i]
-                    print(
-                        'Calculating diplotypes for sample "{}", chr "{}". '
-                        'Failed to find candidate haplotype strain "{}" for platform "{}".'.format(
-                            sample['sample_id'],
-                            chr_id,
-                            strain_name,
-                            platform_id),
-                        file=sys.stderr)
+            _report_missing_strains(sample, contrib_strains, chr_id)
         else:
-            contrib_ab_codes = hhmm.samples_to_ab_codes(contrib_strains, chr_id, snps)
-            sample_ab_codes = hhmm.samples_to_ab_codes([sample], chr_id, snps)[:, 0]
-
+            mds.load_missing_chr_calls([sample], chr_id, db)
+            contrib_ab_codes = _get_haplotype_panel(
+                platform_id, platform_obj.get('revision', 0), chr_id, contrib_strains, snp_table, db)
             hmm = _make_hmm()
+            haplotype_dict, sample_ab_codes = _infer_chr_haplotypes(
+                hmm, sample, contrib_ab_codes, chr_id, snp_table)
 
-            # run viterbi to get maximum likelihood path
-            max_likelihood_states, max_final_likelihood = hmm.viterbi(
-                haplotype_ab_codes=contrib_ab_codes,
-                observation_ab_codes=sample_ab_codes)
-            haplotype_dict = _call_concordance(
-                max_likelihood_states,
-                sample_ab_codes,
-                contrib_ab_codes,
-                snps,
-            )
-
-            # convert haplotypes into coordinates representation
-            num_snps = len(snps)
-            haplotype_blocks = []
-            start_state = max_likelihood_states[0]
-            start_pos_bp = snps[0]['position_bp']
-            curr_state = None
-            for curr_index in range(1, num_snps):
-                curr_state = max_likelihood_states[curr_index]
-                if curr_state != start_state:
-                    haplotype_blocks.append({
-                        'start_position_bp': start_pos_bp,
-                        'end_position_bp': snps[curr_index]['position_bp'] - 1,
-                        'haplotype_index_1': start_state[0],
-                        'haplotype_index_2': start_state[1],
-                    })
-
-                    start_state = curr_state
-                    start_pos_bp = snps[curr_index]['position_bp']
-
-            haplotype_blocks.append({
-                'start_position_bp': start_pos_bp,
-                'end_position_bp': snps[num_snps - 1]['position_bp'],
-                'haplotype_index_1': curr_state[0],
-                'haplotype_index_2': curr_state[1],
-            })
-            _extend_haplotype_blocks(haplotype_blocks)
-            haplotype_dict['haplotype_blocks'] = haplotype_blocks
-            haplotype_dict['results_pending'] = False
-
-            db.samples.update_one(
+            update_res = db.samples.update_one(
                 {
                     # TODO add an index for this
                     '_id': sample_obj_id,
@@ -2724,73 +3223,92 @@ def infer_haplotype_structure_task(sample_obj_id_str, chr_id, haplotype_inferenc
                 },
             )
 
+            # only save diplotype probabilities if the haplotypes we inferred are still current
+            if update_res.matched_count:
+                _save_diplotype_probabilities(
+                    hmm,
+                    sample,
+                    chr_id,
+                    contrib_ab_codes,
+                    sample_ab_codes,
+                    db,
+                )
+
+
+def _save_diplotype_probabilities(hmm, sample, chr_id, contrib_ab_codes, sample_ab_codes, db):
+    """
+    Calculate the per-SNP posterior diplotype probabilities for a sample's chromosome and save
+    them as a compact float32 matrix (see mds.save_hmm_diplotype_probabilities)
+    """
+    posterior_probs, _ = hmm.posterior_probabilities(contrib_ab_codes, sample_ab_codes)
+
+    contributing_strains = sample['contributing_strains']
+    state_hap1_indices, state_hap2_indices = np.triu_indices(len(contributing_strains))
+    diplotype_strains = [
+        [contributing_strains[hap1_index], contributing_strains[hap2_index]]
+        for hap1_index, hap2_index in zip(state_hap1_indices, state_hap2_indices)
+    ]
+
+    mds.save_hmm_diplotype_probabilities(sample, chr_id, diplotype_strains, posterior_probs, db)
+
 
 CONCORDANCE_BIN_SIZE = 50
 
 
-def _call_concordance(max_likelihood_states, sample_ab_codes, contrib_ab_codes, snps):
+def _call_concordance(max_likelihood_haplotypes, sample_ab_codes, contrib_ab_codes, positions_bp):
     """
     Calculates call concordance as a series of bins (the resulting concordance values are what
     we use to render the histograms on the karyotype plots)
-    """
-
-    informative_count = 0
-    concordant_count = 0
-    discordant_snp_indexes = []
-    concordance_bins = []
-    curr_bin_start_pos = -1
-    curr_bin_informative = 0
-    curr_bin_concordant = 0
-
-    for t, curr_state in enumerate(max_likelihood_states):
-        if curr_bin_start_pos == -1:
-            curr_bin_start_pos = snps[t]['position_bp']
-
-        curr_state_calls = {contrib_ab_codes[t, curr_state[0]], contrib_ab_codes[t, curr_state[1]]}
-        curr_sample_call = sample_ab_codes[t]
-
-        if curr_sample_call != hhmm.N_CODE:
-            if hhmm.N_CODE in curr_state_calls or hhmm.H_CODE in curr_state_calls:
-                is_concordant = False
-            elif len(curr_state_calls) == 2:
-                is_concordant = curr_sample_call == hhmm.H_CODE
-            else:
-                assert len(curr_state_calls) == 1
-                is_concordant = curr_sample_call == next(iter(curr_state_calls))
-
-            curr_bin_informative += 1
-            informative_count += 1
-            if is_concordant:
-                curr_bin_concordant += 1
-                concordant_count += 1
-            else:
-                discordant_snp_indexes.append(t)
-
-            if curr_bin_informative >= CONCORDANCE_BIN_SIZE:
-                # TODO this start/end isn't consistent with how we're doing haplotype start/end
-                concordance_bins.append({
-                    'start_position_bp': curr_bin_start_pos,
-                    'end_position_bp': snps[t]['position_bp'],
-                    'informative_count': curr_bin_informative,
-                    'concordant_count': curr_bin_concordant,
-                })
-                curr_bin_start_pos = -1
-                curr_bin_informative = 0
-                curr_bin_concordant = 0
-
-    if curr_bin_informative > 0:
+    :param max_likelihood_haplotypes: the (# SNPs, 2) haplotype indices of the viterbi path
+    :param sample_ab_codes: the sample's AB codes
+    :param contrib_ab_codes: the contributing strain AB codes
+    :param positions_bp: the SNP positions
+    :return: the concordance dict
+    """
+    all_snps = np.arange(len(sample_ab_codes))
+    hap1_calls = contrib_ab_codes[all_snps, max_likelihood_haplotypes[:, 0]]
+    hap2_calls = contrib_ab_codes[all_snps, max_likelihood_haplotypes[:, 1]]
+
+    # a SNP is informative if the sample has a call. It is concordant if the haplotypes both have a
+    # homozygous call and the sample's call matches them (a het call if the haplotypes differ)
+    informative = sample_ab_codes != hhmm.N_CODE
+    hom_haplotype_calls = np.isin(hap1_calls, [hhmm.A_CODE, hhmm.B_CODE])
+    hom_haplotype_calls &= np.isin(hap2_calls, [hhmm.A_CODE, hhmm.B_CODE])
+    expected_calls = np.where(hap1_calls == hap2_calls, hap1_calls, hhmm.H_CODE)
+    concordant = informative & hom_haplotype_calls & (sample_ab_codes == expected_calls)
+
+    # every bin holds CONCORDANCE_BIN_SIZE informative SNPs (except for the last bin which
+    # holds the remainder). A bin starts at the SNP following the previous bin's last SNP
+    informative_indexes = np.flatnonzero(informative)
+    informative_count = len(informative_indexes)
+    cumulative_concordant_counts = np.concatenate([[0], np.cumsum(concordant[informative_indexes])])
+    bin_starts = np.arange(0, informative_count, CONCORDANCE_BIN_SIZE)
+    bin_stops = np.minimum(bin_starts + CONCORDANCE_BIN_SIZE, informative_count)
+    bin_start_positions_bp = positions_bp[np.concatenate([[0], informative_indexes[bin_stops[:-1] - 1] + 1])]
+    bin_end_positions_bp = positions_bp[informative_indexes[bin_stops - 1]]
+    if informative_count % CONCORDANCE_BIN_SIZE:
         # TODO maybe we should require a higher number of informative than 1?
-        concordance_bins.append({
-            'start_position_bp': curr_bin_start_pos,
-            'end_position_bp': snps[-1]['position_bp'],
-            'informative_count': curr_bin_informative,
-            'concordant_count': curr_bin_concordant,
-        })
+        bin_end_positions_bp[-1] = positions_bp[-1]
+
+    # TODO this start/end isn't consistent with how we're doing haplotype start/end
+    concordance_bins = [
+        {
+            'start_position_bp': start_pos_bp,
+            'end_position_bp': end_pos_bp,
+            'informative_count': bin_informative,
+            'concordant_count': bin_concordant,
+        }
+        for start_pos_bp, end_pos_bp, bin_informative, bin_concordant in zip(
+            bin_start_positions_bp.tolist(),
+            bin_end_positions_bp.tolist(),
+            (bin_stops - bin_starts).tolist(),
+            (cumulative_concordant_counts[bin_stops] - cumulative_concordant_counts[bin_starts]).tolist())
+    ]
 
     return {
         'informative_count': informative_count,
-        'concordant_count': concordant_count,
-        'discordant_snp_indexes': discordant_snp_indexes,
+        'concordant_count': int(cumulative_concordant_counts[-1]),
+        'discordant_snp_indexes': np.flatnonzero(informative & ~concordant).tolist(),
         'concordance_bins': concordance_bins,
     }
 
@@ -2877,6 +3395,168 @@ def gemm_intens_html(mongo_id):
         return flask.render_template('gemm-intens.html', sample=sample, gemm_intens=gemm_intens)
 
 
+def _start_gemm_screen(query):
+    """
+    Kick off a GEMM screen of all of the samples matching the given query that the user has access to
+    :param query: the sample query
+    :return: the flask JSON response containing the task ID that the screen results are stored under
+    """
+    user = flask.g.user
+    if user is None:
+        response = flask.jsonify({'success': False})
+        response.status_code = 400
+
+        return response
+    else:
+        samples = _find_and_anno_samples(
+            query,
+            {'_id': 1, 'owner': 1},
+            cursor_func=lambda c: c.sort('sample_id', pymongo.ASCENDING),
+        )
+        sample_obj_id_strs = [str(sample['_id']) for sample in samples]
+        t = gemm_screen_task.delay(sample_obj_id_strs, user['email_address_lowercase'])
+
+        return flask.jsonify(task_id=t.task_id, sample_count=len(sample_obj_id_strs))
+
+
+@app.route('/tag/<escfwd:tag_id>/gemm-screen.json', methods=['POST'])
+def tag_gemm_screen_json(tag_id):
+    """
+    Start a GEMM screen of all samples with the given tag. Poll gemm-screen-status with the returned task ID
+    :param tag_id: the tag
+    :return: JSON containing the screen's task_id
+    """
+    return _start_gemm_screen({'tags': tag_id})
+
+
+@app.route('/standard-designation/<escfwd:standard_designation>/gemm-screen.json', methods=['POST'])
+def standard_designation_gemm_screen_json(standard_designation):
+    """
+    Start a GEMM screen of all samples with the given standard designation. Poll gemm-screen-status
+    with the returned task ID
+    :param standard_designation: the standard designation
+    :return: JSON containing the screen's task_id
+    """
+    return _start_gemm_screen({'standard_designation': standard_designation})
+
+
+@app.route('/gemm-screen-status/<task_id>.json')
+def gemm_screen_status_json(task_id):
+    """
+    Render a JSON response describing the status of a GEMM screen task. Once the screen is
+    ready the response includes the screened 'samples', the engineered 'targets' and the
+    samples x targets 'probabilities' matrix (with null for samples that couldn't be called)
+    along with the object IDs of any 'missing_samples' that were deleted before the screen ran
+    :param task_id: the celery task ID for the screen
+    :return: the flask response object for the status
+    """
+    user = flask.g.user
+    if user is None:
+        response = flask.jsonify({'success': False})
+        response.status_code = 400
+
+        return response
+
+    async_result = gemm_screen_task.AsyncResult(task_id)
+    msg_dict = {
+        'ready': async_result.ready(),
+        'failed': async_result.failed(),
+    }
+    if async_result.failed():
+        msg_dict['error_message'] = str(async_result.result)
+        response = flask.jsonify(**msg_dict)
+
+        # server error code
+        response.status_code = 500
+
+        return response
+
+    if async_result.ready():
+        db = mds.get_db()
+        gemm_screen = db.gemm_screens.find_one(
+            {'task_id': task_id, 'user_email': user['email_address_lowercase']},
+            {'_id': 0, 'missing_samples': 1, 'targets': 1},
+        )
+        if gemm_screen is None:
+            flask.abort(404)
+        msg_dict.update(gemm_screen)
+
+        msg_dict['samples'] = []
+        msg_dict['probabilities'] = []
+        gemm_screen_rows = db.gemm_screen_rows.find(
+            {'task_id': task_id},
+            {'_id': 0, 'samples': 1, 'probabilities': 1},
+        ).sort('start_row', pymongo.ASCENDING)
+        for rows in gemm_screen_rows:
+            msg_dict['samples'].extend(rows['samples'])
+            msg_dict['probabilities'].extend(rows['probabilities'])
+
+    return flask.jsonify(**msg_dict)
+
+
+# the number of samples stored per gemm_screen_rows document. This keeps the documents
+# of large screens well under the 16MB BSON document limit
+GEMM_SCREEN_ROWS_PER_DOC = 1000
+
+
+@celery.task(name='gemm_screen_task', bind=True)
+def gemm_screen_task(self, sample_obj_id_strs, user_email):
+    """
+    Score all of the given samples against every engineered target in a single pass and
+    persist the samples x targets probability matrix. The screen's targets are stored in the
+    gemm_screens collection and its rows in gemm_screen_rows documents holding up to
+    GEMM_SCREEN_ROWS_PER_DOC samples each. Samples that were deleted after the screen was
+    queued are skipped and listed as 'missing_samples'
+    """
+    db = mds.get_db()
+    requested_obj_ids = [ObjectId(x) for x in sample_obj_id_strs]
+    sample_ids = {
+        x['_id']: x['sample_id']
+        for x in db.samples.find({'_id': {'$in': requested_obj_ids}}, {'sample_id': 1})
+    }
+    sample_obj_ids = [obj_id for obj_id in requested_obj_ids if obj_id in sample_ids]
+    gemm_probs = gemminf.est_gemm_probs(sample_obj_ids, db=db) if sample_obj_ids else dict()
+
+    targets = sorted(gemm_probs.keys())
+    if targets:
+        probabilities = np.array([gemm_probs[tgt] for tgt in targets]).transpose()
+    else:
+        probabilities = np.empty((len(sample_obj_ids), 0))
+
+    # the rows are written before the summary so that a screen is complete once its summary exists.
+    # created is in UTC for the TTL indexes (see mds.init_db)
+    created = datetime.datetime.utcnow()
+    row_docs = [
+        {
+            'task_id': self.request.id,
+            'created': created,
+            'start_row': start_row,
+            'samples': [
+                {'obj_id': str(obj_id), 'sample_id': sample_ids[obj_id]}
+                for obj_id in sample_obj_ids[start_row:start_row + GEMM_SCREEN_ROWS_PER_DOC]
+            ],
+            'probabilities': [
+                [float(x) if np.isfinite(x) else None for x in sample_probs]
+                for sample_probs in probabilities[start_row:start_row + GEMM_SCREEN_ROWS_PER_DOC]
+            ],
+        }
+        for start_row in range(0, len(sample_obj_ids), GEMM_SCREEN_ROWS_PER_DOC)
+    ]
+    if row_docs:
+        db.gemm_screen_rows.insert_many(row_docs)
+
+    db.gemm_screens.insert_one({
+        'task_id': self.request.id,
+        'user_email': user_email,
+        'created': created,
+        'sample_count': len(sample_obj_ids),
+        'missing_samples': [str(obj_id) for obj_id in requested_obj_ids if obj_id not in sample_ids],
+        'targets': targets,
+    })
+
+    return len(sample_obj_ids)
+
+
 #####################################################################
 # UNIQUE IDs
 #####################################################################
@@ -2918,7 +3598,10 @@ def max_likelihood_genoprobs(sample_id, db=None):
     if db is None:
         db = mds.get_db()
 
-    diplo_prob_platform = db.diplotype_probabilities.find_one({'sample_id': sample_id}, {'platform_id': 1})
+    # HMM posteriors are preferred over imported genotype probabilities
+    diplo_prob_platform = db.hmm_diplotype_probabilities.find_one({'sample_id': sample_id}, {'platform_id': 1})
+    if diplo_prob_platform is None:
+        diplo_prob_platform = db.diplotype_probabilities.find_one({'sample_id': sample_id}, {'platform_id': 1})
 
     if diplo_prob_platform is not None:
         platform_obj = db.platforms.find_one({'platform_id': diplo_prob_platform['platform_id']})
@@ -2929,16 +3612,36 @@ def max_likelihood_genoprobs(sample_id, db=None):
             max_likelihood_chr_genoprobs(sample_id, chrom, db)
 
 
+def _chr_genoprobs(sample_id, chrom, db):
+    """
+    Find the diplotype probabilities of a sample's chromosome. The HMM posteriors saved during haplotype
+    inference are used when present, otherwise we fall back to imported genotype probabilities
+    :return: the (platform_id, diplotype_strains, probs) tuple or None if there are no probabilities
+    """
+    hmm_genoprobs = mds.get_hmm_diplotype_probabilities(sample_id, chrom, db)
+    if hmm_genoprobs is not None:
+        return hmm_genoprobs
+
+    sample_genoprob = db.diplotype_probabilities.find_one({'sample_id': sample_id, 'chromosome': chrom})
+    if sample_genoprob:
+        return (
+            sample_genoprob['platform_id'],
+            sample_genoprob['diplotype_strains'],
+            mds.get_diplotype_probabilities(sample_genoprob),
+        )
+
+    return None
+
+
 def max_likelihood_chr_genoprobs(sample_id, chrom, db):
     print('======', chrom, '=======')
     ml_diplotype_indices = []
     ml_positions_bp = []
-    sample_genoprob = db.diplotype_probabilities.find_one({'sample_id': sample_id, 'chromosome': chrom})
+    sample_genoprob = _chr_genoprobs(sample_id, chrom, db)
     if sample_genoprob:
-        snps = list(mds.get_snps(sample_genoprob['platform_id'], sample_genoprob['chromosome']))
+        platform_id, diplo_strains, diplo_genoprobs = sample_genoprob
+        snps = list(mds.get_snps(platform_id, chrom, db))
         if snps:
-            diplo_strains = sample_genoprob['diplotype_strains']
-            diplo_genoprobs = sample_genoprob['diplotype_probabilities']
             prev_start_pos_bp = snps[0]['position_bp']
             prev_max_likelihood_diplo = np.argmax(diplo_genoprobs[0])
             ml_diplotype_indices.append(prev_max_likelihood_diplo)
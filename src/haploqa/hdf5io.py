@@ -1,10 +1,20 @@
 import argparse
+from collections import deque
 import h5py
+from itertools import islice
+import multiprocessing
 import numpy as np
+from pymongo import UpdateOne
 import sys
 
 import haploqa.mongods as mds
 
+# the number of probesets read from a diplotype probability dataset at a time
+HDF5_READ_CHUNK_SIZE = 10000
+
+# the number of diplotype probability upserts sent per bulk write
+UPDATE_BATCH_SIZE = 50
+
 
 def as_utf8(s):
     if isinstance(s, bytes):
@@ -13,7 +23,116 @@ def as_utf8(s):
         return s
 
 
-def merge_h5(h5_filename, match_other_ids):
+def _scatter_probabilities(probs_dataset, probeset_ids, snp_index):
+    """
+    Read the diplotype probabilities dataset (with shape (# strains, # probesets)) in chunks and
+    scatter the values into per-chromosome float32 arrays with shape (# platform SNPs, # strains).
+    Probabilities for SNPs that aren't in the platform are dropped and platform SNPs that aren't
+    in the dataset are NaN
+    """
+    strain_count = probs_dataset.shape[0]
+    chr_probs = {
+        chrom: np.full((count, strain_count), np.nan, dtype=np.float32)
+        for chrom, count
+        in snp_index.snp_count_per_chr.items()
+    }
+
+    chr_codes, chr_indexes = snp_index.lookup(probeset_ids)
+    for chunk_start in range(0, len(probeset_ids), HDF5_READ_CHUNK_SIZE):
+        chunk_end = min(chunk_start + HDF5_READ_CHUNK_SIZE, len(probeset_ids))
+        chunk_probs = np.transpose(probs_dataset[:, chunk_start:chunk_end])
+        chunk_chr_codes = chr_codes[chunk_start:chunk_end]
+        chunk_chr_indexes = chr_indexes[chunk_start:chunk_end]
+        for chr_code, chrom in enumerate(snp_index.chromosomes):
+            is_chr = chunk_chr_codes == chr_code
+            if np.any(is_chr):
+                chr_probs[chrom][chunk_chr_indexes[is_chr], :] = chunk_probs[is_chr, :]
+
+    return chr_probs
+
+
+def _sample_prob_docs(sample_grp, mds_sample_id, snp_index):
+    """
+    build the per-chromosome diplotype_probabilities documents for a single HDF5 sample group
+    """
+    platform_id = as_utf8(sample_grp['platform'][0])
+    h5_probeset_ids = [as_utf8(x) for x in np.array(sample_grp['probeset_ids'])]
+    h5_diplotype_strains = list(map(lambda x: list(map(as_utf8, x)), sample_grp['diplotype_strains']))
+
+    chr_probs = _scatter_probabilities(sample_grp['diplotype_probabilities'], h5_probeset_ids, snp_index)
+
+    return [
+        {
+            'sample_id': mds_sample_id,
+            'chromosome': chr,
+            'platform_id': platform_id,
+            'diplotype_probabilities': mds.float_array_to_binary(probs),
+            'diplotype_strains': h5_diplotype_strains,
+        }
+        for chr, probs in chr_probs.items()
+    ]
+
+
+# the (h5_file, snp_indexes) tuple used by _merge_sample
+_merge_worker_state = None
+
+
+def _init_merge_worker(h5_filename, snp_indexes):
+    # every worker opens its own read-only handle since h5py files can't be shared across processes
+    global _merge_worker_state
+    _merge_worker_state = h5py.File(h5_filename, 'r'), snp_indexes
+
+
+def _merge_sample(merge_job):
+    h5_file, snp_indexes = _merge_worker_state
+    sample_grp_name, h5_sample_id, mds_sample_id, platform_id = merge_job
+    print('processing:', h5_sample_id)
+    return _sample_prob_docs(h5_file['samples'][sample_grp_name], mds_sample_id, snp_indexes[platform_id])
+
+
+def _iter_serial_prob_docs(merge_jobs, h5_filename, snp_indexes):
+    """
+    build the documents for the given jobs in this process. The HDF5 file is closed once
+    all of the jobs are done (or if we stop early)
+    """
+    global _merge_worker_state
+    with h5py.File(h5_filename, 'r') as h5_file:
+        _merge_worker_state = h5_file, snp_indexes
+        try:
+            for merge_job in merge_jobs:
+                yield _merge_sample(merge_job)
+        finally:
+            _merge_worker_state = None
+
+
+def _iter_parallel_prob_docs(merge_jobs, h5_filename, snp_indexes, workers):
+    """
+    build the documents for the given jobs in a pool of worker processes. As with the final
+    report import we only keep a couple of jobs per worker in flight so that memory use stays
+    bounded even if the DB writes are slower than the merge
+    """
+    pool = multiprocessing.Pool(workers, initializer=_init_merge_worker, initargs=(h5_filename, snp_indexes))
+    try:
+        job_iter = iter(merge_jobs)
+        pending_jobs = deque(
+            pool.apply_async(_merge_sample, (merge_job,))
+            for merge_job in islice(job_iter, 2 * workers)
+        )
+        while pending_jobs:
+            prob_docs = pending_jobs.popleft().get()
+            next_job = next(job_iter, None)
+            if next_job is not None:
+                pending_jobs.append(pool.apply_async(_merge_sample, (next_job,)))
+
+            yield prob_docs
+
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def merge_h5(h5_filename, match_other_ids, db=None, workers=1):
     """
     Merge data from the given HDF5 file into the database
 
@@ -21,75 +140,88 @@ def merge_h5(h5_filename, match_other_ids):
     :param match_other_ids:
         this indicates that the IDs present are not canonical and should be matched against
         a sample's "other_ids" attribute rather than the canonical "sample_id" attribute
+    :param db: the database. By default we use mds.get_db()
+    :param workers:
+        the number of processes used to read and scatter the sample probabilities. All DB
+        writes are performed by this process
     """
-    db = mds.get_db()
-    samples = db.samples
-    h5_file = h5py.File(h5_filename, 'r')
-
-    platform_tuple_cache = dict()
-    def get_platform_tuple(platform_id):
-        if platform_id in platform_tuple_cache:
-            return platform_tuple_cache[platform_id]
-        else:
-            tup = mds.within_chr_snp_indices(platform_id, db)
-            platform_tuple_cache[platform_id] = tup
-            return tup
-
-    samples_grp = h5_file['samples']
-    for sample_grp_name in samples_grp:
-        sample_grp = samples_grp[sample_grp_name]
-
-        # for attr_name in sample_grp:
-        #     print('\t' + attr_name)
-
-        if 'sample_id' in sample_grp:
-            h5_sample_id = as_utf8(sample_grp['sample_id'][0])
-            matching_samples = list(samples.find(
-                {'other_ids': h5_sample_id},
-                {'_id': 1, 'sample_id': 1, 'platform_id': 1}))
-            matching_sample_count = len(matching_samples)
-            if matching_sample_count == 1:
-                print('processing:', h5_sample_id)
-                mds_matching_sample = matching_samples[0]
-
-                mds_sample_id = mds_matching_sample['sample_id']
-                mds_sample_platform = mds_matching_sample['platform_id']
-                h5_sample_platform = as_utf8(sample_grp['platform'][0])
-                if h5_sample_platform != mds_sample_platform:
-                    print('skipping', h5_sample_id, 'due to platform mismatch', file=sys.stderr)
-                    continue
-
-                h5_probeset_ids = [as_utf8(x) for x in np.array(sample_grp['probeset_ids'])]
-                h5_diplotype_probabilities = np.array(sample_grp['diplotype_probabilities']).transpose().tolist()
-                h5_diplotype_strains = list(map(lambda x: list(map(as_utf8, x)), sample_grp['diplotype_strains']))
-
-                platform_chrs, snp_count_per_chr, snp_chr_indexes = get_platform_tuple(h5_sample_platform)
-
-                # create a per-chromosome 2D list with shape (# platform SNPs, # diplotype strains) for probabilities
-                chr_probs = {
-                    chrom: [[float('nan')] * len(h5_diplotype_strains) for _ in range(count)]
-                    for chrom, count
-                    in snp_count_per_chr.items()
-                }
-                for h5_idx, probeset_id in enumerate(h5_probeset_ids):
-                    if probeset_id in snp_chr_indexes:
-                        chr_idx = snp_chr_indexes[probeset_id]
-                        chr_probs[chr_idx['chromosome']][chr_idx['index']] = h5_diplotype_probabilities[h5_idx]
-
-                for chr, probs in chr_probs.items():
-                    db.diplotype_probabilities.update_one(
-                        {'sample_id': mds_sample_id, 'chromosome': chr},
-                        {'$set': {
-                            'sample_id': mds_sample_id,
-                            'chromosome': chr,
-                            'platform_id': h5_sample_platform,
-                            'diplotype_probabilities': probs,
-                            'diplotype_strains': h5_diplotype_strains,
-                        }},
-                        upsert=True,
-                    )
-            else:
-                print('skipping:', h5_sample_id)
+    if db is None:
+        db = mds.get_db()
+    if workers > 1 and multiprocessing.current_process().daemon:
+        # daemonic processes (eg. celery prefork pool workers) aren't allowed to have children
+        print('merging in a single process since daemonic processes cannot start workers', file=sys.stderr)
+        workers = 1
+
+    # figure out which sample groups we're merging before any probabilities are read
+    merge_jobs = []
+    with h5py.File(h5_filename, 'r') as h5_file:
+        samples_grp = h5_file['samples']
+
+        # look up the matching samples for the whole file with a single query
+        id_key = 'other_ids' if match_other_ids else 'sample_id'
+        h5_sample_ids = [
+            as_utf8(samples_grp[sample_grp_name]['sample_id'][0])
+            for sample_grp_name in samples_grp
+            if 'sample_id' in samples_grp[sample_grp_name]
+        ]
+        matching_samples_by_id = {h5_sample_id: [] for h5_sample_id in h5_sample_ids}
+        matching_samples = db.samples.find(
+            {id_key: {'$in': h5_sample_ids}},
+            {'_id': 1, 'sample_id': 1, 'other_ids': 1, 'platform_id': 1})
+        for matching_sample in matching_samples:
+            sample_ids = matching_sample.get('other_ids', []) if match_other_ids else [matching_sample['sample_id']]
+            for sample_id in sample_ids:
+                if sample_id in matching_samples_by_id:
+                    matching_samples_by_id[sample_id].append(matching_sample)
+
+        for sample_grp_name in samples_grp:
+            sample_grp = samples_grp[sample_grp_name]
+
+            # for attr_name in sample_grp:
+            #     print('\t' + attr_name)
+
+            if 'sample_id' in sample_grp:
+                h5_sample_id = as_utf8(sample_grp['sample_id'][0])
+                matching_samples = matching_samples_by_id[h5_sample_id]
+                matching_sample_count = len(matching_samples)
+                if matching_sample_count == 1:
+                    mds_matching_sample = matching_samples[0]
+
+                    mds_sample_id = mds_matching_sample['sample_id']
+                    mds_sample_platform = mds_matching_sample['platform_id']
+                    h5_sample_platform = as_utf8(sample_grp['platform'][0])
+                    if h5_sample_platform != mds_sample_platform:
+                        print('skipping', h5_sample_id, 'due to platform mismatch', file=sys.stderr)
+                        continue
+
+                    merge_jobs.append((sample_grp_name, h5_sample_id, mds_sample_id, h5_sample_platform))
+                else:
+                    print('skipping:', h5_sample_id)
+
+    snp_indexes = {
+        platform_id: mds.get_platform_snp_index(platform_id, db)
+        for platform_id in set(merge_job[-1] for merge_job in merge_jobs)
+    }
+
+    if workers > 1:
+        sample_prob_docs = _iter_parallel_prob_docs(merge_jobs, h5_filename, snp_indexes, workers)
+    else:
+        sample_prob_docs = _iter_serial_prob_docs(merge_jobs, h5_filename, snp_indexes)
+
+    pending_updates = []
+    for prob_docs in sample_prob_docs:
+        for prob_doc in prob_docs:
+            pending_updates.append(UpdateOne(
+                {'sample_id': prob_doc['sample_id'], 'chromosome': prob_doc['chromosome']},
+                {'$set': prob_doc},
+                upsert=True,
+            ))
+            if len(pending_updates) >= UPDATE_BATCH_SIZE:
+                db.diplotype_probabilities.bulk_write(pending_updates, ordered=False)
+                pending_updates = []
+
+    if pending_updates:
+        db.diplotype_probabilities.bulk_write(pending_updates, ordered=False)
 
 
 def main():
@@ -98,9 +230,14 @@ def main():
     parser.add_argument(
         'h5_file',
         help='the HDF file to import')
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='the number of processes used to read sample probabilities from the HDF file')
     args = parser.parse_args()
 
-    merge_h5(args.h5_file, True)
+    merge_h5(args.h5_file, True, workers=args.workers)
 
 
 if __name__ == '__main__':
@@ -1,9 +1,41 @@
+from bson.binary import Binary
+from bson.objectid import ObjectId
+from collections import OrderedDict
+import numpy as np
 import pymongo
 from haploqa.config import HAPLOQA_CONFIG
+import haploqa.haplohmm as hhmm
 from datetime import datetime
+import os
+import sys
+import threading
+import zlib
 
 DB_NAME = 'haploqa'
-SCHEMA_VERSION = 0, 0, 3
+SCHEMA_VERSION = 0, 0, 6
+
+# when true newly imported samples store their chromosome data in the packed binary
+# format (see pack_chr_data) rather than as lists of strings and doubles
+PACKED_CHROMOSOME_DATA = HAPLOQA_CONFIG.get('PACKED_CHROMOSOME_DATA', False)
+
+# the number of within_chr_index updates sent per bulk write by update_snp_indices
+SNP_INDEX_UPDATE_BATCH_SIZE = 10000
+
+# HMM posterior diplotype probabilities are split into chunks of at most this many bytes
+# so that chromosomes with many SNPs and diplotypes stay under the 16MB BSON document limit
+MAX_DIPLOTYPE_PROB_CHUNK_BYTES = 8 * 1024 * 1024
+
+# process-wide LRU cache of SNP annotation tables. This maps (platform_id, chromosome) to a
+# (platform_revision, snp_table) tuple. See get_snp_table
+SNP_TABLE_CACHE_SIZE = HAPLOQA_CONFIG.get('SNP_TABLE_CACHE_SIZE', 128)
+_snp_table_cache = OrderedDict()
+_snp_table_cache_lock = threading.Lock()
+
+# the process-wide MongoClient (see get_client). MongoClient instances are not fork-safe
+# so we also track the PID of the process that created the client
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
 
 
 def base10_id_to_alphabet_id(base10_id):
@@ -29,12 +61,28 @@ def gen_unique_id(db=None):
                 use the db returned from get_db()
     :return: the unique string ID
     """
+    return gen_unique_ids(1, db)[0]
+
+
+def gen_unique_ids(id_count, db=None):
+    """
+    Generate a block of unique IDs (see gen_unique_id). The whole block is reserved with a single
+    atomic increment so this is much cheaper than calling gen_unique_id repeatedly.
+
+    :param id_count: the number of IDs to generate
+    :param db: the DB that the generated IDs will be unique within. If this is None we
+                use the db returned from get_db()
+    :return: the list of unique string IDs
+    """
+    if id_count <= 0:
+        return []
+
     if db is None:
         db = get_db()
 
     meta_doc = db.meta.find_one_and_update(
         {},
-        {'$inc': {'unique_id_count': 1}},
+        {'$inc': {'unique_id_count': id_count}},
     )
 
     if 'unique_id_count' not in meta_doc:
@@ -42,7 +90,8 @@ def gen_unique_id(db=None):
         # we treat that as 0
         meta_doc['unique_id_count'] = 0
 
-    return base10_id_to_alphabet_id(meta_doc['unique_id_count'])
+    first_id = meta_doc['unique_id_count']
+    return [base10_id_to_alphabet_id(x) for x in range(first_id, first_id + id_count)]
 
 
 def version_to_str(vsn):
@@ -52,13 +101,64 @@ def version_to_str(vsn):
     return '.'.join(str(x) for x in vsn)
 
 
+def _client_options():
+    # we only pass along the options that are configured so that pymongo's defaults apply otherwise
+    config_options = [
+        ('DB_MAX_POOL_SIZE', 'maxPoolSize'),
+        ('DB_CONNECT_TIMEOUT_MS', 'connectTimeoutMS'),
+        ('DB_SOCKET_TIMEOUT_MS', 'socketTimeoutMS'),
+        ('DB_SERVER_SELECTION_TIMEOUT_MS', 'serverSelectionTimeoutMS'),
+        ('DB_READ_PREFERENCE', 'readPreference'),
+    ]
+
+    return {
+        client_key: HAPLOQA_CONFIG[config_key]
+        for config_key, client_key in config_options
+        if HAPLOQA_CONFIG.get(config_key) is not None
+    }
+
+
+def get_client():
+    """
+    Gets the MongoClient shared by the current process. The client maintains a connection pool so
+    it should be reused rather than creating a new client per request. If the process has been
+    forked since the client was created a new client is created for the child process.
+    :return: the client
+    """
+    global _client, _client_pid
+
+    with _client_lock:
+        pid = os.getpid()
+        if _client is None or _client_pid != pid:
+            _client = pymongo.MongoClient(
+                HAPLOQA_CONFIG['DB_HOST'],
+                HAPLOQA_CONFIG['DB_PORT'],
+                **_client_options()
+            )
+            _client_pid = pid
+
+        return _client
+
+
+def reset_client():
+    """
+    Discard the shared MongoClient so that the next call to get_client creates a new one. This should
+    be called in newly forked worker processes. We don't close the client since its sockets may still
+    be in use by the parent process
+    """
+    global _client, _client_pid
+
+    with _client_lock:
+        _client = None
+        _client_pid = None
+
+
 def get_db():
     """
     Gets a reference to the HaploQA database
     :return: the DB
     """
-    client = pymongo.MongoClient(HAPLOQA_CONFIG['DB_HOST'], HAPLOQA_CONFIG['DB_PORT'])
-    return client[DB_NAME]
+    return get_client()[DB_NAME]
 
 
 def get_schema_version(db=None):
@@ -81,11 +181,37 @@ def get_schema_version(db=None):
         return tuple(version_doc['schema_version'])
 
 
-def init_db(db=None):
+def create_snp_indexes(db=None):
+    """
+    Create the indexes for the SNP annotation collection. This is normally done by init_db but bulk
+    SNP imports can defer it until after the SNPs are loaded.
+    :param db: will be looked up via get_db() by default
+    """
+    if db is None:
+        db = get_db()
+
+    db.snps.create_index([
+        ('platform_id', pymongo.ASCENDING),
+        ('snp_id',      pymongo.ASCENDING),
+    ], unique=True)
+    db.snps.create_index([
+        ('platform_id', pymongo.ASCENDING),
+        ('chromosome',  pymongo.ASCENDING),
+        ('position_bp', pymongo.ASCENDING),
+        ('snp_id',      pymongo.ASCENDING),
+    ])
+    db.snps.create_index([
+        ('platform_id',       pymongo.ASCENDING),
+        ('engineered_target', pymongo.ASCENDING),
+    ])
+
+
+def init_db(db=None, snp_indexes=True):
     """
     Initialize the DB indexes. This function is safe to rerun on existing databases
     to make sure that all indexes are generated.
     :param db: will be looked up via get_db() by default
+    :param snp_indexes: if False the SNP annotation indexes are not created (see create_snp_indexes)
     :return: the database
     """
     if db is None:
@@ -93,6 +219,8 @@ def init_db(db=None):
 
     if not db.meta.count():
         db.meta.replace_one({}, {'schema_version': SCHEMA_VERSION}, upsert=True)
+    if snp_indexes:
+        create_snp_indexes(db)
     db.samples.create_index('sample_id', unique=True)
     db.samples.create_index('other_ids')
     db.samples.create_index('tags')
@@ -119,26 +247,33 @@ def init_db(db=None):
         name='sample_text_idx',
     )
     db.platforms.create_index('platform_id')
-    db.snps.create_index([
-        ('platform_id', pymongo.ASCENDING),
-        ('snp_id',      pymongo.ASCENDING),
+    db.platform_snp_indexes.create_index('platform_id', unique=True)
+    db.gemm_control_models.create_index([
+        ('platform_id',         pymongo.ASCENDING),
+        ('engineered_target',   pymongo.ASCENDING),
     ], unique=True)
-    db.snps.create_index([
-        ('platform_id', pymongo.ASCENDING),
-        ('chromosome',  pymongo.ASCENDING),
-        ('position_bp', pymongo.ASCENDING),
-        ('snp_id',      pymongo.ASCENDING),
-    ])
-    db.snps.create_index([
-        ('platform_id',       pymongo.ASCENDING),
-        ('engineered_target', pymongo.ASCENDING),
+    # GEMM screen results are kept for GEMM_SCREEN_TTL_DAYS after which mongo removes them
+    gemm_screen_ttl_secs = int(HAPLOQA_CONFIG.get('GEMM_SCREEN_TTL_DAYS', 7) * 24 * 60 * 60)
+    db.gemm_screens.create_index('task_id')
+    db.gemm_screens.create_index('created', expireAfterSeconds=gemm_screen_ttl_secs)
+    db.gemm_screen_rows.create_index([
+        ('task_id',     pymongo.ASCENDING),
+        ('start_row',   pymongo.ASCENDING),
     ])
+    db.gemm_screen_rows.create_index('created', expireAfterSeconds=gemm_screen_ttl_secs)
+    db.candidate_search_cache.create_index('cache_key', unique=True)
+    db.candidate_search_cache.create_index('last_access')
     db.users.create_index('email_address_lowercase', unique=True)
     db.users.create_index('password_reset_hash')
     db.diplotype_probabilities.create_index([
         ('sample_id',   pymongo.ASCENDING),
         ('chromosome',  pymongo.ASCENDING)
     ])
+    db.hmm_diplotype_probabilities.create_index([
+        ('sample_id',   pymongo.ASCENDING),
+        ('chromosome',  pymongo.ASCENDING),
+        ('write_id',    pymongo.DESCENDING),
+    ])
     db.standard_designations.create_index('standard_designation')
 
     return db
@@ -192,10 +327,112 @@ def hap_cands_by_strain(strain_name, platform, db=None):
         return 'result: {}'.format(len(res))
 
 
+def get_platform_revision(platform_id, db=None):
+    """
+    Get the revision counter of the given platform. The revision is incremented any time the
+    platform's SNP annotations change and is used to invalidate cached annotations
+    :param platform_id: the platform ID
+    :param db: the DB (by default we look up the DB using get_db()
+    :return: the revision (platforms without a revision counter are at revision 0)
+    """
+    if db is None:
+        db = get_db()
+
+    platform_obj = db.platforms.find_one({'platform_id': platform_id}, {'revision': 1})
+    if platform_obj is None:
+        return 0
+    else:
+        return platform_obj.get('revision', 0)
+
+
+def bump_platform_revision(platform_id, db=None):
+    """
+    Increment the revision counter of the given platform. This must be called after modifying the
+    platform's SNP annotations so that cached copies get reloaded
+    :param platform_id: the platform ID
+    :param db: the DB (by default we look up the DB using get_db()
+    """
+    if db is None:
+        db = get_db()
+
+    db.platforms.update_one({'platform_id': platform_id}, {'$inc': {'revision': 1}})
+
+
+def _load_snp_table(platform_id, chromosome, db):
+    snps = list(db.snps.find(
+        {'platform_id': platform_id, 'chromosome': chromosome},
+        {'_id': 0, 'snp_id': 1, 'chromosome': 1, 'position_bp': 1, 'x_probe_call': 1, 'y_probe_call': 1},
+    ).sort([
+        ('position_bp', pymongo.ASCENDING),
+        ('snp_id', pymongo.ASCENDING),
+    ]))
+
+    def str_dtype(key):
+        return 'U{}'.format(max([1] + [len(snp[key]) for snp in snps]))
+
+    snp_table = np.array(
+        [
+            (snp['snp_id'], snp['chromosome'], snp['position_bp'], snp['x_probe_call'], snp['y_probe_call'])
+            for snp in snps
+        ],
+        dtype=[
+            ('snp_id', str_dtype('snp_id')),
+            ('chromosome', str_dtype('chromosome')),
+            ('position_bp', np.int64),
+            ('x_probe_call', str_dtype('x_probe_call')),
+            ('y_probe_call', str_dtype('y_probe_call')),
+        ],
+    )
+    snp_table.setflags(write=False)
+
+    return snp_table
+
+
+def get_snp_table(platform_id, chromosome, db=None):
+    """
+    Get the SNP annotations for a chromosome as a numpy structured array with 'snp_id', 'chromosome',
+    'position_bp', 'x_probe_call' and 'y_probe_call' fields, ordered the same way as get_snps.
+    Tables are cached for the life of the process and reloaded when the platform revision changes
+    (see bump_platform_revision) so the returned array is read-only.
+    :param platform_id: the platform to get SNPs for. Eg. "GigaMUGA"
+    :param chromosome: the chromosome to grab SNPs for
+    :param db: the DB (by default we look up the DB using get_db()
+    :return: the SNP table
+    """
+    if db is None:
+        db = get_db()
+
+    cache_key = platform_id, chromosome
+    revision = get_platform_revision(platform_id, db)
+    with _snp_table_cache_lock:
+        cached_revision, snp_table = _snp_table_cache.get(cache_key, (None, None))
+        if cached_revision == revision:
+            _snp_table_cache.move_to_end(cache_key)
+            return snp_table
+
+    snp_table = _load_snp_table(platform_id, chromosome, db)
+    with _snp_table_cache_lock:
+        _snp_table_cache[cache_key] = revision, snp_table
+        _snp_table_cache.move_to_end(cache_key)
+        while len(_snp_table_cache) > SNP_TABLE_CACHE_SIZE:
+            _snp_table_cache.popitem(last=False)
+
+    return snp_table
+
+
+def snp_table_to_dicts(snp_table):
+    """
+    Convert a SNP table (see get_snp_table) into a list of SNP annotation dicts
+    """
+    field_names = snp_table.dtype.names
+    return [dict(zip(field_names, snp)) for snp in snp_table.tolist()]
+
+
 def get_snps(platform_id, chromosome, db=None):
     """
     Grab the SNP annotations from the DB. These will be returned in order (sorted by position then by ID). This
-    is the same ordering used by the SNP arrays in samples
+    is the same ordering used by the SNP arrays in samples. Callers that only need the 'snp_id', 'chromosome',
+    'position_bp', 'x_probe_call' and 'y_probe_call' values should use the cached get_snp_table instead
     :param platform_id: the platform to get SNPs for. Eg. "GigaMUGA"
     :param chromosome: the chromosome to grab SNPs for
     :param db: the DB (by default we look up the DB using get_db()
@@ -210,104 +447,875 @@ def get_snps(platform_id, chromosome, db=None):
     ])
 
 
-def post_proc_sample(sample, user_email):
+def float_array_to_binary(float_array):
+    """
+    Pack the given numeric array into a BSON binary value holding little-endian float32
+    values in row-major order. This is much more compact than a (nested) list of doubles
+    :param float_array: the numeric array to pack
+    :return: the BSON binary value
+    """
+    return Binary(np.ascontiguousarray(float_array, dtype='<f4').tobytes())
+
+
+def binary_to_float_array(binary_val, row_length=None):
+    """
+    The inverse of float_array_to_binary. The returned array is a read-only view of the
+    binary value's buffer (no copy is made)
+    :param binary_val: the binary value to unpack
+    :param row_length: if not None the result is reshaped into a 2D array with this many columns
+    :return: the float32 numpy array
+    """
+    float_array = np.frombuffer(binary_val, dtype='<f4')
+    if row_length is not None:
+        float_array = float_array.reshape((-1, row_length))
+
+    return float_array
+
+
+def get_diplotype_probabilities(diplotype_prob_doc):
+    """
+    Extract the diplotype probability matrix from a document in the diplotype_probabilities
+    collection. Older documents store probabilities as nested lists while newer ones store
+    them as packed float32 binary values. In either case a 2D numpy array is returned
+    where rows correspond to SNPs and columns correspond to diplotype_strains.
+    :param diplotype_prob_doc: the document from the diplotype_probabilities collection
+    :return: the (# SNPs, # diplotypes) probability matrix
+    """
+    probs = diplotype_prob_doc['diplotype_probabilities']
+    if isinstance(probs, bytes):
+        return binary_to_float_array(probs, len(diplotype_prob_doc['diplotype_strains']))
+    else:
+        return np.array(probs, dtype=np.float64)
+
+
+def save_hmm_diplotype_probabilities(sample, chr_id, diplotype_strains, probs, db=None):
+    """
+    Save the HMM posterior diplotype probabilities of a sample chromosome to the hmm_diplotype_probabilities
+    collection replacing any previously saved probabilities. These are kept apart from the imported
+    probabilities in the diplotype_probabilities collection. The probability matrix is split into chunks of
+    consecutive SNPs (see MAX_DIPLOTYPE_PROB_CHUNK_BYTES) which are all tagged with the same write_id
+    :param sample: the sample dict (with 'sample_id' and 'platform_id')
+    :param chr_id: the chromosome
+    :param diplotype_strains: the strain pair of each diplotype (the columns of probs)
+    :param probs: the (# SNPs, # diplotypes) probability matrix
+    :param db: the DB (by default we look up the DB using get_db()
+    """
+    if db is None:
+        db = get_db()
+
+    snp_count, diplotype_count = probs.shape
+    chunk_snp_count = max(1, MAX_DIPLOTYPE_PROB_CHUNK_BYTES // (4 * max(1, diplotype_count)))
+    write_id = ObjectId()
+    chunk_docs = [
+        {
+            'sample_id': sample['sample_id'],
+            'chromosome': chr_id,
+            'platform_id': sample['platform_id'],
+            'write_id': write_id,
+            'start_snp_index': start_index,
+            'snp_count': snp_count,
+            'diplotype_strains': diplotype_strains,
+            'diplotype_probabilities': float_array_to_binary(probs[start_index:start_index + chunk_snp_count]),
+        }
+        for start_index in range(0, max(1, snp_count), chunk_snp_count)
+    ]
+
+    # the new chunks are written before the old ones are removed so readers always find a complete write
+    db.hmm_diplotype_probabilities.insert_many(chunk_docs)
+    db.hmm_diplotype_probabilities.delete_many({
+        'sample_id': sample['sample_id'],
+        'chromosome': chr_id,
+        'write_id': {'$ne': write_id},
+    })
+
+
+def get_hmm_diplotype_probabilities(sample_id, chr_id, db=None):
+    """
+    Load HMM posterior diplotype probabilities saved with save_hmm_diplotype_probabilities
+    :param sample_id: the sample's sample_id
+    :param chr_id: the chromosome
+    :param db: the DB (by default we look up the DB using get_db()
+    :return:
+        the (platform_id, diplotype_strains, probs) tuple where probs is the (# SNPs, # diplotypes)
+        matrix or None if no probabilities have been saved
+    """
+    if db is None:
+        db = get_db()
+
+    latest_chunk = db.hmm_diplotype_probabilities.find_one(
+        {'sample_id': sample_id, 'chromosome': chr_id},
+        {'write_id': 1},
+        sort=[('write_id', pymongo.DESCENDING)],
+    )
+    if latest_chunk is None:
+        return None
+
+    chunks = list(db.hmm_diplotype_probabilities.find(
+        {'sample_id': sample_id, 'chromosome': chr_id, 'write_id': latest_chunk['write_id']},
+    ).sort('start_snp_index', pymongo.ASCENDING))
+    diplotype_strains = chunks[0]['diplotype_strains']
+    probs = np.concatenate([
+        binary_to_float_array(chunk['diplotype_probabilities'], len(diplotype_strains))
+        for chunk in chunks
+    ])
+    if len(probs) != chunks[0]['snp_count']:
+        raise Exception('incomplete diplotype probabilities for sample "{}", chr "{}"'.format(sample_id, chr_id))
+
+    return chunks[0]['platform_id'], diplotype_strains, probs
+
+
+def snp_probe_calls(snps):
+    """
+    Extract the probe calls from the given SNP annotations
+    :param snps: the SNP annotations (as returned by get_snps or get_snp_table)
+    :return: the tuple (x_calls, y_calls) of numpy string arrays
+    """
+    if isinstance(snps, np.ndarray):
+        return snps['x_probe_call'], snps['y_probe_call']
+
+    x_calls = []
+    y_calls = []
+    for snp in snps:
+        x_calls.append(snp['x_probe_call'])
+        y_calls.append(snp['y_probe_call'])
+
+    return np.array(x_calls), np.array(y_calls)
+
+
+def get_snp_calls(platform_id, db=None):
+    """
+    Get the probe calls for all chromosomes of a platform
+    :param platform_id: the platform to get probe calls for
+    :param db: the DB (by default we look up the DB using get_db()
+    :return: a dict mapping chromosome to the (x_calls, y_calls) tuple returned by snp_probe_calls
+    """
+    if db is None:
+        db = get_db()
+
+    platform_obj = db.platforms.find_one({'platform_id': platform_id})
+    if platform_obj is None:
+        raise Exception('failed to find a platform named "{}".'.format(platform_id))
+
+    return {
+        chr: snp_probe_calls(get_snp_table(platform_id, chr, db))
+        for chr in platform_obj['chromosomes']
+    }
+
+
+def is_packed_chr_data(chr_dict):
+    """
+    Returns true if the given sample chromosome data is stored in the packed binary format
+    """
+    return 'call_format' in chr_dict
+
+
+def uses_snp_format(chr_dict):
+    """
+    Returns true if the given sample chromosome data uses single SNP calls (the 'snps' attribute)
+    rather than forward allele calls (the 'allele1_fwds' and 'allele2_fwds' attributes)
+    """
+    return 'snps' in chr_dict or chr_dict.get('call_format') == 'snps'
+
+
+def _encode_calls(calls):
+    """
+    Exactly encode an array of call strings as the sorted list of distinct calls (the alphabet)
+    along with one byte per call indexing into that alphabet
+    :param calls: the call strings
+    :return: the tuple (call_alphabet, call_codes)
+    """
+    call_alphabet, call_codes = np.unique(np.array(calls, dtype=str).ravel(), return_inverse=True)
+    if len(call_alphabet) > 256:
+        raise Exception('cannot encode more than 256 distinct calls per chromosome')
+
+    return call_alphabet.tolist(), Binary(call_codes.astype(np.uint8).tobytes())
+
+
+def packed_chr_calls(chr_dict):
+    """
+    Decode the nucleotide calls of packed sample chromosome data (see pack_chr_data)
+    :param chr_dict: the packed chromosome data dict
+    :return:
+        a dict holding the 'snps' call list or the 'allele1_fwds' and 'allele2_fwds' call lists
+        depending on the chromosome's call format. If the data was packed without its calls
+        (older versions of pack_chr_data did this) None is returned
+    """
+    if 'call_codes' not in chr_dict:
+        return None
+
+    call_alphabet = np.array(chr_dict['call_alphabet'], dtype=str)
+    calls = call_alphabet[np.frombuffer(chr_dict['call_codes'], dtype=np.uint8)]
+    if chr_dict['call_format'] == 'snps':
+        return {'snps': calls.tolist()}
+    else:
+        calls = calls.reshape(-1, 2)
+        return {
+            'allele1_fwds': calls[:, 0].tolist(),
+            'allele2_fwds': calls[:, 1].tolist(),
+        }
+
+
+def pack_chr_data(chr_dict, x_calls, y_calls):
+    """
+    Convert the given sample chromosome data into the packed binary format. In this format the
+    nucleotide call lists are replaced by an exact one byte per call encoding ('call_alphabet' and
+    'call_codes', see packed_chr_calls) along with 2-bit packed AB codes ('ab_codes') and the
+    intensity lists ('xs' and 'ys') are replaced by packed float32 values. Calls that don't match
+    the SNP probe calls get an AB code of N but the call itself is kept. This function modifies chr_dict.
+    :param chr_dict: the chromosome data dict to convert
+    :param x_calls: the x probe calls for the chromosome
+    :param y_calls: the y probe calls for the chromosome
+    """
+    if 'snps' in chr_dict:
+        call_format = 'snps'
+        calls = chr_dict['snps']
+    else:
+        call_format = 'allele_fwds'
+        calls = np.stack(
+            [np.array(chr_dict['allele1_fwds'], dtype=str), np.array(chr_dict['allele2_fwds'], dtype=str)],
+            axis=1)
+    ab_codes = hhmm.chr_data_to_ab_codes(chr_dict, x_calls, y_calls)
+    ab_codes[ab_codes == 255] = hhmm.N_CODE
+
+    for call_key in ('snps', 'allele1_fwds', 'allele2_fwds'):
+        chr_dict.pop(call_key, None)
+    chr_dict['call_format'] = call_format
+    chr_dict['call_alphabet'], chr_dict['call_codes'] = _encode_calls(calls)
+    chr_dict['snp_count'] = len(ab_codes)
+    chr_dict['ab_codes'] = Binary(hhmm.pack_ab_codes(ab_codes))
+    chr_dict['xs'] = float_array_to_binary(chr_dict['xs'])
+    chr_dict['ys'] = float_array_to_binary(chr_dict['ys'])
+
+
+def pack_samples(platform_id, db=None):
+    """
+    Convert the chromosome data of all samples on the given platform that are stored as call lists
+    into the packed binary format (see pack_chr_data). Packing is lossless so the call lists can always
+    be recovered with unpack_chr_data
+    :param platform_id: the platform whose samples should be packed
+    :param db: the DB (by default we look up the DB using get_db()
+    :return: the number of samples that were packed
+    """
+    if db is None:
+        db = get_db()
+
+    snp_calls = get_snp_calls(platform_id, db)
+    pack_count = 0
+    sample_ids = [x['_id'] for x in db.samples.find({'platform_id': platform_id}, {'_id': 1})]
+    for sample_id in sample_ids:
+        sample = db.samples.find_one({'_id': sample_id}, {'sample_id': 1, 'chromosome_data': 1})
+        set_dict = dict()
+        for chr, chr_dict in sample.get('chromosome_data', {}).items():
+            if not is_packed_chr_data(chr_dict) and chr in snp_calls:
+                x_calls, y_calls = snp_calls[chr]
+                pack_chr_data(chr_dict, x_calls, y_calls)
+                set_dict['chromosome_data.' + chr] = chr_dict
+
+        if set_dict:
+            print('packing chromosome data for sample:', sample['sample_id'])
+            set_dict['calls_revision'] = ObjectId()
+            db.samples.update_one({'_id': sample_id}, {'$set': set_dict})
+            pack_count += 1
+
+    return pack_count
+
+
+def set_chr_ab_codes(chr_dict, x_calls, y_calls):
+    """
+    Compute AB codes for sample chromosome data and cache them on the chromosome data (as 'ab_codes'
+    and 'snp_count') so that the HMM code paths don't have to convert nucleotide calls on every request.
+    The calls themselves are left in place. This works for both the list and packed formats. This function
+    modifies chr_dict.
+    :param chr_dict: the chromosome data dict
+    :param x_calls: the x probe calls for the chromosome
+    :param y_calls: the y probe calls for the chromosome
+    :return: True if the codes were set or False if the chromosome data is packed without its calls
+    """
+    if is_packed_chr_data(chr_dict):
+        chr_calls = packed_chr_calls(chr_dict)
+        if chr_calls is None:
+            return False
+    else:
+        chr_calls = {k: v for k, v in chr_dict.items() if k != 'ab_codes'}
+
+    ab_codes = hhmm.chr_data_to_ab_codes(chr_calls, x_calls, y_calls)
+    ab_codes[ab_codes == 255] = hhmm.N_CODE
+
+    chr_dict['snp_count'] = len(ab_codes)
+    chr_dict['ab_codes'] = Binary(hhmm.pack_ab_codes(ab_codes))
+
+    return True
+
+
+def update_ab_codes(platform_id, db=None):
+    """
+    Recompute the cached AB codes of all samples on the given platform from their nucleotide calls.
+    This should be run whenever the platform's SNP annotations change. Packed chromosome data that was
+    stored without its calls (see packed_chr_calls) can't be recomputed so it is reported and skipped
+    :param platform_id: the platform whose samples should be updated
+    :param db: the DB (by default we look up the DB using get_db()
+    :return: the number of samples that were updated
+    """
+    if db is None:
+        db = get_db()
+
+    snp_calls = get_snp_calls(platform_id, db)
+    update_count = 0
+    sample_ids = [x['_id'] for x in db.samples.find({'platform_id': platform_id}, {'_id': 1})]
+    for sample_id in sample_ids:
+        sample = db.samples.find_one({'_id': sample_id}, {'sample_id': 1, 'chromosome_data': 1})
+        set_dict = dict()
+        for chr, chr_dict in sample.get('chromosome_data', {}).items():
+            if chr in snp_calls:
+                x_calls, y_calls = snp_calls[chr]
+                if set_chr_ab_codes(chr_dict, x_calls, y_calls):
+                    set_dict['chromosome_data.' + chr + '.ab_codes'] = chr_dict['ab_codes']
+                    set_dict['chromosome_data.' + chr + '.snp_count'] = chr_dict['snp_count']
+                else:
+                    print(
+                        'failed to update AB codes for sample "{}", chr "{}". '
+                        'The packed chromosome data has no calls. Re-import the sample.'.format(
+                            sample['sample_id'],
+                            chr),
+                        file=sys.stderr)
+
+        if set_dict:
+            set_dict['calls_revision'] = ObjectId()
+            db.samples.update_one({'_id': sample_id}, {'$set': set_dict})
+            update_count += 1
+
+    return update_count
+
+
+def ab_code_projection(chr_id):
+    """
+    Get the projection needed to load the cached AB codes for a sample chromosome. Use this with
+    load_missing_chr_calls so that samples without cached codes still work
+    :param chr_id: the chromosome
+    :return: the projection dict
+    """
+    return {
+        'chromosome_data.' + chr_id + '.ab_codes': 1,
+        'chromosome_data.' + chr_id + '.snp_count': 1,
+    }
+
+
+def load_missing_chr_calls(samples, chr_id, db=None):
+    """
+    For any of the given samples that were loaded without cached AB codes for the chromosome (see
+    ab_code_projection) we fall back to loading the nucleotide call lists. This function modifies the
+    sample dicts.
+    :param samples: the sample dicts. Each must contain its '_id'
+    :param chr_id: the chromosome
+    :param db: the DB (by default we look up the DB using get_db()
+    """
+    missing_samples = {
+        sample['_id']: sample
+        for sample in samples
+        if 'ab_codes' not in sample.get('chromosome_data', {}).get(chr_id, {})
+    }
+    if missing_samples:
+        if db is None:
+            db = get_db()
+
+        chr_calls = db.samples.find(
+            {'_id': {'$in': list(missing_samples.keys())}},
+            {
+                'chromosome_data.' + chr_id + '.allele1_fwds': 1,
+                'chromosome_data.' + chr_id + '.allele2_fwds': 1,
+                'chromosome_data.' + chr_id + '.snps': 1,
+            },
+        )
+        for chr_call_sample in chr_calls:
+            sample = missing_samples[chr_call_sample['_id']]
+            sample.setdefault('chromosome_data', dict()).update(chr_call_sample.get('chromosome_data', {}))
+
+
+def unpack_chr_data(chr_dict, snps):
+    """
+    Convert packed sample chromosome data back into the list representation so that calls can be
+    reported as nucleotides. If chr_dict is not packed it is returned as-is.
+    :param chr_dict: the chromosome data dict
+    :param snps: the SNP annotations for the chromosome (as returned by get_snps)
+    :return: a chromosome data dict with 'snps' or 'allele1_fwds'/'allele2_fwds' lists
+    """
+    if not is_packed_chr_data(chr_dict):
+        return chr_dict
+
+    unpacked_chr_dict = {
+        k: v for k, v in chr_dict.items()
+        if k not in {'ab_codes', 'call_format', 'call_alphabet', 'call_codes', 'snp_count'}
+    }
+    unpacked_chr_dict['xs'] = chr_intensities(chr_dict, 'xs').tolist()
+    unpacked_chr_dict['ys'] = chr_intensities(chr_dict, 'ys').tolist()
+
+    chr_calls = packed_chr_calls(chr_dict)
+    if chr_calls is not None:
+        unpacked_chr_dict.update(chr_calls)
+        return unpacked_chr_dict
+
+    # the data was packed without its calls so the best we can do is rebuild them
+    # from the AB codes. Note that het allele order is lost in this case
+    x_calls, y_calls = snp_probe_calls(snps)
+    ab_codes = hhmm.unpack_ab_codes(chr_dict['ab_codes'], chr_dict['snp_count'])
+    is_a = ab_codes == hhmm.A_CODE
+    is_b = ab_codes == hhmm.B_CODE
+    is_h = ab_codes == hhmm.H_CODE
+    if chr_dict['call_format'] == 'snps':
+        unpacked_chr_dict['snps'] = np.select([is_a, is_b, is_h], [x_calls, y_calls, 'H'], '-').tolist()
+    else:
+        unpacked_chr_dict['allele1_fwds'] = np.select([is_a | is_h, is_b], [x_calls, y_calls], '-').tolist()
+        unpacked_chr_dict['allele2_fwds'] = np.select([is_a, is_b | is_h], [x_calls, y_calls], '-').tolist()
+
+    return unpacked_chr_dict
+
+
+def chr_intensities(chr_dict, intens_key):
+    """
+    Get probe intensities from sample chromosome data as a numpy array
+    :param chr_dict: the chromosome data dict
+    :param intens_key: either 'xs' or 'ys'
+    :return: the intensity array. For packed data this is a read-only view of the binary value
+    """
+    intens = chr_dict[intens_key]
+    if isinstance(intens, bytes):
+        return binary_to_float_array(intens)
+    else:
+        return np.array(intens, dtype=np.float64)
+
+
+def get_gemm_anno(platform_id, db=None):
+    """
+    Get the GEMM (genetically engineered mouse model) SNP annotations for a platform. The returned
+    dict holds the platform 'revision' that the annotations were read at along with the 'snps' that
+    target an engineered construct (each having 'snp_id', 'chromosome', 'within_chr_index' and
+    'informative_axis')
+    :param platform_id: the platform ID
+    :param db: the DB (by default we look up the DB using get_db()
+    :return: the GEMM annotation dict
+    """
+    if db is None:
+        db = get_db()
+
+    # the revision is read first so that a concurrent annotation change can only make us look stale
+    revision = get_platform_revision(platform_id, db)
+    gemm_snps = db.snps.find(
+        {'platform_id': platform_id, 'engineered_target': {'$exists': True}, 'within_chr_index': {'$exists': True}},
+        {'_id': 0, 'snp_id': 1, 'chromosome': 1, 'within_chr_index': 1, 'informative_axis': 1},
+    ).sort('snp_id', pymongo.ASCENDING)
+
+    return {'revision': revision, 'snps': list(gemm_snps)}
+
+
+def gemm_intensities_projection(gemm_anno):
+    """
+    Get the projection needed to load just the chromosome intensities that sample_gemm_intensities uses
+    :param gemm_anno: the GEMM annotations as returned by get_gemm_anno
+    :return: the projection dict
+    """
+    projection = {'platform_id': 1}
+    for gemm_snp in gemm_anno['snps']:
+        intens_key = 'xs' if gemm_snp['informative_axis'] == 'X' else 'ys'
+        projection['chromosome_data.' + gemm_snp['chromosome'] + '.' + intens_key] = 1
+
+    return projection
+
+
+def sample_gemm_intensities(sample, gemm_anno):
+    """
+    Extract the informative axis intensity of every GEMM SNP from a sample's chromosome data. The result
+    is stored with the sample as its 'gemm_intensities' so that GEMM inference doesn't need to load the
+    chromosome data. Intensities of chromosomes that the sample is missing are NaN
+    :param sample: the sample dict which must contain the chromosome data needed by the GEMM SNPs
+    :param gemm_anno: the GEMM annotations for the sample's platform as returned by get_gemm_anno
+    :return: the GEMM intensities dict
+    """
+    chr_data = sample.get('chromosome_data', {})
+    intensities = []
+    for gemm_snp in gemm_anno['snps']:
+        intens_key = 'xs' if gemm_snp['informative_axis'] == 'X' else 'ys'
+        chr_dict = chr_data.get(gemm_snp['chromosome'], {})
+        if intens_key in chr_dict:
+            intensities.append(float(chr_intensities(chr_dict, intens_key)[gemm_snp['within_chr_index']]))
+        else:
+            intensities.append(float('nan'))
+
+    return {
+        'platform_revision': gemm_anno['revision'],
+        'snp_ids': [gemm_snp['snp_id'] for gemm_snp in gemm_anno['snps']],
+        'intensities': intensities,
+    }
+
+
+def load_gemm_intensities(samples, db=None, gemm_annos=None):
+    """
+    Make sure that all of the given samples have up to date 'gemm_intensities'. Samples which were imported
+    before the GEMM intensities were stored, or whose platform annotations have changed since, get their
+    intensities recomputed from just the chromosome data that's needed and the result is saved back to the DB.
+    This function modifies the sample dicts.
+    :param samples: the sample dicts. Each must contain its '_id', 'platform_id' and 'gemm_intensities' (if it has any)
+    :param db: the DB (by default we look up the DB using get_db()
+    :param gemm_annos: an optional dict of GEMM annotations keyed on platform ID which is filled in as needed
+    """
+    if db is None:
+        db = get_db()
+    if gemm_annos is None:
+        gemm_annos = dict()
+
+    for platform_id in set(sample['platform_id'] for sample in samples):
+        if platform_id not in gemm_annos:
+            gemm_annos[platform_id] = get_gemm_anno(platform_id, db)
+
+    stale_samples = {
+        sample['_id']: sample
+        for sample in samples
+        if sample.get('gemm_intensities', {}).get('platform_revision') != gemm_annos[sample['platform_id']]['revision']
+    }
+    if stale_samples:
+        platform_ids = set(sample['platform_id'] for sample in stale_samples.values())
+        for platform_id in platform_ids:
+            gemm_anno = gemm_annos[platform_id]
+            chr_samples = db.samples.find(
+                {'_id': {'$in': list(stale_samples.keys())}, 'platform_id': platform_id},
+                gemm_intensities_projection(gemm_anno),
+            )
+            for chr_sample in chr_samples:
+                gemm_intens = sample_gemm_intensities(chr_sample, gemm_anno)
+                db.samples.update_one({'_id': chr_sample['_id']}, {'$set': {'gemm_intensities': gemm_intens}})
+                stale_samples[chr_sample['_id']]['gemm_intensities'] = gemm_intens
+
+
+def post_proc_sample(sample, user_email, snp_calls=None, gemm_anno=None):
     """
     Post-process a sample dict after it's loaded from a data source but before it's inserted into the DB. This adds some
     default values and performs some simple calculations. This function will modify the sample by adding new attributes.
     :param sample: the sample dict to modify
+    :param user_email: the email of the user doing the import
+    :param snp_calls:
+        the platform probe calls as returned by get_snp_calls. If this is supplied the AB codes of each
+        chromosome are computed and stored with the sample. If PACKED_CHROMOSOME_DATA is set the chromosome
+        data will also be converted into the packed binary format
+    :param gemm_anno:
+        the platform GEMM annotations as returned by get_gemm_anno. If this is supplied the sample's
+        GEMM intensities are extracted and stored with the sample (see sample_gemm_intensities)
     """
     print('post-processing sample: ' + sample['sample_id'])
 
     sample['last_update'] = '{:%m/%d/%Y %H:%M %p} EST'.format(datetime.now())
     sample['updated_by'] = user_email
 
+    # last_update only has minute resolution so every write of a sample's chromosome data
+    # also gets a new calls_revision which caches of the calls can be keyed on
+    sample['calls_revision'] = ObjectId()
+
     sample['homozygous_count'] = 0
     sample['heterozygous_count'] = 0
     sample['no_read_count'] = 0
     sample['contributing_strains'] = []
 
-    for chr_dict in sample['chromosome_data'].values():
-        chr_dict['homozygous_count'] = 0
-        chr_dict['heterozygous_count'] = 0
-        chr_dict['no_read_count'] = 0
-
+    valid_nucs = ['G', 'A', 'T', 'C']
+    for chr, chr_dict in sample['chromosome_data'].items():
         try:
-            allele1_fwds = chr_dict['allele1_fwds']
-            allele2_fwds = chr_dict['allele2_fwds']
-            for i in range(len(allele1_fwds)):
-                if allele1_fwds[i] == '-' or allele2_fwds[i] == '-':
-                    chr_dict['no_read_count'] += 1
-                elif allele1_fwds[i] == allele2_fwds[i]:
-                    chr_dict['homozygous_count'] += 1
-                else:
-                    chr_dict['heterozygous_count'] += 1
+            allele1_fwds = np.array(chr_dict['allele1_fwds'])
+            allele2_fwds = np.array(chr_dict['allele2_fwds'])
+            is_no_read = np.logical_or(allele1_fwds == '-', allele2_fwds == '-')
+            is_homozygous = np.logical_and(np.logical_not(is_no_read), allele1_fwds == allele2_fwds)
+            is_heterozygous = np.logical_not(np.logical_or(is_no_read, is_homozygous))
         except KeyError:
-            valid_nucs = {'G', 'A', 'T', 'C'}
-            snps = chr_dict['snps']
-            for snp in snps:
-                if snp in valid_nucs:
-                    chr_dict['homozygous_count'] += 1
-                elif snp == '-':
-                    chr_dict['no_read_count'] += 1
-                elif snp == 'H':
-                    chr_dict['heterozygous_count'] += 1
-                else:
-                    raise Exception('unexpected SNP code: {}'.format(snp))
+            snps = np.array(chr_dict['snps'])
+            is_homozygous = np.isin(snps, valid_nucs)
+            is_no_read = snps == '-'
+            is_heterozygous = snps == 'H'
+            is_unexpected = np.logical_not(is_homozygous | is_no_read | is_heterozygous)
+            if np.any(is_unexpected):
+                raise Exception('unexpected SNP code: {}'.format(snps[is_unexpected][0]))
+
+        chr_dict['homozygous_count'] = int(np.count_nonzero(is_homozygous))
+        chr_dict['heterozygous_count'] = int(np.count_nonzero(is_heterozygous))
+        chr_dict['no_read_count'] = int(np.count_nonzero(is_no_read))
 
         sample['homozygous_count'] += chr_dict['homozygous_count']
         sample['heterozygous_count'] += chr_dict['heterozygous_count']
         sample['no_read_count'] += chr_dict['no_read_count']
 
+        if snp_calls is not None:
+            x_calls, y_calls = snp_calls[chr]
+            if PACKED_CHROMOSOME_DATA:
+                pack_chr_data(chr_dict, x_calls, y_calls)
+            else:
+                set_chr_ab_codes(chr_dict, x_calls, y_calls)
+
+        # importers may build chromosome data as numpy arrays but the DB needs lists
+        for key, val in chr_dict.items():
+            if isinstance(val, np.ndarray):
+                chr_dict[key] = val.tolist()
 
-def update_snp_indices(db=None):
+    if gemm_anno is not None:
+        sample['gemm_intensities'] = sample_gemm_intensities(sample, gemm_anno)
+
+
+def update_snp_indices(db=None, platform_id=None):
+    """
+    Make sure that the within_chr_index of every SNP matches its position in the ordering used by
+    get_snps. Each platform is read in a single sorted scan and only the SNPs whose index has
+    changed are written (in bulk), so this is cheap to rerun after annotation edits.
+    :param db: the DB (by default we look up the DB using get_db()
+    :param platform_id: the platform to update. If None all platforms are updated
+    :return: the number of SNPs whose index changed
+    """
     if db is None:
         db = get_db()
 
-    for platform in db.platforms.find():
-        for chr in platform['chromosomes']:
-            for i, snp in enumerate(get_snps(platform['platform_id'], chr, db)):
-                db.snps.update_one(
+    platform_query = {} if platform_id is None else {'platform_id': platform_id}
+
+    change_count = 0
+    pending_updates = []
+    for platform in db.platforms.find(platform_query, {'platform_id': 1}):
+        platform_change_count = change_count + len(pending_updates)
+        platform_snps = db.snps.find(
+            {'platform_id': platform['platform_id']},
+            {'chromosome': 1, 'within_chr_index': 1},
+        ).sort([
+            ('chromosome', pymongo.ASCENDING),
+            ('position_bp', pymongo.ASCENDING),
+            ('snp_id', pymongo.ASCENDING),
+        ])
+
+        prev_chr = None
+        snp_index = 0
+        for snp in platform_snps:
+            if snp['chromosome'] != prev_chr:
+                prev_chr = snp['chromosome']
+                snp_index = 0
+
+            if snp.get('within_chr_index') != snp_index:
+                pending_updates.append(pymongo.UpdateOne(
                     {'_id': snp['_id']},
-                    {'$set': {'within_chr_index': i}},
-                )
+                    {'$set': {'within_chr_index': snp_index}},
+                ))
+                if len(pending_updates) >= SNP_INDEX_UPDATE_BATCH_SIZE:
+                    db.snps.bulk_write(pending_updates, ordered=False)
+                    change_count += len(pending_updates)
+                    pending_updates = []
 
+            snp_index += 1
 
-def within_chr_snp_indices(platform_id, db=None):
+        if change_count + len(pending_updates) != platform_change_count:
+            # the SNP ordering changed so anything derived from it needs to be refreshed
+            bump_platform_revision(platform['platform_id'], db)
 
-    if db is None:
-        db = get_db()
+    if pending_updates:
+        db.snps.bulk_write(pending_updates, ordered=False)
+        change_count += len(pending_updates)
 
-    platform_obj = db.platforms.find_one({'platform_id': platform_id})
-    if platform_obj is None:
-        raise Exception('failed to find a platform named "{}".'.format(platform_id))
+    return change_count
+
+
+class PlatformSnpIndex:
+    """
+    A compact mapping from SNP ID to (chromosome, within chromosome index) for a platform. SNP IDs
+    are held as a sorted byte string array and lookups use binary search, so this uses much less
+    memory than a dict and can be stored in the DB (see get_platform_snp_index).
+    """
+
+    def __init__(self, platform_id, revision, chromosomes, snp_counts, snp_ids, chr_codes, chr_indexes):
+        """
+        :param platform_id: the platform ID
+        :param revision: the platform revision that the index was built from
+        :param chromosomes: the platform's chromosomes
+        :param snp_counts: SNP counts with indices matching chromosomes
+        :param snp_ids: sorted numpy array of utf-8 encoded SNP IDs
+        :param chr_codes: int8 array of chromosome codes (indices into chromosomes) matching snp_ids
+        :param chr_indexes: int32 array of within chromosome indices matching snp_ids
+        """
+        self.platform_id = platform_id
+        self.revision = revision
+        self.chromosomes = list(chromosomes)
+        self.snp_counts = np.asarray(snp_counts, dtype=np.int64)
+        self.snp_ids = snp_ids
+        self.chr_codes = chr_codes
+        self.chr_indexes = chr_indexes
+
+        # the offset of each chromosome when all of the platform's SNPs are laid out in chromosome order
+        self.chr_offsets = np.concatenate([[0], np.cumsum(self.snp_counts)[:-1]]).astype(np.int64)
+
+    @property
+    def snp_count_per_chr(self):
+        return {chr: int(count) for chr, count in zip(self.chromosomes, self.snp_counts)}
 
+    @property
+    def total_snp_count(self):
+        return int(np.sum(self.snp_counts))
+
+    def lookup(self, snp_ids):
+        """
+        Look up many SNPs at once
+        :param snp_ids: a sequence of SNP ID strings
+        :return: the tuple (chr_codes, chr_indexes). Both are int arrays matching snp_ids where
+            chr_codes index into self.chromosomes. SNPs that aren't in the platform have a code of -1
+        """
+        # we let numpy choose the width of the query array so that longer IDs aren't truncated
+        query_ids = np.array([x.encode() for x in snp_ids], dtype=bytes)
+        chr_codes = np.full(len(query_ids), -1, dtype=np.int64)
+        chr_indexes = np.full(len(query_ids), -1, dtype=np.int64)
+        if len(self.snp_ids):
+            positions = np.minimum(np.searchsorted(self.snp_ids, query_ids), len(self.snp_ids) - 1)
+            found = self.snp_ids[positions] == query_ids
+            chr_codes[found] = self.chr_codes[positions[found]]
+            chr_indexes[found] = self.chr_indexes[positions[found]]
+
+        return chr_codes, chr_indexes
+
+    def lookup_rows(self, snp_ids):
+        """
+        Like lookup but returns the SNP's row in the full platform layout (chromosomes in
+        platform order, see self.chr_offsets) with -1 for SNPs that aren't in the platform
+        """
+        chr_codes, chr_indexes = self.lookup(snp_ids)
+        return np.where(chr_codes >= 0, self.chr_offsets[chr_codes] + chr_indexes, -1)
+
+    def get(self, snp_id):
+        """
+        Look up a single SNP
+        :param snp_id: the SNP ID
+        :return: the tuple (chromosome, within chromosome index) or None if the SNP isn't in the platform
+        """
+        encoded_id = snp_id.encode()
+        position = int(np.searchsorted(self.snp_ids, encoded_id))
+        if position < len(self.snp_ids) and self.snp_ids[position] == encoded_id:
+            return self.chromosomes[self.chr_codes[position]], int(self.chr_indexes[position])
+        else:
+            return None
+
+    def get_row(self, snp_id):
+        """
+        Like get but returns the SNP's row in the full platform layout (see lookup_rows) or None
+        """
+        chr_index = self.get(snp_id)
+        if chr_index is None:
+            return None
+        else:
+            snp_chr, snp_index = chr_index
+            return int(self.chr_offsets[self.chromosomes.index(snp_chr)]) + snp_index
+
+    def to_doc(self):
+        return {
+            'platform_id': self.platform_id,
+            'revision': self.revision,
+            'chromosomes': self.chromosomes,
+            'snp_counts': self.snp_counts.tolist(),
+            'snp_ids': Binary(zlib.compress(b'\n'.join(self.snp_ids.tolist()))),
+            'chr_codes': Binary(self.chr_codes.astype('<i1').tobytes()),
+            'chr_indexes': Binary(self.chr_indexes.astype('<i4').tobytes()),
+        }
+
+    @classmethod
+    def from_doc(cls, index_doc):
+        snp_ids_bytes = zlib.decompress(index_doc['snp_ids'])
+        snp_ids = np.array(snp_ids_bytes.split(b'\n') if snp_ids_bytes else [], dtype=bytes)
+        return cls(
+            index_doc['platform_id'],
+            index_doc['revision'],
+            index_doc['chromosomes'],
+            index_doc['snp_counts'],
+            snp_ids,
+            np.frombuffer(index_doc['chr_codes'], dtype='<i1').astype(np.int8),
+            np.frombuffer(index_doc['chr_indexes'], dtype='<i4').astype(np.int32),
+        )
+
+
+def _build_platform_snp_index(platform_obj, db):
+    platform_id = platform_obj['platform_id']
     platform_chrs = platform_obj['chromosomes']
-    snp_chr_indexes = dict()
-    snp_count_per_chr = {chr: 0 for chr in platform_chrs}
+    chr_codes_by_name = {chr: i for i, chr in enumerate(platform_chrs)}
+    snp_counts = np.zeros(len(platform_chrs), dtype=np.int64)
+
+    snp_ids = []
+    chr_codes = []
+    chr_indexes = []
 
     prev_chr = None
     snp_index = 0
 
-    chr_snps = db.snps.find({'platform_id': platform_id}).sort([
+    chr_snps = db.snps.find({'platform_id': platform_id}, {'_id': 0, 'snp_id': 1, 'chromosome': 1}).sort([
         ('chromosome', pymongo.ASCENDING),
         ('position_bp', pymongo.ASCENDING),
         ('snp_id', pymongo.ASCENDING),
     ])
     for snp in chr_snps:
         if snp['chromosome'] != prev_chr:
-            if prev_chr is not None:
-                snp_count_per_chr[prev_chr] = snp_index
             snp_index = 0
             prev_chr = snp['chromosome']
-        snp_chr_indexes[snp['snp_id']] = {
-            'index': snp_index,
-            'chromosome': snp['chromosome'],
-        }
+
+        # SNPs on chromosomes that the platform doesn't list can't be stored in samples
+        chr_code = chr_codes_by_name.get(snp['chromosome'])
+        if chr_code is not None:
+            snp_ids.append(snp['snp_id'].encode())
+            chr_codes.append(chr_code)
+            chr_indexes.append(snp_index)
+            snp_counts[chr_code] = snp_index + 1
+
         snp_index += 1
-    if prev_chr is not None:
-        snp_count_per_chr[prev_chr] = snp_index
 
-    return platform_chrs, snp_count_per_chr, snp_chr_indexes
+    snp_ids = np.array(snp_ids, dtype=bytes)
+    sort_order = np.argsort(snp_ids, kind='stable')
+
+    return PlatformSnpIndex(
+        platform_id,
+        platform_obj.get('revision', 0),
+        platform_chrs,
+        snp_counts,
+        snp_ids[sort_order],
+        np.array(chr_codes, dtype=np.int8)[sort_order],
+        np.array(chr_indexes, dtype=np.int32)[sort_order],
+    )
+
+
+def get_platform_snp_index(platform_id, db=None):
+    """
+    Get the SNP index for a platform (see PlatformSnpIndex). The index is stored in the
+    platform_snp_indexes collection and rebuilt whenever the platform revision changes
+    (see bump_platform_revision)
+    :param platform_id: the platform ID
+    :param db: the DB (by default we look up the DB using get_db()
+    :return: the PlatformSnpIndex
+    """
+    if db is None:
+        db = get_db()
+
+    platform_obj = db.platforms.find_one({'platform_id': platform_id})
+    if platform_obj is None:
+        raise Exception('failed to find a platform named "{}".'.format(platform_id))
+
+    index_doc = db.platform_snp_indexes.find_one({'platform_id': platform_id})
+    if (index_doc is not None
+            and index_doc['revision'] == platform_obj.get('revision', 0)
+            and index_doc['chromosomes'] == platform_obj['chromosomes']):
+        return PlatformSnpIndex.from_doc(index_doc)
+    else:
+        snp_index = _build_platform_snp_index(platform_obj, db)
+        db.platform_snp_indexes.replace_one({'platform_id': platform_id}, snp_index.to_doc(), upsert=True)
+
+        return snp_index
+
+
+def within_chr_snp_indices(platform_id, db=None):
+    """
+    Get the within chromosome index of every SNP in a platform. Importers should prefer
+    get_platform_snp_index which is much more compact
+    :param platform_id: the platform ID
+    :param db: the DB (by default we look up the DB using get_db()
+    :return: the tuple (platform_chrs, snp_count_per_chr, snp_chr_indexes) where snp_chr_indexes
+        maps each SNP ID to an {'index': ..., 'chromosome': ...} dict
+    """
+    snp_index = get_platform_snp_index(platform_id, db)
+    snp_chr_indexes = {
+        snp_id.decode(): {'index': chr_index, 'chromosome': snp_index.chromosomes[chr_code]}
+        for snp_id, chr_code, chr_index
+        in zip(snp_index.snp_ids.tolist(), snp_index.chr_codes.tolist(), snp_index.chr_indexes.tolist())
+    }
+
+    return snp_index.chromosomes, snp_index.snp_count_per_chr, snp_chr_indexes
 
 
 # as a convenience we can run this file as a script to
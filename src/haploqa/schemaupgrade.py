@@ -1,3 +1,4 @@
+import argparse
 import haploqa.mongods as mds
 import pymongo
 from datetime import datetime, timedelta
@@ -196,15 +197,64 @@ def upgrade_from_0_0_3(db):
     )
 
 
+def upgrade_from_0_0_4(db):
+    """
+    Schema 0.0.5 adds the packed binary chromosome data format (see mongods.pack_chr_data). Both
+    formats are supported so existing samples are left as call lists. Converting them is opt-in
+    (see the --pack-chromosome-data option)
+    :param db: database
+    :return: none
+    """
+
+    upgrade_to_schema_version = 0, 0, 5
+
+    # Make the update official up updating the schema version in meta
+    db.meta.update_one(
+        {},
+        {'$set': {'schema_version': upgrade_to_schema_version}},
+    )
+
+
+def upgrade_from_0_0_5(db):
+    """
+    Caches AB codes with the chromosome data of all samples. See mongods.set_chr_ab_codes for details
+    :param db: database
+    :return: none
+    """
+
+    upgrade_to_schema_version = 0, 0, 6
+
+    for platform in db.platforms.find():
+        update_count = mds.update_ab_codes(platform['platform_id'], db)
+        print('cached AB codes for {} samples on platform: {}'.format(update_count, platform['platform_id']))
+
+    # Make the update official up updating the schema version in meta
+    db.meta.update_one(
+        {},
+        {'$set': {'schema_version': upgrade_to_schema_version}},
+    )
+
+
 SCHEMA_UPGRADE_FUNCTIONS = [
     ((0, 0, 0), upgrade_from_0_0_0),
     ((0, 0, 1), upgrade_from_0_0_1),
     ((0, 0, 2), upgrade_from_0_0_2),
-    ((0, 0, 3), upgrade_from_0_0_3)
+    ((0, 0, 3), upgrade_from_0_0_3),
+    ((0, 0, 4), upgrade_from_0_0_4),
+    ((0, 0, 5), upgrade_from_0_0_5),
 ]
 
 
 def main():
+    # parse command line arguments
+    parser = argparse.ArgumentParser(description='upgrade or initialize the HaploQA DB schema')
+    parser.add_argument(
+        '--pack-chromosome-data',
+        action='store_true',
+        help='convert the chromosome data of existing samples into the packed binary format. '
+             'Packing is lossless and reduces the size of sample documents')
+    args = parser.parse_args()
+
     db = mds.get_db()
     schema_version = mds.get_schema_version(db)
     if schema_version is not None:
@@ -231,6 +281,11 @@ def main():
         mds.version_to_str(mds.get_schema_version(db)),
     )
 
+    if args.pack_chromosome_data:
+        for platform in db.platforms.find():
+            pack_count = mds.pack_samples(platform['platform_id'], db)
+            print('packed chromosome data for {} samples on platform: {}'.format(pack_count, platform['platform_id']))
+
 
 # as a convenience we can run this file as a script to
 # upgrade or initialize the DB
@@ -1,8 +1,8 @@
 import argparse
 import csv
 from functools import cmp_to_key
-import re
-import sys
+
+import numpy as np
 
 import haploqa.mongods as mds
 
@@ -18,6 +18,9 @@ PYTHONPATH=src python -m haploqa.snpmapimport new_platform_name "./path-to/SNP_M
 
 valid_nonnumeric_chromosome_names = ['X', 'Y', 'M', 'MT']
 
+# the number of SNP annotations inserted per insert_many call
+SNP_INSERT_BATCH_SIZE = 10000
+
 
 def normalize_chr(chrom):
     """
@@ -63,6 +66,45 @@ def chr_cmp(chrom1, chrom2):
         return chrom1_idx - chrom2_idx
 
 
+def _fmt_err(row_index, msg):
+    # row_index counts data rows so we add 2 for the header and one based line numbers
+    raise Exception('Format Error on line {} of SNP map: {}'.format(row_index + 2, msg))
+
+
+def _read_snp_anno_cols(snp_anno_file):
+    """
+    read the columns that we need from the SNP map. The whole table is parsed by numpy
+    rather than row by row. Optional columns that are missing from the header are returned as None
+    :return: a dict mapping the lower case column names to numpy string arrays
+    """
+    required_cols = ['name', 'chromosome', 'position', 'snp']
+    optional_cols = ['ilmn strand', 'customer strand']
+
+    with open(snp_anno_file, 'r') as snp_anno_file_handle:
+        header = next(csv.reader(snp_anno_file_handle, delimiter='\t'))
+    header_indexes = {x.lower(): i for i, x in enumerate(header)}
+    for col in required_cols:
+        if col not in header_indexes:
+            raise Exception('failed to find required column "{}" in SNP map header'.format(col))
+
+    read_cols = required_cols + [col for col in optional_cols if col in header_indexes]
+    table = np.loadtxt(
+        snp_anno_file,
+        dtype=str,
+        delimiter='\t',
+        comments=None,
+        skiprows=1,
+        usecols=[header_indexes[col] for col in read_cols],
+        ndmin=2,
+        encoding='utf-8',
+    )
+
+    snp_anno_cols = dict.fromkeys(optional_cols)
+    snp_anno_cols.update(zip(read_cols, table.T))
+
+    return snp_anno_cols
+
+
 def import_snp_anno(snp_anno_file, platform_id, db):
     complimentary_nucleobases = {
         'A': 'T',
@@ -71,57 +113,104 @@ def import_snp_anno(snp_anno_file, platform_id, db):
         'C': 'G',
     }
 
-    with open(snp_anno_file, 'r') as snp_anno_file_handle:
-        snp_anno_table = csv.reader(snp_anno_file_handle, delimiter='\t')
-
-        header = next(snp_anno_table)
-        header_indexes = {x.lower(): i for i, x in enumerate(header)}
-
-        snp_pattern = re.compile('''^\[(.)/(.)\]$''')
-        snps = db.snps
-        all_chrs = set()
-        for row in snp_anno_table:
+    snp_anno_cols = _read_snp_anno_cols(snp_anno_file)
+    snp_ids = snp_anno_cols['name']
+    chromosomes = snp_anno_cols['chromosome']
+    snp_count = len(snp_ids)
+
+    # SNP calls look like "[A/G]". Once we know that every value is five characters long
+    # we can look at the characters as a (# SNPs, 5) array
+    snp_calls = snp_anno_cols['snp']
+    snp_call_chars = snp_calls.astype('U5').view('U1').reshape((snp_count, 5))
+    bad_rows = np.flatnonzero(
+        (np.char.str_len(snp_calls) != 5)
+        | (snp_call_chars[:, 0] != '[')
+        | (snp_call_chars[:, 2] != '/')
+        | (snp_call_chars[:, 4] != ']'))
+    if len(bad_rows):
+        _fmt_err(bad_rows[0], 'unexpected snp calls format: ' + snp_calls[bad_rows[0]])
+    x_probe_calls = snp_call_chars[:, 1].copy()
+    y_probe_calls = snp_call_chars[:, 3].copy()
+
+    # a missing strand column compares the same as "Unknown" strand values
+    ilmn_strands = snp_anno_cols['ilmn strand']
+    customer_strands = snp_anno_cols['customer strand']
+    if ilmn_strands is None:
+        ilmn_strands = np.full(snp_count, 'Unknown')
+    if customer_strands is None:
+        customer_strands = np.full(snp_count, 'Unknown')
+
+    # TODO this seems to work but is it the right thing to do?
+    flip_strand = ilmn_strands != customer_strands
+    for probe_calls in (x_probe_calls, y_probe_calls):
+        flip_calls = probe_calls[flip_strand]
+        bad_rows = np.flatnonzero(~np.isin(flip_calls, list(complimentary_nucleobases)))
+        if len(bad_rows):
+            row_index = np.flatnonzero(flip_strand)[bad_rows[0]]
+            _fmt_err(row_index, 'cannot take the complement of "{}"'.format(probe_calls[row_index]))
+        flipped_calls = flip_calls.copy()
+        for nucleobase, complement in complimentary_nucleobases.items():
+            flipped_calls[flip_calls == nucleobase] = complement
+        probe_calls[flip_strand] = flipped_calls
+
+    try:
+        positions_bp = snp_anno_cols['position'].astype(np.int64)
+    except ValueError:
+        for row_index, position in enumerate(snp_anno_cols['position'].tolist()):
             try:
-                def get_val(column_name):
-                    try:
-                        val = row[header_indexes[column_name]]
-                    except KeyError:
-                        val = None
-
-                    if val == "Unknown":
-                        val = None
-
-                    return val
-
-                snp_calls = get_val('snp')
-                snp_match = snp_pattern.match(snp_calls)
-                if not snp_match:
-                    raise Exception('unexpected snp calls format: ' + snp_calls)
-                x_probe_call, y_probe_call = snp_match.groups()
-                if get_val('ilmn strand') != get_val('customer strand'):
-                    # TODO this seems to work but is it the right thing to do?
-                    x_probe_call = complimentary_nucleobases[x_probe_call]
-                    y_probe_call = complimentary_nucleobases[y_probe_call]
-
-                chromosome = get_val('chromosome')
-                snps.insert_one({
-                    'platform_id': platform_id,
-                    'snp_id': get_val('name'),
-                    'chromosome': chromosome,
-                    'position_bp': int(get_val('position')),
-                    'x_probe_call': x_probe_call,
-                    'y_probe_call': y_probe_call,
-                })
-                all_chrs.add(chromosome)
-            except:
-                print('failed to import row:', row, file=sys.stderr)
-                raise
-
-        all_chrs = sorted(all_chrs, key=cmp_to_key(chr_cmp))
-        db.platforms.insert_one({
+                int(position)
+            except ValueError:
+                _fmt_err(row_index, 'failed to convert position "{}" into an integer'.format(position))
+        raise
+
+    unique_snp_ids, unique_snp_id_counts = np.unique(snp_ids, return_counts=True)
+    duplicate_snp_ids = unique_snp_ids[unique_snp_id_counts > 1]
+    if len(duplicate_snp_ids):
+        raise Exception('duplicate SNP name: {}'.format(duplicate_snp_ids[0]))
+
+    # we calculate the within chromosome indexes up front using the same ordering as
+    # mds.get_snps (position then SNP ID) so that the SNPs don't have to be revisited
+    # after they're inserted
+    unique_chrs, chr_codes = np.unique(chromosomes, return_inverse=True)
+    snp_order = np.lexsort((snp_ids, positions_bp, chr_codes))
+    sorted_chr_codes = chr_codes[snp_order]
+    within_chr_indexes = np.empty(snp_count, dtype=np.int64)
+    within_chr_indexes[snp_order] = np.arange(snp_count) - np.searchsorted(sorted_chr_codes, sorted_chr_codes)
+
+    snp_docs = [
+        {
             'platform_id': platform_id,
-            'chromosomes': all_chrs,
-        })
+            'snp_id': snp_id,
+            'chromosome': None if chromosome == 'Unknown' else chromosome,
+            'position_bp': position_bp,
+            'x_probe_call': x_probe_call,
+            'y_probe_call': y_probe_call,
+            'within_chr_index': within_chr_index,
+        }
+        for snp_id, chromosome, position_bp, x_probe_call, y_probe_call, within_chr_index in zip(
+            snp_ids.tolist(),
+            chromosomes.tolist(),
+            positions_bp.tolist(),
+            x_probe_calls.tolist(),
+            y_probe_calls.tolist(),
+            within_chr_indexes.tolist())
+    ]
+
+    for batch_start in range(0, len(snp_docs), SNP_INSERT_BATCH_SIZE):
+        db.snps.insert_many(snp_docs[batch_start:batch_start + SNP_INSERT_BATCH_SIZE])
+
+    all_chrs = sorted(
+        [None if chromosome == 'Unknown' else chromosome for chromosome in unique_chrs.tolist()],
+        key=cmp_to_key(chr_cmp))
+    db.platforms.insert_one({
+        'platform_id': platform_id,
+        'chromosomes': all_chrs,
+    })
+
+    # the SNP annotations determine how sample calls map to AB codes so any
+    # cached SNP tables and codes for this platform need to be refreshed
+    mds.bump_platform_revision(platform_id, db)
+    mds.update_ab_codes(platform_id, db)
 
 
 def main():
@@ -134,9 +223,18 @@ def main():
     parser.add_argument(
         'snp_annotation_txt',
         help='the tab-delimited snp annotation file. There should be a header row and one row per SNP')
+    parser.add_argument(
+        '--defer-indexes',
+        action='store_true',
+        help='create the SNP annotation indexes after the SNPs are loaded rather than before. This is '
+             'faster when importing into a database that does not have the SNP indexes yet',
+    )
     args = parser.parse_args()
 
-    import_snp_anno(args.snp_annotation_txt, args.platform, mds.init_db())
+    db = mds.init_db(snp_indexes=not args.defer_indexes)
+    import_snp_anno(args.snp_annotation_txt, args.platform, db)
+    if args.defer_indexes:
+        mds.create_snp_indexes(db)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,112 @@
+import csv
+import os
+import shutil
+import tempfile
+import unittest
+
+import mongomock
+import numpy as np
+
+import haploqa.customcsvimport as csvimp
+import haploqa.mongods as mds
+import haploqa.snpmapimport as snpmapimp
+
+TEST_DATA_DIR = os.path.join(os.path.dirname(__file__), 'test_files')
+MATRIX_FILES = [os.path.join(TEST_DATA_DIR, x) for x in ('geno_matrix.csv', 'x_matrix.csv', 'y_matrix.csv')]
+
+# the SNPs of the test platform in within chromosome order
+CHR_SNP_IDS = {
+    '1': ['rs9', 'rs1', 'rs2'],
+    '2': ['rs4', 'rs5'],
+    '10': ['rs3'],
+    'X': ['JAX001'],
+    'MT': ['MT01'],
+}
+
+
+def _read_reference_matrix(matrix_file):
+    """
+    read a matrix file into a dict of {sample name: {SNP ID: value}}
+    """
+    with open(matrix_file, 'r') as matrix_handle:
+        rows = list(csv.reader(matrix_handle))
+
+    return {
+        sample_name: {row[0]: row[i + 1] for row in rows[1:]}
+        for i, sample_name in enumerate(rows[0][1:])
+    }
+
+
+class TestCustomCsvImport(unittest.TestCase):
+    """
+    Class for testing genotype and intensity matrix imports
+    """
+
+    def setUp(self):
+        self.db = mongomock.MongoClient().db
+        self.db.meta.insert_one({'schema_version': [0, 0, 0]})
+        snpmapimp.import_snp_anno(os.path.join(TEST_DATA_DIR, 'snp_map.txt'), 'TestMUGA', self.db)
+
+        self.prev_packed_chromosome_data = mds.PACKED_CHROMOSOME_DATA
+        self.prev_buffer_bytes_per_snp = csvimp.BUFFER_BYTES_PER_SNP
+        mds.PACKED_CHROMOSOME_DATA = False
+
+    def tearDown(self):
+        mds.PACKED_CHROMOSOME_DATA = self.prev_packed_chromosome_data
+        csvimp.BUFFER_BYTES_PER_SNP = self.prev_buffer_bytes_per_snp
+
+    def _check_imported_samples(self):
+        ref_genos, ref_xs, ref_ys = [_read_reference_matrix(x) for x in MATRIX_FILES]
+        samples = {x['other_ids'][0]: x for x in self.db.samples.find()}
+        self.assertEqual(sorted(samples), ['m1', 'm2', 'm3'])
+        self.assertEqual(len(set(x['sample_id'] for x in samples.values())), 3)
+
+        for sample_name, sample in samples.items():
+            self.assertEqual(sample['platform_id'], 'TestMUGA')
+            self.assertEqual(sample['tags'], ['matrix', 'TestMUGA'])
+            for chr_id, snp_ids in CHR_SNP_IDS.items():
+                chr_data = sample['chromosome_data'][chr_id]
+                for snp_index, snp_id in enumerate(snp_ids):
+                    if snp_id in ref_genos[sample_name]:
+                        ref_geno = ref_genos[sample_name][snp_id]
+                        self.assertEqual(chr_data['snps'][snp_index], '-' if ref_geno == 'N' else ref_geno)
+                        self.assertEqual(chr_data['xs'][snp_index], float(ref_xs[sample_name][snp_id]))
+                        self.assertEqual(chr_data['ys'][snp_index], float(ref_ys[sample_name][snp_id]))
+                    else:
+                        # rs4 isn't in the matrices
+                        self.assertEqual(chr_data['snps'][snp_index], '-')
+                        self.assertTrue(np.isnan(chr_data['xs'][snp_index]))
+                        self.assertTrue(np.isnan(chr_data['ys'][snp_index]))
+
+    def test_import_samples(self):
+        """every sample column should be imported with its calls and intensities in platform SNP order"""
+
+        csvimp.import_samples('TestMUGA', *MATRIX_FILES, ['matrix', 'TestMUGA'], self.db, batch_size=2)
+        self._check_imported_samples()
+
+    def test_import_samples_in_passes(self):
+        """a memory budget too small for all samples should import the samples over several passes"""
+
+        # this makes the 1 MB budget hold two samples of the eight SNP test platform
+        csvimp.BUFFER_BYTES_PER_SNP = 2 ** 20 // 16
+        csvimp.import_samples('TestMUGA', *MATRIX_FILES, ['matrix', 'TestMUGA'], self.db, memory_budget_mb=1)
+        self._check_imported_samples()
+
+    def test_mismatched_matrices(self):
+        """matrices with different samples or SNPs should be rejected"""
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            y_matrix_file = os.path.join(temp_dir, 'y_matrix.csv')
+            shutil.copy(MATRIX_FILES[2], y_matrix_file)
+            with open(y_matrix_file, 'r') as y_matrix_handle:
+                lines = y_matrix_handle.readlines()
+
+            with open(y_matrix_file, 'w') as y_matrix_handle:
+                y_matrix_handle.writelines([lines[0].replace('m3', 'm4')] + lines[1:])
+            with self.assertRaisesRegex(Exception, 'sample IDs do not match'):
+                csvimp.import_samples('TestMUGA', *MATRIX_FILES[:2], y_matrix_file, ['matrix'], self.db)
+
+            with open(y_matrix_file, 'w') as y_matrix_handle:
+                y_matrix_handle.writelines(lines[:1] + lines[2:] + lines[1:2])
+            with self.assertRaisesRegex(Exception, 'snp IDs do not match'):
+                csvimp.import_samples('TestMUGA', *MATRIX_FILES[:2], y_matrix_file, ['matrix'], self.db)
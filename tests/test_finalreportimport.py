@@ -0,0 +1,248 @@
+import csv
+import functools
+import os
+import unittest
+
+import mongomock
+import numpy as np
+from pymongo.errors import DuplicateKeyError
+
+import haploqa.finalreportimport as finalin
+import haploqa.mongods as mds
+import haploqa.snpmapimport as snpmapimp
+
+TEST_DATA_DIR = os.path.join(os.path.dirname(__file__), 'test_files')
+FINAL_REPORT_FILE = os.path.join(TEST_DATA_DIR, 'final_report.txt')
+
+# the SNPs of the test platform in within chromosome order
+CHR_SNP_IDS = {
+    '1': ['rs9', 'rs1', 'rs2'],
+    '2': ['rs4', 'rs5'],
+    '10': ['rs3'],
+    'X': ['JAX001'],
+    'MT': ['MT01'],
+}
+
+
+def _make_test_db():
+    """
+    make an in-memory DB with the test platform. Newer versions of pymongo pass a sort argument
+    to mongomock's bulk update and replace builders which they don't accept so we drop it
+    """
+    bulk_builder = mongomock.collection.BulkOperationBuilder
+    for method_name in ('add_update', 'add_replace'):
+        method = getattr(bulk_builder, method_name)
+        if not getattr(method, 'drops_sort', False):
+            @functools.wraps(method)
+            def drop_sort(self, *args, __method=method, **kwargs):
+                kwargs.pop('sort', None)
+                return __method(self, *args, **kwargs)
+            drop_sort.drops_sort = True
+            setattr(bulk_builder, method_name, drop_sort)
+
+    db = mongomock.MongoClient().db
+    db.meta.insert_one({'schema_version': [0, 0, 0]})
+    db.samples.create_index('sample_id', unique=True)
+    snpmapimp.import_snp_anno(os.path.join(TEST_DATA_DIR, 'snp_map.txt'), 'TestMUGA', db)
+
+    return db
+
+
+def _read_reference_report():
+    """
+    read the data section of the test final report into a dict of {sample ID: {SNP name: row dict}}
+    """
+    with open(FINAL_REPORT_FILE, 'r') as final_report_handle:
+        lines = final_report_handle.read().splitlines()
+    data_lines = lines[lines.index('[Data]') + 1:]
+
+    samples = dict()
+    for row in csv.DictReader(data_lines, delimiter='\t'):
+        samples.setdefault(row['Sample ID'], dict())[row['SNP Name']] = row
+
+    return samples
+
+
+def _import(db, on_duplicate='halt', generate_ids=False, sample_tags=None, batch_size=2, workers=1):
+    finalin.import_final_report(
+        'tester@example.com',
+        generate_ids,
+        on_duplicate,
+        FINAL_REPORT_FILE,
+        {'SB': {'sex': 'female', 'chromosome_data': 'ignored'}},
+        'TestMUGA',
+        sample_tags if sample_tags is not None else ['final_report', 'TestMUGA'],
+        db,
+        batch_size,
+        workers)
+
+
+def _comparable_samples(db):
+    """
+    load the samples keyed by sample ID with their chromosome data in the list format. NaN
+    intensities are replaced by None so that samples can be compared with ==
+    """
+    samples = dict()
+    # these values change every time a sample is written
+    for sample in db.samples.find({}, {'_id': 0, 'last_update': 0, 'calls_revision': 0}):
+        for chr_id, chr_data in sample['chromosome_data'].items():
+            unpacked_chr_data = mds.unpack_chr_data(chr_data, list(mds.get_snps('TestMUGA', chr_id, db)))
+            sample['chromosome_data'][chr_id] = {
+                'allele1_fwds': list(unpacked_chr_data['allele1_fwds']),
+                'allele2_fwds': list(unpacked_chr_data['allele2_fwds']),
+            }
+            for intens_key in ('xs', 'ys'):
+                intensities = np.asarray(unpacked_chr_data[intens_key], dtype=np.float64)
+                sample['chromosome_data'][chr_id][intens_key] = [
+                    None if np.isnan(x) else x for x in intensities.tolist()
+                ]
+        samples[sample['sample_id']] = sample
+
+    return samples
+
+
+class TestFinalReportImport(unittest.TestCase):
+    """
+    Class for testing final report imports
+    """
+
+    def setUp(self):
+        self.db = _make_test_db()
+        self.prev_packed_chromosome_data = mds.PACKED_CHROMOSOME_DATA
+        mds.PACKED_CHROMOSOME_DATA = False
+
+    def tearDown(self):
+        mds.PACKED_CHROMOSOME_DATA = self.prev_packed_chromosome_data
+
+    def test_import_final_report(self):
+        """imported samples should hold the report's calls and intensities in platform SNP order"""
+
+        for packed in (False, True):
+            with self.subTest(packed=packed):
+                mds.PACKED_CHROMOSOME_DATA = packed
+                self.db = _make_test_db()
+                _import(self.db)
+                self._check_imported_samples()
+
+    def _check_imported_samples(self):
+        ref_samples = _read_reference_report()
+        samples = _comparable_samples(self.db)
+        self.assertEqual(sorted(samples), ['SA', 'SB', 'SC'])
+        for sample_id, sample in samples.items():
+            self.assertEqual(sample['platform_id'], 'TestMUGA')
+            self.assertEqual(sample['tags'], ['final_report', 'TestMUGA'])
+            self.assertEqual(sample['owner'], 'tester@example.com')
+            self.assertEqual(sample['other_ids'], [])
+            self.assertEqual(sorted(sample['chromosome_data']), sorted(CHR_SNP_IDS))
+
+            ref_rows = ref_samples[sample_id]
+            for chr_id, snp_ids in CHR_SNP_IDS.items():
+                chr_data = sample['chromosome_data'][chr_id]
+                for snp_index, snp_id in enumerate(snp_ids):
+                    ref_row = ref_rows.get(snp_id)
+                    if ref_row is None:
+                        # platform SNPs missing from the report get no-calls
+                        self.assertIsNone(chr_data['xs'][snp_index])
+                        self.assertIsNone(chr_data['ys'][snp_index])
+                        self.assertEqual(chr_data['allele1_fwds'][snp_index], '-')
+                        self.assertEqual(chr_data['allele2_fwds'][snp_index], '-')
+                    else:
+                        # packed intensities are stored as float32
+                        if ref_row['X'] == 'NA':
+                            self.assertIsNone(chr_data['xs'][snp_index])
+                        else:
+                            self.assertAlmostEqual(chr_data['xs'][snp_index], float(ref_row['X']), places=6)
+                        self.assertAlmostEqual(chr_data['ys'][snp_index], float(ref_row['Y']), places=6)
+                        self.assertEqual(chr_data['allele1_fwds'][snp_index], ref_row['Allele1 - Forward'])
+                        self.assertEqual(chr_data['allele2_fwds'][snp_index], ref_row['Allele2 - Forward'])
+
+            self.assertEqual(
+                [x['snp_name'] for x in sample['unannotated_snps']],
+                ['unknown'])
+
+        self.assertEqual(samples['SB']['sex'], 'female')
+        self.assertNotIn('sex', samples['SA'])
+        self.assertEqual(samples['SC']['chromosome_data']['2']['allele1_fwds'], ['-', '-'])
+
+    def test_generate_ids(self):
+        """with generated IDs the report's sample IDs should move to other_ids"""
+
+        _import(self.db, generate_ids=True)
+
+        samples = _comparable_samples(self.db)
+        self.assertEqual(len(samples), 3)
+        self.assertNotIn('SA', samples)
+        self.assertEqual(sorted(x['other_ids'][0] for x in samples.values()), ['SA', 'SB', 'SC'])
+
+    def test_on_duplicate(self):
+        """duplicate sample IDs should be skipped, replaced or halt the import depending on on_duplicate"""
+
+        _import(self.db)
+        orig_samples = _comparable_samples(self.db)
+
+        _import(self.db, on_duplicate='skip', sample_tags=['second_import'])
+        self.assertEqual(_comparable_samples(self.db), orig_samples)
+
+        self.db.samples.delete_one({'sample_id': 'SC'})
+        _import(self.db, on_duplicate='skip', sample_tags=['second_import'])
+        samples = _comparable_samples(self.db)
+        self.assertEqual(samples['SA'], orig_samples['SA'])
+        self.assertEqual(samples['SC']['tags'], ['second_import'])
+
+        _import(self.db, on_duplicate='replace', sample_tags=['third_import'])
+        samples = _comparable_samples(self.db)
+        self.assertEqual(len(samples), 3)
+        for sample in samples.values():
+            self.assertEqual(sample['tags'], ['third_import'])
+
+        # an ordered insert halts at the first duplicate so nothing after SA is written
+        self.db.samples.delete_many({'sample_id': {'$in': ['SB', 'SC']}})
+        with self.assertRaises(DuplicateKeyError):
+            _import(self.db, sample_tags=['fourth_import'], batch_size=1)
+        self.assertEqual(sorted(_comparable_samples(self.db)), ['SA'])
+
+    def test_sample_chunks(self):
+        """chunks should start and end on sample boundaries and cover the whole data section"""
+
+        sample_id_col_hdr = finalin._sample_id_col_hdr('TestMUGA')
+        data_header_indexes, data_start = finalin._read_data_header(FINAL_REPORT_FILE, sample_id_col_hdr)
+        for chunk_count in (1, 2, 3, 8):
+            chunks = finalin._sample_chunks(
+                FINAL_REPORT_FILE,
+                data_start,
+                data_header_indexes[sample_id_col_hdr],
+                chunk_count)
+
+            self.assertEqual(chunks[0][0], data_start)
+            self.assertEqual(chunks[-1][1], os.path.getsize(FINAL_REPORT_FILE))
+            for (_, prev_end), (next_start, _) in zip(chunks[:-1], chunks[1:]):
+                self.assertEqual(prev_end, next_start)
+
+            chunk_sample_ids = [
+                [
+                    x['sample_id']
+                    for x in finalin._iter_chunk_samples(
+                        FINAL_REPORT_FILE,
+                        chunk,
+                        data_header_indexes,
+                        sample_id_col_hdr,
+                        'TestMUGA',
+                        finalin.mds.get_platform_snp_index('TestMUGA', self.db))
+                ]
+                for chunk in chunks
+            ]
+            self.assertEqual(sum(chunk_sample_ids, []), ['SA', 'SB', 'SC'])
+            self.assertTrue(all(chunk_sample_ids))
+
+        # with enough chunks every sample gets its own chunk
+        self.assertEqual(chunk_sample_ids, [['SA'], ['SB'], ['SC']])
+
+    def test_parallel_import(self):
+        """parsing the report in worker processes should import the same samples as a single process"""
+
+        _import(self.db)
+        serial_samples = _comparable_samples(self.db)
+
+        parallel_db = _make_test_db()
+        _import(parallel_db, workers=2)
+        self.assertEqual(_comparable_samples(parallel_db), serial_samples)
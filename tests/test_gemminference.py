@@ -0,0 +1,106 @@
+import unittest
+import mongomock
+import numpy as np
+from scipy.spatial.distance import mahalanobis
+from scipy.stats import multivariate_normal
+
+import haploqa.gemminference as gemminf
+
+
+class TestGemmInference(unittest.TestCase):
+    """
+    Class for testing GEMM control models
+    """
+
+    def test_calc_log_pd_and_dist(self):
+        """the fused scorer should agree with the scipy density and distance functions"""
+
+        rng = np.random.default_rng(7)
+        for probe_count in (1, 3):
+            ctrl_intens = rng.normal(size=(probe_count, 20))
+            sample_intens = rng.normal(size=(50, probe_count))
+            ctrl_model = gemminf._fit_ctrl_model(list(range(20)), ctrl_intens)
+            log_densities, dists = gemminf.calc_log_pd_and_dist(ctrl_model, sample_intens)
+
+            ctrl_mean = np.mean(ctrl_intens, axis=1)
+            ctrl_cov = np.atleast_2d(np.cov(ctrl_intens))
+            np.testing.assert_allclose(
+                log_densities,
+                multivariate_normal.logpdf(sample_intens, ctrl_mean, ctrl_cov))
+            np.testing.assert_allclose(
+                dists,
+                [mahalanobis(x, ctrl_mean, np.linalg.inv(ctrl_cov)) for x in sample_intens])
+
+    def test_pos_mixture_probs(self):
+        """far away samples should get NaN and probabilities shouldn't underflow"""
+
+        ctrl_model = {
+            'pos': gemminf._fit_ctrl_model([0, 1, 2], np.array([[9.0, 10.0, 11.0]])),
+            'neg': gemminf._fit_ctrl_model([3, 4, 5], np.array([[-1.0, 0.0, 1.0]])),
+        }
+        probs = gemminf.pos_mixture_probs(ctrl_model, [[10.0], [0.0], [5.0], [np.nan], [60.0]], 100)
+
+        self.assertGreater(probs[0], 0.99)
+        self.assertLess(probs[1], 0.01)
+        self.assertAlmostEqual(probs[2], 0.5)
+        self.assertTrue(np.isnan(probs[3]))
+        self.assertEqual(probs[4], 1.0)
+
+        probs = gemminf.pos_mixture_probs(ctrl_model, [[10.0], [50.0]], 2)
+        self.assertFalse(np.isnan(probs[0]))
+        self.assertTrue(np.isnan(probs[1]))
+
+    def test_drop_incomplete_controls(self):
+        """controls missing intensities should be left out of the fit and count against the minimum"""
+
+        db = mongomock.MongoClient().db
+        db.platforms.insert_one({'platform_id': 'TestMUGA', 'revision': 1})
+        db.snps.insert_many([
+            {
+                'platform_id': 'TestMUGA', 'snp_id': snp_id, 'chromosome': '1', 'within_chr_index': i,
+                'engineered_target': 'neo', 'informative_axis': 'Y',
+            }
+            for i, snp_id in enumerate(('g1', 'g2'))
+        ])
+
+        rng = np.random.default_rng(11)
+        ctrl_intens = {'pos': rng.normal(10.0, size=(5, 2)), 'neg': rng.normal(0.0, size=(5, 2))}
+        ctrl_intens['pos'][0, 1] = np.nan
+        for ctrl_type, intens in ctrl_intens.items():
+            db.samples.insert_many([
+                {
+                    'sample_id': '{}{}'.format(ctrl_type, i),
+                    'platform_id': 'TestMUGA',
+                    ctrl_type + '_ctrl_eng_tgts': ['neo'],
+                    'gemm_intensities': {
+                        'platform_revision': 1,
+                        'snp_ids': ['g1', 'g2'],
+                        'intensities': sample_intens.tolist(),
+                    },
+                }
+                for i, sample_intens in enumerate(intens)
+            ])
+
+        ctrl_model = gemminf.get_gemm_ctrl_models(['TestMUGA'], 4, db)[('TestMUGA', 'neo')]
+        self.assertEqual(len(ctrl_model['pos']['control_sample_ids']), 5)
+        self.assertEqual(ctrl_model['pos']['count'], 4)
+        self.assertEqual(ctrl_model['neg']['count'], 5)
+        np.testing.assert_allclose(ctrl_model['pos']['mean'], np.mean(ctrl_intens['pos'][1:], axis=0))
+        self.assertTrue(np.all(np.isfinite(ctrl_model['pos']['cholesky'])))
+
+        # the cached model is still valid because the control membership hasn't changed
+        self.assertEqual(db.gemm_control_models.count_documents({}), 1)
+        cached_model = gemminf.get_gemm_ctrl_models(['TestMUGA'], 4, db)[('TestMUGA', 'neo')]
+        self.assertEqual(cached_model['pos'], ctrl_model['pos'])
+        self.assertEqual(cached_model['neg'], ctrl_model['neg'])
+
+        # a new positive control missing one of the intensities leaves too few to fit the target
+        db.samples.update_one({'sample_id': 'pos1'}, {'$set': {'gemm_intensities.intensities': [np.nan, 10.0]}})
+        db.samples.insert_one({
+            'sample_id': 'pos5',
+            'platform_id': 'TestMUGA',
+            'pos_ctrl_eng_tgts': ['neo'],
+            'gemm_intensities': {'platform_revision': 1, 'snp_ids': ['g1'], 'intensities': [10.0]},
+        })
+        self.assertEqual(gemminf.get_gemm_ctrl_models(['TestMUGA'], 4, db), dict())
+        self.assertEqual(db.gemm_control_models.count_documents({}), 0)
@@ -0,0 +1,235 @@
+import unittest
+import numpy as np
+
+import haploqa.haplohmm as hhmm
+
+
+def _make_test_hmm(trans_prob=0.01):
+    """
+    make an HMM using the same parameters that the app uses
+    """
+    hom_obs_probs = np.array([50, 0.5, 1, 1], dtype=np.float64)
+    het_obs_probs = np.array([50, 2, 2], dtype=np.float64)
+    n_obs_probs = np.ones(3, dtype=np.float64)
+
+    return hhmm.SnpHaploHMM(trans_prob, hom_obs_probs, het_obs_probs, n_obs_probs)
+
+
+def _reference_viterbi(hmm, haplotype_ab_codes, observation_ab_codes):
+    """
+    a straightforward (full transition matrix) viterbi implementation that
+    we can compare the optimized implementation against
+    """
+    obs_count, haplotype_count = haplotype_ab_codes.shape
+    state_hap1_indices, state_hap2_indices = np.triu_indices(haplotype_count)
+    state_count = state_hap1_indices.size
+
+    log_trans_probs = np.empty((state_count, state_count), dtype=np.float64)
+    log_trans_probs[:] = np.log(hmm.trans_prob / (state_count - 1)) if state_count > 1 else 0
+    np.fill_diagonal(log_trans_probs, np.log(1.0 - hmm.trans_prob))
+    log_obs_prob_matrix = np.log(hmm.obs_prob_matrix)
+
+    curr_log_likelihoods = np.log(1.0 / state_count) + log_obs_prob_matrix[
+        haplotype_ab_codes[0, state_hap1_indices],
+        haplotype_ab_codes[0, state_hap2_indices],
+        observation_ab_codes[0]]
+    from_state_lattice = np.zeros((obs_count - 1, state_count), dtype=np.uint16)
+    for t in range(1, obs_count):
+        prev_log_likelihoods = curr_log_likelihoods
+        curr_log_likelihoods = np.zeros(state_count, dtype=np.float64)
+        for to_state in range(state_count):
+            from_log_likelihoods = prev_log_likelihoods + log_trans_probs[:, to_state]
+            max_from_state = np.argmax(from_log_likelihoods)
+            from_state_lattice[t - 1, to_state] = max_from_state
+            curr_log_likelihoods[to_state] = from_log_likelihoods[max_from_state]
+        curr_log_likelihoods += log_obs_prob_matrix[
+            haplotype_ab_codes[t, state_hap1_indices],
+            haplotype_ab_codes[t, state_hap2_indices],
+            observation_ab_codes[t]]
+
+    states = np.zeros(obs_count, dtype=np.uint16)
+    states[-1] = np.argmax(curr_log_likelihoods)
+    for t in reversed(range(obs_count - 1)):
+        states[t] = from_state_lattice[t, states[t + 1]]
+
+    return (
+        [(int(state_hap1_indices[s]), int(state_hap2_indices[s])) for s in states],
+        np.max(curr_log_likelihoods),
+    )
+
+
+def _random_ab_codes(rng, obs_count, haplotype_count):
+    """
+    generate a random haplotype panel along with a noisy mosaic observation drawn from it
+    """
+    haplotype_ab_codes = rng.choice(
+        [hhmm.A_CODE, hhmm.B_CODE, hhmm.N_CODE, hhmm.H_CODE],
+        size=(obs_count, haplotype_count),
+        p=[0.45, 0.45, 0.05, 0.05],
+    ).astype(np.uint8)
+
+    # the observations follow haplotype 0 for the first half and haplotype 1 after that
+    observation_ab_codes = haplotype_ab_codes[:, 0].copy()
+    observation_ab_codes[obs_count // 2:] = haplotype_ab_codes[obs_count // 2:, haplotype_count - 1]
+    noise = rng.random(obs_count) < 0.05
+    observation_ab_codes[noise] = rng.integers(0, 4, size=np.count_nonzero(noise))
+
+    return haplotype_ab_codes, observation_ab_codes
+
+
+class TestSnpHaploHMM(unittest.TestCase):
+    """
+    Class for testing the SNP haplotype HMM
+    """
+
+    def test_viterbi_matches_reference(self):
+        """the optimized viterbi should give the same path and likelihood as a full-matrix viterbi"""
+
+        rng = np.random.default_rng(5)
+        hmm = _make_test_hmm()
+        for haplotype_count in (1, 2, 3, 8):
+            haplotype_ab_codes, observation_ab_codes = _random_ab_codes(rng, 300, haplotype_count)
+            states, log_likelihood = hmm.viterbi(haplotype_ab_codes, observation_ab_codes)
+            ref_states, ref_log_likelihood = _reference_viterbi(hmm, haplotype_ab_codes, observation_ab_codes)
+
+            self.assertEqual(states, ref_states)
+            self.assertEqual(log_likelihood, ref_log_likelihood)
+
+            haplotype_indices, log_likelihood = hmm.viterbi_haplotype_indices(haplotype_ab_codes, observation_ab_codes)
+            self.assertEqual(haplotype_indices.shape, (300, 2))
+            self.assertEqual([tuple(x) for x in haplotype_indices.tolist()], ref_states)
+            self.assertEqual(log_likelihood, ref_log_likelihood)
+
+    def test_viterbi_ties(self):
+        """all-N observations make every state equally likely so tie breaking must match the reference"""
+
+        hmm = _make_test_hmm()
+        haplotype_ab_codes = np.ones((50, 4), dtype=np.uint8)
+        observation_ab_codes = np.zeros(50, dtype=np.uint8)
+        states, log_likelihood = hmm.viterbi(haplotype_ab_codes, observation_ab_codes)
+        ref_states, ref_log_likelihood = _reference_viterbi(hmm, haplotype_ab_codes, observation_ab_codes)
+
+        self.assertEqual(states, ref_states)
+        self.assertEqual(log_likelihood, ref_log_likelihood)
+
+    def test_viterbi_batch_matches_single(self):
+        """decoding a batch of samples together should give the same results as decoding them one at a time"""
+
+        rng = np.random.default_rng(11)
+        hmm = _make_test_hmm()
+        haplotype_ab_codes, _ = _random_ab_codes(rng, 200, 5)
+        observation_ab_codes = np.stack(
+            [_random_ab_codes(rng, 200, 5)[1] for _ in range(4)] + [haplotype_ab_codes[:, 2]],
+            axis=1)
+        batch_states, batch_log_likelihoods = hmm.viterbi_batch(haplotype_ab_codes, observation_ab_codes)
+
+        self.assertEqual(len(batch_states), 5)
+        for i in range(observation_ab_codes.shape[1]):
+            states, log_likelihood = hmm.viterbi(haplotype_ab_codes, observation_ab_codes[:, i])
+            self.assertEqual(batch_states[i], states)
+            self.assertEqual(batch_log_likelihoods[i], log_likelihood)
+
+    def test_posterior_probabilities(self):
+        """posteriors should match an unscaled full transition matrix forward-backward"""
+
+        rng = np.random.default_rng(17)
+        hmm = _make_test_hmm(trans_prob=0.05)
+        haplotype_ab_codes, observation_ab_codes = _random_ab_codes(rng, 40, 3)
+        posterior_probs, log_likelihood = hmm.posterior_probabilities(haplotype_ab_codes, observation_ab_codes)
+
+        state_hap1_indices, state_hap2_indices = np.triu_indices(3)
+        state_count = state_hap1_indices.size
+        trans_probs = np.full((state_count, state_count), hmm.trans_prob / (state_count - 1))
+        np.fill_diagonal(trans_probs, 1.0 - hmm.trans_prob)
+        obs_probs = hmm.obs_prob_matrix[
+            haplotype_ab_codes[:, state_hap1_indices],
+            haplotype_ab_codes[:, state_hap2_indices],
+            observation_ab_codes[:, np.newaxis]]
+
+        alphas = np.empty_like(obs_probs)
+        alphas[0] = obs_probs[0] / state_count
+        for t in range(1, len(obs_probs)):
+            alphas[t] = alphas[t - 1].dot(trans_probs) * obs_probs[t]
+        betas = np.ones_like(obs_probs)
+        for t in reversed(range(len(obs_probs) - 1)):
+            betas[t] = trans_probs.dot(obs_probs[t + 1] * betas[t + 1])
+        expected_probs = alphas * betas
+        expected_probs /= np.sum(expected_probs, axis=1, keepdims=True)
+
+        self.assertEqual(posterior_probs.shape, (40, state_count))
+        np.testing.assert_allclose(posterior_probs, expected_probs, rtol=1e-9)
+        self.assertAlmostEqual(log_likelihood, np.log(np.sum(alphas[-1])))
+
+    def test_pack_ab_codes(self):
+        """packing and unpacking AB codes should round trip for any code count"""
+
+        rng = np.random.default_rng(3)
+        for snp_count in (0, 1, 4, 5, 1003):
+            ab_codes = rng.integers(0, 4, size=snp_count).astype(np.uint8)
+            packed_ab_codes = hhmm.pack_ab_codes(ab_codes)
+
+            self.assertEqual(len(packed_ab_codes), (snp_count + 3) // 4)
+            np.testing.assert_array_equal(hhmm.unpack_ab_codes(packed_ab_codes, snp_count), ab_codes)
+
+    def test_chr_data_to_ab_codes(self):
+        """nucleotide calls should convert to the same AB codes as their packed representation"""
+
+        x_calls = np.array(['A', 'C', 'A', 'G', 'A', 'A'])
+        y_calls = np.array(['G', 'T', 'C', 'T', 'T', 'G'])
+        chr_data = {
+            'allele1_fwds': ['A', 'C', '-', 'T', 'A', 'C'],
+            'allele2_fwds': ['A', 'T', '-', 'T', 'G', 'G'],
+        }
+        ab_codes = hhmm.chr_data_to_ab_codes(chr_data, x_calls, y_calls)
+        np.testing.assert_array_equal(
+            ab_codes,
+            [hhmm.A_CODE, hhmm.H_CODE, hhmm.N_CODE, hhmm.B_CODE, 255, 255])
+
+        ab_codes[ab_codes == 255] = hhmm.N_CODE
+        packed_chr_data = {'ab_codes': hhmm.pack_ab_codes(ab_codes), 'snp_count': 6}
+        np.testing.assert_array_equal(hhmm.chr_data_to_ab_codes(packed_chr_data, x_calls, y_calls), ab_codes)
+
+    def test_best_haplotype_pairs(self):
+        """the top pairs should match scoring every pair with log_likelihood and sorting"""
+
+        rng = np.random.default_rng(23)
+        hmm = _make_test_hmm()
+        haplotype_ab_codes, observation_ab_codes = _random_ab_codes(rng, 500, 12)
+
+        # duplicated haplotypes give exactly tied pairs
+        haplotype_ab_codes = np.concatenate([haplotype_ab_codes, haplotype_ab_codes[:, [0, 3, 11]]], axis=1)
+        haplotype_count = haplotype_ab_codes.shape[1]
+
+        ref_pairs = []
+        for i in range(haplotype_count):
+            for j in range(i, haplotype_count):
+                ref_pairs.append((i, j, hmm.log_likelihood(
+                    haplotype_ab_codes[:, i],
+                    haplotype_ab_codes[:, j],
+                    observation_ab_codes)))
+        # summing pair by pair adds rounding noise to otherwise tied pairs
+        ref_pairs.sort(key=lambda tup: -round(tup[2], 6))
+
+        for limit in (None, 1, 7, 20, 500):
+            pairs = hmm.best_haplotype_pairs(haplotype_ab_codes, observation_ab_codes, limit)
+            expected_pairs = ref_pairs[:limit]
+            self.assertEqual([(i, j) for i, j, _ in pairs], [(i, j) for i, j, _ in expected_pairs])
+            np.testing.assert_allclose([x[2] for x in pairs], [x[2] for x in expected_pairs])
+
+    def test_interval_pair_log_likelihoods(self):
+        """block prefix sums should give the same pairwise log likelihoods as scoring an interval directly"""
+
+        rng = np.random.default_rng(29)
+        hmm = _make_test_hmm()
+        haplotype_ab_codes, observation_ab_codes = _random_ab_codes(rng, 1000, 6)
+        interval_lls = hhmm.IntervalPairLogLikelihoods(hmm, haplotype_ab_codes, observation_ab_codes, block_size=64)
+
+        intervals = [(0, 1000), (0, 0), (5, 6), (64, 128), (10, 60), (63, 129), (100, 999)]
+        intervals += [tuple(sorted(rng.integers(0, 1001, size=2))) for _ in range(20)]
+        for start_index, stop_index in intervals:
+            np.testing.assert_allclose(
+                interval_lls.log_likelihoods(start_index, stop_index),
+                hmm.pairwise_log_likelihoods(
+                    haplotype_ab_codes[start_index:stop_index, :],
+                    observation_ab_codes[start_index:stop_index]),
+                rtol=1e-12, atol=1e-9)
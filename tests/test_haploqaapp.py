@@ -0,0 +1,195 @@
+import unittest
+import numpy as np
+
+import haploqa.haplohmm as hhmm
+import haploqa.haploqaapp as hqa
+
+
+def _reference_haplotype_blocks(max_likelihood_states, positions_bp):
+    """
+    the original loop that converted a viterbi path into haplotype blocks
+    """
+    num_snps = len(positions_bp)
+    haplotype_blocks = []
+    start_state = max_likelihood_states[0]
+    start_pos_bp = positions_bp[0]
+    curr_state = None
+    for curr_index in range(1, num_snps):
+        curr_state = max_likelihood_states[curr_index]
+        if curr_state != start_state:
+            haplotype_blocks.append({
+                'start_position_bp': start_pos_bp,
+                'end_position_bp': positions_bp[curr_index] - 1,
+                'haplotype_index_1': start_state[0],
+                'haplotype_index_2': start_state[1],
+            })
+
+            start_state = curr_state
+            start_pos_bp = positions_bp[curr_index]
+
+    haplotype_blocks.append({
+        'start_position_bp': start_pos_bp,
+        'end_position_bp': positions_bp[num_snps - 1],
+        'haplotype_index_1': curr_state[0],
+        'haplotype_index_2': curr_state[1],
+    })
+
+    return haplotype_blocks
+
+
+def _reference_call_concordance(max_likelihood_states, sample_ab_codes, contrib_ab_codes, positions_bp):
+    """
+    the original loop that calculated call concordance bins
+    """
+    informative_count = 0
+    concordant_count = 0
+    discordant_snp_indexes = []
+    concordance_bins = []
+    curr_bin_start_pos = -1
+    curr_bin_informative = 0
+    curr_bin_concordant = 0
+
+    for t, curr_state in enumerate(max_likelihood_states):
+        if curr_bin_start_pos == -1:
+            curr_bin_start_pos = positions_bp[t]
+
+        curr_state_calls = {contrib_ab_codes[t, curr_state[0]], contrib_ab_codes[t, curr_state[1]]}
+        curr_sample_call = sample_ab_codes[t]
+
+        if curr_sample_call != hhmm.N_CODE:
+            if hhmm.N_CODE in curr_state_calls or hhmm.H_CODE in curr_state_calls:
+                is_concordant = False
+            elif len(curr_state_calls) == 2:
+                is_concordant = curr_sample_call == hhmm.H_CODE
+            else:
+                is_concordant = curr_sample_call == next(iter(curr_state_calls))
+
+            curr_bin_informative += 1
+            informative_count += 1
+            if is_concordant:
+                curr_bin_concordant += 1
+                concordant_count += 1
+            else:
+                discordant_snp_indexes.append(t)
+
+            if curr_bin_informative >= hqa.CONCORDANCE_BIN_SIZE:
+                concordance_bins.append({
+                    'start_position_bp': curr_bin_start_pos,
+                    'end_position_bp': positions_bp[t],
+                    'informative_count': curr_bin_informative,
+                    'concordant_count': curr_bin_concordant,
+                })
+                curr_bin_start_pos = -1
+                curr_bin_informative = 0
+                curr_bin_concordant = 0
+
+    if curr_bin_informative > 0:
+        concordance_bins.append({
+            'start_position_bp': curr_bin_start_pos,
+            'end_position_bp': positions_bp[-1],
+            'informative_count': curr_bin_informative,
+            'concordant_count': curr_bin_concordant,
+        })
+
+    return {
+        'informative_count': informative_count,
+        'concordant_count': concordant_count,
+        'discordant_snp_indexes': discordant_snp_indexes,
+        'concordance_bins': concordance_bins,
+    }
+
+
+def _random_path(rng, snp_count, haplotype_count, switch_prob):
+    """
+    generate a random (# SNPs, 2) viterbi path which switches state with the given probability
+    """
+    path = np.empty((snp_count, 2), dtype=np.int64)
+    path[0] = sorted(rng.integers(0, haplotype_count, size=2))
+    for t in range(1, snp_count):
+        if rng.random() < switch_prob:
+            path[t] = sorted(rng.integers(0, haplotype_count, size=2))
+        else:
+            path[t] = path[t - 1]
+
+    return path
+
+
+class TestHaplotypeInference(unittest.TestCase):
+    """
+    Class for testing the conversion of viterbi paths into haplotype blocks and call concordance
+    """
+
+    def test_haplotype_blocks(self):
+        """vectorized block extraction should match the original loop on random paths"""
+
+        rng = np.random.default_rng(31)
+        for snp_count, switch_prob in ((2, 0.5), (2, 0.0), (100, 0.0), (100, 0.1), (500, 0.02), (500, 0.9)):
+            path = _random_path(rng, snp_count, 5, switch_prob)
+            positions_bp = np.cumsum(rng.integers(1, 1000, size=snp_count))
+            self.assertEqual(
+                hqa._haplotype_blocks(path, positions_bp),
+                _reference_haplotype_blocks([tuple(x) for x in path.tolist()], positions_bp.tolist()))
+
+        # a state change at the last SNP gives a single SNP final block
+        path = np.array([[0, 1], [0, 1], [0, 1], [1, 1]])
+        positions_bp = np.array([10, 20, 30, 40])
+        blocks = hqa._haplotype_blocks(path, positions_bp)
+        self.assertEqual(blocks, _reference_haplotype_blocks([tuple(x) for x in path.tolist()], positions_bp.tolist()))
+        self.assertEqual(blocks[-1], {
+            'start_position_bp': 40,
+            'end_position_bp': 40,
+            'haplotype_index_1': 1,
+            'haplotype_index_2': 1,
+        })
+
+        # a single SNP chromosome is a single block (the original loop fails on this)
+        self.assertEqual(hqa._haplotype_blocks(np.array([[2, 3]]), np.array([7])), [{
+            'start_position_bp': 7,
+            'end_position_bp': 7,
+            'haplotype_index_1': 2,
+            'haplotype_index_2': 3,
+        }])
+
+    def test_call_concordance(self):
+        """vectorized concordance binning should match the original loop"""
+
+        rng = np.random.default_rng(37)
+        all_codes = [hhmm.N_CODE, hhmm.A_CODE, hhmm.B_CODE, hhmm.H_CODE]
+        bin_size = hqa.CONCORDANCE_BIN_SIZE
+        for snp_count, no_call_prob in (
+                (1, 0.0),
+                (1, 1.0),
+                (bin_size, 0.0),
+                (bin_size + 1, 0.0),
+                (3 * bin_size, 1.0),
+                (1000, 0.2),
+                (1000, 0.9)):
+            path = _random_path(rng, snp_count, 4, 0.05)
+            contrib_ab_codes = rng.choice(all_codes, size=(snp_count, 4), p=[0.05, 0.45, 0.45, 0.05]).astype(np.uint8)
+            sample_ab_codes = rng.choice(all_codes[1:], size=snp_count).astype(np.uint8)
+            sample_ab_codes[rng.random(snp_count) < no_call_prob] = hhmm.N_CODE
+            positions_bp = np.cumsum(rng.integers(1, 1000, size=snp_count))
+
+            self.assertEqual(
+                hqa._call_concordance(path, sample_ab_codes, contrib_ab_codes, positions_bp),
+                _reference_call_concordance(
+                    [tuple(x) for x in path.tolist()],
+                    sample_ab_codes.tolist(),
+                    contrib_ab_codes,
+                    positions_bp.tolist()))
+
+        # the final bin ends at the last SNP even when trailing SNPs are no-calls
+        contrib_ab_codes = np.full((bin_size + 3, 1), hhmm.A_CODE, dtype=np.uint8)
+        sample_ab_codes = np.full(bin_size + 3, hhmm.A_CODE, dtype=np.uint8)
+        sample_ab_codes[-2:] = hhmm.N_CODE
+        positions_bp = np.arange(bin_size + 3) * 10
+        concordance = hqa._call_concordance(
+            np.zeros((bin_size + 3, 2), dtype=np.int64), sample_ab_codes, contrib_ab_codes, positions_bp)
+        self.assertEqual(concordance['informative_count'], bin_size + 1)
+        self.assertEqual(concordance['concordant_count'], bin_size + 1)
+        self.assertEqual(concordance['concordance_bins'][-1], {
+            'start_position_bp': bin_size * 10,
+            'end_position_bp': (bin_size + 2) * 10,
+            'informative_count': 1,
+            'concordant_count': 1,
+        })
@@ -0,0 +1,144 @@
+import functools
+import os
+import tempfile
+import unittest
+
+import h5py
+import mongomock
+import numpy as np
+
+import haploqa.hdf5io as hdf5io
+import haploqa.mongods as mds
+import haploqa.snpmapimport as snpmapimp
+
+TEST_DATA_DIR = os.path.join(os.path.dirname(__file__), 'test_files')
+
+# the SNPs of the test platform in within chromosome order
+CHR_SNP_IDS = {
+    '1': ['rs9', 'rs1', 'rs2'],
+    '2': ['rs4', 'rs5'],
+    '10': ['rs3'],
+    'X': ['JAX001'],
+    'MT': ['MT01'],
+}
+
+
+def _make_test_db():
+    """
+    make an in-memory DB. Newer versions of pymongo pass a sort argument to mongomock's bulk
+    update and replace builders which they don't accept so we drop it
+    """
+    bulk_builder = mongomock.collection.BulkOperationBuilder
+    for method_name in ('add_update', 'add_replace'):
+        method = getattr(bulk_builder, method_name)
+        if not getattr(method, 'drops_sort', False):
+            @functools.wraps(method)
+            def drop_sort(self, *args, __method=method, **kwargs):
+                kwargs.pop('sort', None)
+                return __method(self, *args, **kwargs)
+            drop_sort.drops_sort = True
+            setattr(bulk_builder, method_name, drop_sort)
+
+    return mongomock.MongoClient().db
+
+
+def _write_h5_sample(samples_grp, grp_name, sample_id, platform_id, probeset_ids, probs):
+    sample_grp = samples_grp.create_group(grp_name)
+    sample_grp['sample_id'] = [sample_id.encode()]
+    sample_grp['platform'] = [platform_id.encode()]
+    sample_grp['probeset_ids'] = [x.encode() for x in probeset_ids]
+    sample_grp['diplotype_strains'] = [[b'A', b'A'], [b'A', b'B'], [b'B', b'B']]
+    sample_grp['diplotype_probabilities'] = probs
+
+
+class TestMergeH5(unittest.TestCase):
+    """
+    Class for testing merging HDF5 diplotype probabilities into the DB
+    """
+
+    def setUp(self):
+        self.db = _make_test_db()
+        snpmapimp.import_snp_anno(os.path.join(TEST_DATA_DIR, 'snp_map.txt'), 'TestMUGA', self.db)
+        self.db.samples.insert_many([
+            {'sample_id': 'S1', 'other_ids': ['report1'], 'platform_id': 'TestMUGA'},
+            {'sample_id': 'S2', 'other_ids': ['report2'], 'platform_id': 'TestMUGA'},
+            {'sample_id': 'S3', 'other_ids': ['report3'], 'platform_id': 'OtherMUGA'},
+        ])
+
+        # the probesets are out of order and include one SNP that the platform doesn't have
+        self.probeset_ids = ['rs2', 'MT01', 'rs4', 'rs9', 'unknown', 'JAX001', 'rs5', 'rs3']
+        rng = np.random.default_rng(41)
+        self.probs = {
+            sample_id: rng.random((3, len(self.probeset_ids))).astype(np.float32)
+            for sample_id in ('report1', 'report2', 'report3')
+        }
+
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.h5_filename = os.path.join(self.temp_dir.name, 'probs.h5')
+        with h5py.File(self.h5_filename, 'w') as h5_file:
+            samples_grp = h5_file.create_group('samples')
+            for i, (sample_id, probs) in enumerate(sorted(self.probs.items())):
+                _write_h5_sample(samples_grp, 'sample{}'.format(i), sample_id, 'TestMUGA', self.probeset_ids, probs)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _check_merged_probs(self):
+        self.assertEqual(
+            sorted(self.db.diplotype_probabilities.distinct('sample_id')),
+            ['S1', 'S2'])
+
+        for sample_id, h5_sample_id in (('S1', 'report1'), ('S2', 'report2')):
+            probs_by_snp = dict(zip(self.probeset_ids, self.probs[h5_sample_id].T))
+            for chr_id, snp_ids in CHR_SNP_IDS.items():
+                prob_doc = self.db.diplotype_probabilities.find_one({'sample_id': sample_id, 'chromosome': chr_id})
+                self.assertEqual(prob_doc['platform_id'], 'TestMUGA')
+                self.assertEqual(prob_doc['diplotype_strains'], [['A', 'A'], ['A', 'B'], ['B', 'B']])
+
+                chr_probs = mds.get_diplotype_probabilities(prob_doc)
+                self.assertEqual(chr_probs.shape, (len(snp_ids), 3))
+                for snp_index, snp_id in enumerate(snp_ids):
+                    # rs1 isn't in the HDF5 file so its probabilities are NaN
+                    np.testing.assert_array_equal(chr_probs[snp_index], probs_by_snp.get(snp_id, [np.nan] * 3))
+
+    def test_merge_h5(self):
+        """probabilities should be scattered into platform SNP order for samples matching by other_ids"""
+
+        hdf5io.merge_h5(self.h5_filename, True, self.db)
+        self._check_merged_probs()
+        self.assertIsNone(hdf5io._merge_worker_state)
+
+        # merging again replaces the existing documents
+        self.probs['report1'] = np.zeros_like(self.probs['report1'])
+        with h5py.File(self.h5_filename, 'a') as h5_file:
+            h5_file['samples']['sample0']['diplotype_probabilities'][...] = self.probs['report1']
+        hdf5io.merge_h5(self.h5_filename, True, self.db)
+        self._check_merged_probs()
+        self.assertEqual(self.db.diplotype_probabilities.count_documents({}), 2 * len(CHR_SNP_IDS))
+
+    def test_merge_h5_workers(self):
+        """merging in a process pool should give the same result as merging in a single process"""
+
+        hdf5io.merge_h5(self.h5_filename, True, self.db, workers=2)
+        self._check_merged_probs()
+
+    def test_missing_snps(self):
+        """reading probabilities in small chunks should still scatter them correctly with NaN for missing SNPs"""
+
+        hdf5io.HDF5_READ_CHUNK_SIZE, prev_chunk_size = 3, hdf5io.HDF5_READ_CHUNK_SIZE
+        try:
+            with h5py.File(self.h5_filename, 'w') as h5_file:
+                _write_h5_sample(
+                    h5_file.create_group('samples'), 'sample0', 'S1', 'TestMUGA',
+                    ['rs5', 'rs9', 'rs1', 'rs2', 'rs3'], np.ones((3, 5), dtype=np.float32))
+            hdf5io.merge_h5(self.h5_filename, False, self.db)
+        finally:
+            hdf5io.HDF5_READ_CHUNK_SIZE = prev_chunk_size
+
+        chr2_doc = self.db.diplotype_probabilities.find_one({'sample_id': 'S1', 'chromosome': '2'})
+        chr2_probs = mds.get_diplotype_probabilities(chr2_doc)
+        self.assertTrue(np.all(np.isnan(chr2_probs[0])))
+        np.testing.assert_array_equal(chr2_probs[1], [1, 1, 1])
+
+        x_doc = self.db.diplotype_probabilities.find_one({'sample_id': 'S1', 'chromosome': 'X'})
+        self.assertTrue(np.all(np.isnan(mds.get_diplotype_probabilities(x_doc))))
@@ -0,0 +1,97 @@
+import unittest
+import numpy as np
+
+import haploqa.haplohmm as hhmm
+import haploqa.mongods as mds
+
+
+def _make_test_snp_index():
+    """
+    make a small two chromosome index. SNP IDs are given in within chromosome order
+    """
+    chr_snp_ids = [['rs3', 'rs10', 'rs1'], ['JAX00001', 'rs2']]
+    snp_ids = []
+    chr_codes = []
+    chr_indexes = []
+    for chr_code, curr_snp_ids in enumerate(chr_snp_ids):
+        for chr_index, snp_id in enumerate(curr_snp_ids):
+            snp_ids.append(snp_id.encode())
+            chr_codes.append(chr_code)
+            chr_indexes.append(chr_index)
+
+    snp_ids = np.array(snp_ids, dtype=bytes)
+    sort_order = np.argsort(snp_ids)
+
+    return mds.PlatformSnpIndex(
+        'TestMUGA', 3, ['1', 'X'], [3, 2],
+        snp_ids[sort_order],
+        np.array(chr_codes, dtype=np.int8)[sort_order],
+        np.array(chr_indexes, dtype=np.int32)[sort_order],
+    )
+
+
+class TestPlatformSnpIndex(unittest.TestCase):
+    """
+    Class for testing the platform SNP index
+    """
+
+    def test_lookup(self):
+        """single and vectorized lookups should agree and unknown SNPs should be reported as missing"""
+
+        snp_index = _make_test_snp_index()
+        self.assertEqual(snp_index.get('rs10'), ('1', 1))
+        self.assertEqual(snp_index.get('rs2'), ('X', 1))
+        self.assertIsNone(snp_index.get('rs'))
+        self.assertIsNone(snp_index.get('rs100'))
+        self.assertEqual(snp_index.get_row('rs2'), 4)
+
+        query_ids = ['rs1', 'zzz', 'JAX00001', 'rs10000000', 'rs3']
+        chr_codes, chr_indexes = snp_index.lookup(query_ids)
+        np.testing.assert_array_equal(chr_codes, [0, -1, 1, -1, 0])
+        np.testing.assert_array_equal(chr_indexes, [2, -1, 0, -1, 0])
+        np.testing.assert_array_equal(snp_index.lookup_rows(query_ids), [2, -1, 3, -1, 0])
+        self.assertEqual(snp_index.snp_count_per_chr, {'1': 3, 'X': 2})
+
+    def test_doc_round_trip(self):
+        """an index should be unchanged after converting it to a DB document and back"""
+
+        snp_index = _make_test_snp_index()
+        loaded_index = mds.PlatformSnpIndex.from_doc(snp_index.to_doc())
+
+        self.assertEqual(loaded_index.platform_id, 'TestMUGA')
+        self.assertEqual(loaded_index.revision, 3)
+        self.assertEqual(loaded_index.chromosomes, ['1', 'X'])
+        np.testing.assert_array_equal(loaded_index.snp_ids, snp_index.snp_ids)
+        np.testing.assert_array_equal(loaded_index.chr_codes, snp_index.chr_codes)
+        np.testing.assert_array_equal(loaded_index.chr_indexes, snp_index.chr_indexes)
+        np.testing.assert_array_equal(loaded_index.chr_offsets, [0, 3])
+
+
+class TestPackedChrData(unittest.TestCase):
+    """
+    Class for testing the packed chromosome data format
+    """
+
+    def test_pack_round_trip(self):
+        """packing should keep calls exactly including het allele order and calls that don't match the probes"""
+
+        x_calls = np.array(['A', 'C', 'A', 'G', 'A'])
+        y_calls = np.array(['G', 'T', 'C', 'T', 'T'])
+        chr_dict = {
+            'allele1_fwds': ['A', 'T', '-', 'T', 'C'],
+            'allele2_fwds': ['A', 'C', '-', 'G', 'T'],
+            'xs': [0.5, 1.0, 0.0, 0.25, 2.0],
+            'ys': [1.5, 0.5, 0.0, 0.75, 0.125],
+        }
+        unpacked_chr_dict = {k: list(v) for k, v in chr_dict.items()}
+        mds.pack_chr_data(chr_dict, x_calls, y_calls)
+
+        self.assertNotIn('allele1_fwds', chr_dict)
+        np.testing.assert_array_equal(
+            hhmm.unpack_ab_codes(chr_dict['ab_codes'], chr_dict['snp_count']),
+            [hhmm.A_CODE, hhmm.H_CODE, hhmm.N_CODE, hhmm.H_CODE, hhmm.N_CODE])
+        self.assertEqual(mds.unpack_chr_data(chr_dict, None), unpacked_chr_dict)
+
+        snps_chr_dict = {'snps': ['A', 'H', '-', 'N'], 'xs': [0.0] * 4, 'ys': [0.0] * 4}
+        mds.pack_chr_data(snps_chr_dict, x_calls[:4], y_calls[:4])
+        self.assertEqual(mds.unpack_chr_data(snps_chr_dict, None)['snps'], ['A', 'H', '-', 'N'])
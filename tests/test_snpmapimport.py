@@ -0,0 +1,68 @@
+import os
+import tempfile
+import unittest
+
+import mongomock
+
+import haploqa.mongods as mds
+import haploqa.snpmapimport as snpmapimp
+
+TEST_DATA_DIR = os.path.join(os.path.dirname(__file__), 'test_files')
+
+
+class TestSnpMapImport(unittest.TestCase):
+    """
+    Class for testing SNP map imports
+    """
+
+    def setUp(self):
+        self.db = mongomock.MongoClient().db
+
+    def test_import_snp_anno(self):
+        """SNPs should be stored with their probe calls and a within_chr_index following the get_snps ordering"""
+
+        snpmapimp.import_snp_anno(os.path.join(TEST_DATA_DIR, 'snp_map.txt'), 'TestMUGA', self.db)
+
+        platform = self.db.platforms.find_one({'platform_id': 'TestMUGA'})
+        self.assertEqual(platform['chromosomes'], ['1', '2', '10', 'X', 'MT'])
+
+        snps = {x['snp_id']: x for x in self.db.snps.find({'platform_id': 'TestMUGA'}, {'_id': 0})}
+        self.assertEqual(len(snps), 8)
+        self.assertEqual(snps['rs5'], {
+            'platform_id': 'TestMUGA',
+            'snp_id': 'rs5',
+            'chromosome': '2',
+            'position_bp': 300,
+            'x_probe_call': 'A',
+            'y_probe_call': 'G',
+            'within_chr_index': 1,
+        })
+
+        # SNPs whose strands differ get complementary probe calls
+        self.assertEqual((snps['JAX001']['x_probe_call'], snps['JAX001']['y_probe_call']), ('A', 'G'))
+        self.assertEqual((snps['rs1']['x_probe_call'], snps['rs1']['y_probe_call']), ('C', 'A'))
+
+        # SNPs are ordered by position within a chromosome with ties broken by SNP ID
+        for chr_id, snp_ids in (('1', ['rs9', 'rs1', 'rs2']), ('2', ['rs4', 'rs5']), ('X', ['JAX001'])):
+            self.assertEqual([snps[snp_id]['within_chr_index'] for snp_id in snp_ids], list(range(len(snp_ids))))
+            self.assertEqual([x['snp_id'] for x in mds.get_snps('TestMUGA', chr_id, self.db)], snp_ids)
+
+    def test_reject_bad_rows(self):
+        """duplicate SNP names and malformed calls should fail the import before anything is written"""
+
+        header = 'Name\tChromosome\tPosition\tSNP\n'
+        bad_tables = [
+            ('duplicate SNP name: rs1', 'rs1\t1\t10\t[A/G]\nrs2\t1\t20\t[A/G]\nrs1\t2\t30\t[A/G]\n'),
+            ('unexpected snp calls format', 'rs1\t1\t10\t[A/G]\nrs2\t1\t20\tA/G\n'),
+            ('failed to convert position', 'rs1\t1\t10\t[A/G]\nrs2\t1\tten\t[A/G]\n'),
+        ]
+        with tempfile.TemporaryDirectory() as temp_dir:
+            snp_map_file = os.path.join(temp_dir, 'snp_map.txt')
+            for msg, rows in bad_tables:
+                with open(snp_map_file, 'w') as snp_map_handle:
+                    snp_map_handle.write(header + rows)
+
+                with self.assertRaisesRegex(Exception, msg):
+                    snpmapimp.import_snp_anno(snp_map_file, 'TestMUGA', self.db)
+                self.assertEqual(self.db.snps.count_documents({}), 0)
+                self.assertIsNone(self.db.platforms.find_one({'platform_id': 'TestMUGA'}))